@@ -0,0 +1,180 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import re
+import threading
+
+from array import array
+
+# fetch item which download the whole message, batch packed by RFC822.SIZE
+# ex: BODY[], BODY.PEEK[], BODY.PEEK[TEXT], RFC822
+BODY_FETCH = re.compile(r'BODY(?:\.PEEK)?\[(?:TEXT)?\]|\bRFC822(?![.\w])', re.I)
+
+def is_body_fetch(fields):
+    '''
+        check if fetch item download the whole message
+    '''
+
+    return BODY_FETCH.search(fields) is not None
+
+def get_fetch_size(fetched):
+    '''
+        get total literal bytes of fetch items
+    '''
+
+    return sum(len(value) for fetch_item in fetched for value in fetch_item.values()
+        if isinstance(value, (memoryview, bytes, bytearray)))
+
+class FetchBatcher(object):
+    '''
+        adaptive fetch batch size
+        latency and bytes of each FETCH is recorded, number of uid and total bytes of next batch
+        grow while batch complete faster than target_time and shrink when slower
+        so each server and link run close to its best throughput
+        - too small batch waste round trip
+        - too big batch hit server response limit, stall and inflate memory
+    '''
+
+    # maximum change of limit for each recorded batch
+    MAX_SCALE = 2.0
+
+    # weight of new sample of message size
+    WEIGHT = 0.3
+
+    def __init__(self, count=100, min_count=1, max_count=1000, min_bytes=65536, max_bytes=16777216, target_time=1.0):
+        '''
+            count = initial number of uid in one batch
+            min_count, max_count = bound of number of uid in one batch
+            min_bytes, max_bytes = bound of total bytes in one batch
+            target_time = target seconds of one FETCH command
+        '''
+
+        self.__lock = threading.Lock()
+        self.__count = count
+        self.__bytes = None
+        self.__message_size = None
+        self.__batches = 0
+        self.set_limit(min_count, max_count, min_bytes, max_bytes, target_time)
+
+    def set_limit(self, min_count=1, max_count=1000, min_bytes=65536, max_bytes=16777216, target_time=1.0):
+        '''
+            set bound of batch, current limit is clamped into the new bound
+        '''
+
+        with self.__lock:
+            self.__min_count = max(min_count, 1)
+            self.__max_count = max(max_count, self.__min_count)
+            self.__min_bytes = max(min_bytes, 1)
+            self.__max_bytes = max(max_bytes, self.__min_bytes)
+            self.__target_time = target_time
+            self.__count = self.__clamp(self.__count, self.__min_count, self.__max_count)
+            self.__bytes = self.__clamp(self.__bytes or min(self.__max_bytes, 1048576), self.__min_bytes, self.__max_bytes)
+
+    def __clamp(self, value, minimum, maximum):
+        return int(min(max(value, minimum), maximum))
+
+    def get_limit(self, sized=False):
+        '''
+            get limit of next batch
+            sized = False if size of each email is unknown,
+                number of uid also limited by total bytes using measured average message size
+            return (number of uid, total bytes)
+        '''
+
+        with self.__lock:
+            count = self.__count
+            if not sized and self.__message_size:
+                count = self.__clamp(min(count, self.__bytes // self.__message_size), self.__min_count, self.__max_count)
+
+            return count, self.__bytes
+
+    def get_stats(self):
+        '''
+            get current state of batcher
+            {'count':200, 'bytes':2097152, 'message_size':4120, 'batches':12}
+        '''
+
+        with self.__lock:
+            return {'count':self.__count, 'bytes':self.__bytes,
+                'message_size':int(self.__message_size) if self.__message_size else None, 'batches':self.__batches}
+
+    def record(self, count, size, elapsed, sized=False):
+        '''
+            record one completed batch
+            count = number of uid, size = fetched bytes, elapsed = seconds
+            only full batch grow the limit, last smaller batch can only shrink it
+        '''
+
+        if count <= 0:
+            return
+
+        limit_count, limit_bytes = self.get_limit(sized)
+
+        with self.__lock:
+            self.__batches += 1
+            message_size = max(size / count, 1)
+            if self.__message_size is None:
+                self.__message_size = message_size
+            else:
+                self.__message_size += (message_size - self.__message_size) * self.WEIGHT
+
+            scale = self.__target_time / max(elapsed, 0.001)
+            scale = min(max(scale, 1 / self.MAX_SCALE), self.MAX_SCALE)
+
+            is_full = count >= limit_count or size >= limit_bytes * 0.8
+            if scale > 1 and not is_full:
+                return
+
+            self.__count = self.__clamp(max(count, limit_count if scale > 1 else count) * scale,
+                self.__min_count, self.__max_count)
+            self.__bytes = self.__clamp(max(size, limit_bytes if scale > 1 else size) * scale,
+                self.__min_bytes, self.__max_bytes)
+
+    def failure(self):
+        '''
+            batch rejected by server (ex: response too big), halve the limit
+        '''
+
+        with self.__lock:
+            self.__count = self.__clamp(self.__count // 2, self.__min_count, self.__max_count)
+            self.__bytes = self.__clamp(self.__bytes // 2, self.__min_bytes, self.__max_bytes)
+
+    def batches(self, email_ids, sizes=None):
+        '''
+            split email_ids into batch using current limit
+            sizes = RFC822.SIZE of each email_id in the same order, batch packed by size
+                or function(email_ids) return sizes of chunk of email_ids,
+                called for next max_count email_ids only when packed batch need it
+            limit is read for each batch, so recorded batch affect the next batch
+            batch has at least one email_id even if bigger than byte limit
+        '''
+
+        fetch_sizes = sizes if callable(sizes) else None
+        if fetch_sizes:
+            sizes = array('L')
+
+        index = 0
+        while index < len(email_ids):
+            count, max_bytes = self.get_limit(sizes is not None)
+            end = min(index + count, len(email_ids))
+
+            # size of email_ids in next batch is fetched lazily, one chunk ahead of packing
+            while fetch_sizes and len(sizes) < end:
+                with self.__lock:
+                    chunk = self.__max_count
+                sizes.extend(fetch_sizes(email_ids[len(sizes):len(sizes) + chunk]))
+
+            if sizes is not None:
+                total = sizes[index]
+                stop = index + 1
+                while stop < end and total + sizes[stop] <= max_bytes:
+                    total += sizes[stop]
+                    stop += 1
+
+                end = stop
+
+            yield email_ids[index:end]
+            index = end
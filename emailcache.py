@@ -0,0 +1,163 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import threading
+
+class FlagCache(object):
+    '''
+        local per uid flag cache
+        namespace is tuple of (host, username, mailbox)
+        updated from FETCH and STORE response
+        so flag based filter don't need server round trip
+    '''
+
+    def __init__(self):
+        '''
+            create flag cache object
+            with no parameter
+        '''
+
+        self.__flag_cache = {}
+        # loader of restored namespace, see restore
+        self.__loaders = {}
+        self.__lock = threading.RLock()
+
+    def __load(self, namespace):
+        '''
+            load restored namespace on first access
+            flags already set before loading are kept
+        '''
+
+        loader = self.__loaders.pop(namespace, None)
+        if loader is None:
+            return
+
+        flag_cache = dict((str(email_id), set(flags)) for email_id, flags in (loader() or {}).items())
+        flag_cache.update(self.__flag_cache.get(namespace, {}))
+        self.__flag_cache[namespace] = flag_cache
+
+    def restore(self, namespace, loader):
+        '''
+            restore cached flags of namespace lazily
+            loader is called on first access of namespace
+            loader return dictionary of email_id and flags {'30411':['\\Seen']}
+        '''
+
+        with self.__lock:
+            self.__loaders[namespace] = loader
+
+    def is_loaded(self, namespace):
+        '''
+            check if restored namespace already loaded
+        '''
+
+        with self.__lock:
+            return namespace not in self.__loaders
+
+    def get_namespaces(self):
+        '''
+            get all namespace, including restored namespace not loaded yet
+        '''
+
+        with self.__lock:
+            return list(set(self.__flag_cache) | set(self.__loaders))
+
+    def get(self, namespace, email_id=None):
+        '''
+            get cached flags of email_id
+            if email_id not set will return all cached flags in namespace as dictionary
+            return None if email_id not in cache
+        '''
+
+        with self.__lock:
+            self.__load(namespace)
+            flag_cache = self.__flag_cache.get(namespace, {})
+
+            if email_id is None:
+                return dict((cached_id, set(flags)) for cached_id, flags in flag_cache.items())
+
+            flags = flag_cache.get(str(email_id))
+            if flags is None:
+                return None
+
+            return set(flags)
+
+    def set(self, namespace, email_id, flags):
+        '''
+            replace cached flags of email_id
+            flags = ['\\Seen', '\\Answered']
+        '''
+
+        with self.__lock:
+            self.__load(namespace)
+            self.__flag_cache.setdefault(namespace, {})[str(email_id)] = set(flags)
+
+    def update(self, namespace, email_ids, command, flags):
+        '''
+            apply store command to cached flags
+            command should be 'FLAGS', '+FLAGS', '-FLAGS', optionaly with suffix of .SILENT
+            flags = ['\\Seen', '\\Answered']
+        '''
+
+        command = command.upper().replace('.SILENT', '')
+        flags = set(flags)
+
+        with self.__lock:
+            self.__load(namespace)
+            flag_cache = self.__flag_cache.setdefault(namespace, {})
+
+            for email_id in email_ids:
+                email_id = str(email_id)
+
+                if command == 'FLAGS':
+                    flag_cache[email_id] = set(flags)
+                elif command == '+FLAGS':
+                    flag_cache.setdefault(email_id, set()).update(flags)
+                elif command == '-FLAGS' and email_id in flag_cache:
+                    flag_cache.get(email_id).difference_update(flags)
+
+    def update_from_fetch(self, namespace, fetched):
+        '''
+            update cached flags from parsed fetch response
+            fetched is list of fetch item from parse_fetch_response
+        '''
+
+        with self.__lock:
+            self.__load(namespace)
+            flag_cache = self.__flag_cache.setdefault(namespace, {})
+
+            for fetch_item in fetched:
+                if fetch_item.get('UID') and fetch_item.get('FLAGS') is not None:
+                    flag_cache[fetch_item.get('UID')] = set(fetch_item.get('FLAGS'))
+
+    def search(self, namespace, flag, present=True):
+        '''
+            search cached email_id with flag
+            present = False will return email_id without the flag
+        '''
+
+        with self.__lock:
+            self.__load(namespace)
+            flag_cache = self.__flag_cache.get(namespace, {})
+
+            return [email_id for email_id, flags in flag_cache.items() if (flag in flags) == present]
+
+    def remove(self, namespace, email_ids=None):
+        '''
+            remove email_id from cache
+            if email_ids not set will remove all cached flags in namespace
+        '''
+
+        with self.__lock:
+            if email_ids is None:
+                self.__flag_cache.pop(namespace, None)
+                self.__loaders.pop(namespace, None)
+                return
+
+            self.__load(namespace)
+            flag_cache = self.__flag_cache.get(namespace, {})
+            for email_id in email_ids:
+                flag_cache.pop(str(email_id), None)
@@ -0,0 +1,406 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import abc
+import json
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import time
+
+from email.header import Header
+from urllib.parse import quote
+
+class CodecError(ValueError):
+    '''
+        cached data can't be encoded or decoded
+    '''
+    pass
+
+def _to_json(value):
+    '''
+        convert value not supported by json, ex: email.header.Header of undecoded header
+    '''
+
+    if isinstance(value, Header):
+        return str(value)
+
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+class CacheCodec(abc.ABC):
+    '''
+        base class of email cache codec
+        encoded data start with MAGIC so codec can be detected when reading
+        register new codec with register_codec
+    '''
+
+    NAME = None
+    MAGIC = None
+
+    @abc.abstractmethod
+    def encode(self, value):
+        '''
+            encode value into bytes
+        '''
+
+    @abc.abstractmethod
+    def decode(self, data):
+        '''
+            decode bytes into value
+        '''
+
+    def is_encoded(self, data):
+        '''
+            check if data encoded by this codec
+        '''
+
+        return self.MAGIC is not None and bytes(data[:len(self.MAGIC)]) == self.MAGIC
+
+    def peek(self, data, keys):
+        '''
+            decode only value of keys, missing key is not returned
+            codec override it when value can be read without decoding the whole data
+        '''
+
+        value = self.decode(data)
+        return dict((key, value.get(key)) for key in keys if key in value)
+
+class BinaryCodec(CacheCodec):
+    '''
+        safe length prefixed binary codec, default cache codec
+        encode dictionary with str key (cached email dictionary)
+        value can be str, int, float, bool, None or json serializable list and dictionary
+        email.header.Header is stored as str
+        decoding never execute code, so cache can be shared between services
+
+        layout:
+            MAGIC, count of item (uint32), type tag of each value (1 byte),
+            length of each key and value in character (uint32), utf-8 text of all key and value
+    '''
+
+    NAME = 'binary'
+    MAGIC = b'PXC1'
+
+    __COUNT = struct.Struct('<I')
+
+    def encode(self, value):
+        if not isinstance(value, dict):
+            raise CodecError('can\'t encode %s with %s codec' % (type(value).__name__, self.NAME))
+
+        tags = bytearray()
+        lengths = []
+        texts = []
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise CodecError('can\'t encode %s key with %s codec' % (type(key).__name__, self.NAME))
+
+            if isinstance(item, Header):
+                item = str(item)
+
+            if isinstance(item, str):
+                tag = b's'
+            elif item is None:
+                tag, item = b'N', ''
+            elif item is True or item is False:
+                tag, item = (b'T' if item else b'F'), ''
+            elif isinstance(item, int):
+                tag, item = b'i', str(item)
+            elif isinstance(item, float):
+                tag, item = b'f', repr(item)
+            else:
+                try:
+                    tag, item = b'j', json.dumps(item, separators=(',', ':'), default=_to_json)
+                except (TypeError, ValueError) as e:
+                    raise CodecError('can\'t encode %s: %s' % (key, e))
+
+            tags += tag
+            lengths.append(len(key))
+            lengths.append(len(item))
+            texts.append(key)
+            texts.append(item)
+
+        return b''.join((self.MAGIC, self.__COUNT.pack(len(tags)), tags,
+            struct.pack('<%dI' % len(lengths), *lengths), ''.join(texts).encode('UTF-8', 'surrogatepass')))
+
+    def decode(self, data):
+        return self.__decode(data)
+
+    def peek(self, data, keys):
+        # other value is sliced over, json and number of them is not parsed
+        return self.__decode(data, set(keys))
+
+    def __decode(self, data, keys=None):
+        if not self.is_encoded(data):
+            raise CodecError('data is not encoded with %s codec' % self.NAME)
+
+        try:
+            offset = len(self.MAGIC)
+            count = self.__COUNT.unpack_from(data, offset)[0]
+            offset += self.__COUNT.size
+            tags = bytes(data[offset:offset + count])
+            offset += count
+            lengths = struct.unpack_from('<%dI' % (count * 2), data, offset)
+            offset += count * 8
+            text = str(data[offset:], 'UTF-8', 'surrogatepass')
+
+            value = {}
+            position = 0
+            for i, tag in enumerate(tags):
+                key_end = position + lengths[i * 2]
+                end = key_end + lengths[i * 2 + 1]
+                key = text[position:key_end]
+                position = end
+
+                if keys is not None and key not in keys:
+                    if tag not in b'sNTFifj':
+                        raise CodecError('corrupted data: unknown tag %r' % chr(tag))
+                    continue
+
+                # s, N, T, F, i, f, j
+                if tag == 115:
+                    value[key] = text[key_end:end]
+                elif tag == 78:
+                    value[key] = None
+                elif tag == 84:
+                    value[key] = True
+                elif tag == 70:
+                    value[key] = False
+                elif tag == 105:
+                    value[key] = int(text[key_end:end])
+                elif tag == 102:
+                    value[key] = float(text[key_end:end])
+                elif tag == 106:
+                    value[key] = json.loads(text[key_end:end])
+                else:
+                    raise CodecError('corrupted data: unknown tag %r' % chr(tag))
+
+        except (struct.error, ValueError) as e:
+            if isinstance(e, CodecError):
+                raise
+
+            raise CodecError('corrupted data: %s' % e)
+
+        if len(tags) != count or position != len(text):
+            raise CodecError('corrupted data: length mismatch')
+
+        return value
+
+class PickleCodec(CacheCodec):
+    '''
+        legacy pickle codec, format of cache before codec support
+        unsafe for untrusted cache, only used when allowed, see migrate_cache
+    '''
+
+    NAME = 'pickle'
+
+    def encode(self, value):
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+    def is_encoded(self, data):
+        # pickle protocol 2 and newer start with PROTO opcode
+        return bytes(data[:1]) == b'\x80'
+
+_codecs = {}
+
+def register_codec(codec):
+    '''
+        register codec object so it can be used by name and detected when reading
+    '''
+
+    _codecs[codec.NAME] = codec
+
+def get_codec(name=None):
+    '''
+        get registered codec by name, default is binary codec
+    '''
+
+    codec = _codecs.get(name or BinaryCodec.NAME)
+    if codec is None:
+        raise CodecError('unknown codec: %s' % name)
+
+    return codec
+
+def decode_cache(data, codec=None, allow_pickle=False, keys=None):
+    '''
+        decode cached data with codec which encoded it
+        codec = preferred codec, tried first
+        legacy pickle data only decoded if allow_pickle is True
+        keys = only decode value of keys, see CacheCodec.peek
+    '''
+
+    codecs = [codec or get_codec()] + list(_codecs.values())
+    for item in codecs:
+        if isinstance(item, PickleCodec) and not allow_pickle:
+            continue
+
+        if item.is_encoded(data):
+            return item.decode(data) if keys is None else item.peek(data, keys)
+
+    raise CodecError('unknown cache format')
+
+register_codec(BinaryCodec())
+register_codec(PickleCodec())
+
+def migrate_cache(directory, codec=None, allow_pickle=True, legacy_mailbox=None):
+    '''
+        convert cached email of pxemail_cache tree into codec format
+        directory = local cache directory, see PxEmail.imap_set_directory
+        cached email is file named by email_id inside directory with the same name
+            directory/username/quoted mailbox/email_id/email_id
+        file replaced atomically, file already in codec format is skipped
+
+        legacy_mailbox = mailbox of cache saved before cache was kept per mailbox
+            legacy file directory/username/email_id/email_id is never read again,
+            it is moved into directory/username/quoted legacy_mailbox/email_id/email_id,
+            legacy file is left and counted as legacy if not set,
+            legacy file is removed if the email already cached in new layout
+
+        return {'migrated':10, 'skipped':2, 'legacy':0, 'failed':{'path':'error'}}
+    '''
+
+    codec = codec or get_codec()
+    result = {'migrated':0, 'skipped':0, 'legacy':0, 'failed':{}}
+    directory = os.path.abspath(directory)
+
+    # username/email_id is legacy layout, username/mailbox/email_id is current layout
+    # legacy file is moved after current layout converted, moved file is not walked again
+    cached = []
+    for dir_path, dir_names, file_names in os.walk(directory):
+        email_id = os.path.basename(dir_path)
+        if email_id.isdigit() and email_id in file_names:
+            parts = os.path.relpath(dir_path, directory).split(os.path.sep)
+            cached.append((len(parts) == 2, dir_path, parts))
+
+    cached.sort(key=lambda item: item[0])
+
+    for is_legacy, dir_path, parts in cached:
+        email_id = parts[-1]
+        filename = dir_path + os.path.sep + email_id
+        target = filename
+
+        if is_legacy:
+            if legacy_mailbox is None:
+                result['legacy'] += 1
+                continue
+
+            target_dir = os.path.sep.join((directory, parts[0], quote(legacy_mailbox, safe=''), email_id))
+            target = target_dir + os.path.sep + email_id
+            if os.path.isfile(target):
+                _remove_legacy(dir_path, filename)
+                result['skipped'] += 1
+                continue
+
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+
+            if target == filename and codec.is_encoded(data):
+                result['skipped'] += 1
+                continue
+
+            encoded = data if codec.is_encoded(data) else codec.encode(decode_cache(data, codec, allow_pickle))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+
+            with open(target + '.tmp', 'wb') as f:
+                f.write(encoded)
+
+            os.replace(target + '.tmp', target)
+            if target != filename:
+                _remove_legacy(dir_path, filename)
+
+            result['migrated'] += 1
+
+        except Exception as e:
+            result['failed'][filename] = repr(e)
+
+    return result
+
+def _remove_legacy(dir_path, filename):
+    '''
+        remove legacy cache file and its directory if empty
+    '''
+
+    os.remove(filename)
+    try:
+        os.rmdir(dir_path)
+    except OSError:
+        pass
+
+def benchmark(samples=None, rounds=2000):
+    '''
+        compare encode and decode throughput and size of registered codec
+        file is write and read round trip of cached email file, the way PxEmail use the codec
+        samples = list of cached email dictionary, default is generated header and content sample
+
+        return {'binary':{'encode':ops per second, 'decode':ops per second, 'file':ops per second, 'size':average bytes}}
+    '''
+
+    if samples is None:
+        samples = [{'ID':str(30000 + i),
+            'From':'Jhon Doe <jhon%d@mail.com>' % i,
+            'To':'jane@mail.com, team@mail.com',
+            'CC':None,
+            'BCC':None,
+            'Subject':'weekly report %d' % i,
+            'Date':'Mon, 03 Jan 2022 10:00:00 +0000',
+            'MessageID':'<%d.report@mail.com>' % i,
+            'Size':1234 + i,
+            'Message':'hello world\n' * (i % 50),
+            'Attachment':[{'name':'report.pdf', 'mime':'application/pdf'}],
+            'InlineAttachment':[]} for i in range(100)]
+
+    result = {}
+    for name, codec in _codecs.items():
+        encoded = [codec.encode(sample) for sample in samples]
+
+        start = time.perf_counter()
+        for i in range(rounds):
+            codec.encode(samples[i % len(samples)])
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(rounds):
+            codec.decode(encoded[i % len(encoded)])
+        decode_time = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            for i in range(rounds):
+                filename = directory + os.path.sep + str(i % len(samples))
+                with open(filename + '.tmp', 'wb') as f:
+                    f.write(codec.encode(samples[i % len(samples)]))
+
+                os.replace(filename + '.tmp', filename)
+                with open(filename, 'rb') as f:
+                    codec.decode(f.read())
+
+            file_time = time.perf_counter() - start
+
+        result[name] = {'encode':int(rounds / encode_time),
+            'decode':int(rounds / decode_time),
+            'file':int(rounds / file_time),
+            'size':sum(len(data) for data in encoded) // len(encoded)}
+
+    return result
+
+if __name__ == '__main__':
+    '''
+        python emailcodec.py benchmark
+        python emailcodec.py migrate pxemail_cache [legacy mailbox, ex: INBOX]
+    '''
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'migrate':
+        print(migrate_cache(sys.argv[2], legacy_mailbox=sys.argv[3] if len(sys.argv) > 3 else None))
+    else:
+        for name, stat in benchmark().items():
+            print('%-8s encode %8d/s  decode %8d/s  file %8d/s  size %6d bytes' % (name,
+                stat.get('encode'), stat.get('decode'), stat.get('file'), stat.get('size')))
@@ -0,0 +1,163 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+
+from emailthrottle import is_disconnected
+
+class DeadlineExceeded(Exception):
+    '''
+        operation not completed before deadline
+        continuation = imap sequence set of email_id not processed yet, None if not batched operation
+        not OSError, so handler of dropped connection don't reconnect and retry after deadline
+    '''
+
+    def __init__(self, msg='deadline exceeded', continuation=None):
+        super().__init__(msg)
+        self.continuation = continuation
+
+class Deadline(object):
+    '''
+        absolute deadline of one call
+        Deadline(2.0) expire 2 seconds from now, nested call given the same object share the time budget
+        socket operation can't run past the deadline, see apply
+    '''
+
+    def __init__(self, timeout=None):
+        '''
+            timeout = seconds from now, None never expire
+        '''
+
+        self.__expire = None if timeout is None else time.monotonic() + timeout
+
+        # socket used inside apply, shut down by one timer when deadline expire
+        self.__lock = threading.Lock()
+        self.__sockets = []
+        self.__timer = None
+
+    @classmethod
+    def get(cls, deadline):
+        '''
+            get Deadline object from seconds, Deadline object or None
+        '''
+
+        if deadline is None or isinstance(deadline, Deadline):
+            return deadline
+
+        return cls(deadline)
+
+    def remaining(self):
+        '''
+            seconds until deadline, None if never expire
+        '''
+
+        if self.__expire is None:
+            return None
+
+        return max(self.__expire - time.monotonic(), 0)
+
+    def is_expired(self):
+        return self.__expire is not None and time.monotonic() >= self.__expire
+
+    def check(self, continuation=None):
+        '''
+            raise DeadlineExceeded if expired
+        '''
+
+        if self.is_expired():
+            raise DeadlineExceeded(continuation=continuation)
+
+    def __shutdown(self):
+        '''
+            timer callback, shut down every socket still used inside apply
+        '''
+
+        with self.__lock:
+            entries = list(self.__sockets)
+            for entry in entries:
+                entry['shutdown'] = True
+
+        for entry in entries:
+            try:
+                entry.get('sock').shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __register(self, sock):
+        '''
+            add socket to be shut down at deadline, timer started on first socket
+        '''
+
+        entry = {'sock':sock, 'shutdown':False}
+        with self.__lock:
+            self.__sockets.append(entry)
+            if self.__timer is None:
+                self.__timer = threading.Timer(self.remaining(), self.__shutdown)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+        return entry
+
+    def __unregister(self, entry):
+        '''
+            remove socket from shut down list
+            return True if socket already shut down by timer
+        '''
+
+        with self.__lock:
+            self.__sockets.remove(entry)
+            return entry.get('shutdown')
+
+    @contextmanager
+    def apply(self, sock):
+        '''
+            limit blocking socket operation to remaining time
+            socket timeout only limit one read, server sending response slowly line by line
+            can pass it, so socket is also shut down when deadline expire
+            one timer is shared by every apply of the deadline
+            socket timeout is restored when leaving, timeout or dropped connection
+            after deadline is raised as DeadlineExceeded, socket shut down can't be used again
+
+            with deadline.apply(imap.sock):
+                imap.noop()
+        '''
+
+        self.check()
+
+        timeout = sock.gettimeout()
+        remaining = self.remaining()
+        if remaining is None:
+            yield self
+            return
+
+        sock.settimeout(remaining if timeout is None else min(timeout, remaining))
+        entry = self.__register(sock)
+        shutdown = False
+
+        try:
+            yield self
+
+        except Exception as e:
+            if is_disconnected(e) and self.is_expired():
+                raise DeadlineExceeded('deadline exceeded: %s' % e) from e
+
+            raise
+
+        finally:
+            shutdown = self.__unregister(entry)
+            try:
+                sock.settimeout(timeout)
+            except OSError:
+                # socket already closed
+                pass
+
+        # operation completed but socket is already shut down
+        if shutdown:
+            raise DeadlineExceeded() from OSError('socket shut down at deadline')
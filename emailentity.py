@@ -6,7 +6,6 @@
 
 import imaplib
 import smtplib
-imaplib._MAXLINE = 1000000
 
 class EntityFlag(object):
     '''
@@ -56,7 +55,7 @@ class IMAPEntity(object):
         return True
         
     def add(self, host, username, password, port=imaplib.IMAP4_PORT,
-        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, ssl_context=None, force=False):
+        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, ssl_context=None, force=False, timeout=None):
             
         '''
             add imap user to __imap_user
@@ -66,6 +65,7 @@ class IMAPEntity(object):
             port = 143 (default is imap port or custom port depend on connection preference)
             force = False (default is false, to not override existing user), if exist will return false
                 True will force existing user with new configuration
+            timeout = socket timeout in seconds of connect and each blocking operation, None wait forever
                     
             connection_type = EntityFlag.CONNECTION_PLAIN (if connection using ssl, may need keyfile, certfile, ssl_context parameter)
                 value should be one of EntityFlag.CONNECTION_PLAIN|EntityFlag.CONNECTION_SSL
@@ -78,15 +78,13 @@ class IMAPEntity(object):
         if not self.__imap_entity.get(host):
             self.__imap_entity[host] = {}
                  
+        if connection_type == EntityFlag.CONNECTION_SSL and port == imaplib.IMAP4_PORT:
+            port = imaplib.IMAP4_SSL_PORT
+                 
         # imap is imap object
         # also auto create imap object when add imap user
         try:
-            if connection_type == EntityFlag.CONNECTION_SSL:
-                if port == imaplib.IMAP4_PORT:
-                    port = imaplib.IMAP4_SSL_PORT
-                imap = imaplib.IMAP4_SSL(host, port, keyfile, certfile, ssl_context)
-            else:
-                imap = imaplib.IMAP4(host, port)
+            imap = self.__connect(host, port, connection_type, keyfile, certfile, ssl_context, timeout)
                 
         except imaplib.IMAP4.error as e:
             return EntityFlag.ERROR_UNKNOWN_HOST
@@ -98,10 +96,66 @@ class IMAPEntity(object):
             'keyfile':keyfile,
             'certfile':certfile,
             'ssl_context':ssl_context,
+            'timeout':timeout,
             'imap':imap,
             'is_login':False}
         
         return EntityFlag.SUCCESS_ADD_NEW_USER
+        
+    def restore(self, host, username, password, port=imaplib.IMAP4_PORT,
+        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, ssl_context=None, timeout=None):
+        '''
+            add imap user without connecting to server
+            imap object is created on first get_imap, used for restoring snapshot
+            existing user is not overridden
+        '''
+        
+        if self.is_entity_exist(host, username):
+            return EntityFlag.ERROR_USER_EXIST
+            
+        self.__imap_entity.setdefault(host, {})[username] = {
+            'password':password,
+            'port':port,
+            'connection_type':connection_type,
+            'keyfile':keyfile,
+            'certfile':certfile,
+            'ssl_context':ssl_context,
+            'timeout':timeout,
+            'imap':None,
+            'is_login':False}
+            
+        return EntityFlag.SUCCESS_ADD_NEW_USER
+        
+    def __connect(self, host, port, connection_type, keyfile, certfile, ssl_context, timeout=None):
+        '''
+            create new imap object
+            depend on connection type
+        '''
+        
+        if connection_type == EntityFlag.CONNECTION_SSL:
+            return imaplib.IMAP4_SSL(host, port, keyfile, certfile, ssl_context, timeout=timeout)
+            
+        return imaplib.IMAP4(host, port, timeout=timeout)
+        
+    def create_imap(self, host, username):
+        '''
+            create new imap object using existing imap user configuration
+            the new imap object is not login yet
+            used for additional connection, ex: connection pool
+            if imap user not exist return None
+        '''
+        
+        if not self.is_entity_exist(host, username):
+            return None
+            
+        imap_user = self.get(host, username)
+        return self.__connect(host,
+            imap_user.get('port'),
+            imap_user.get('connection_type'),
+            imap_user.get('keyfile'),
+            imap_user.get('certfile'),
+            imap_user.get('ssl_context'),
+            imap_user.get('timeout'))
     
     def get_all(self):
         '''
@@ -137,6 +191,7 @@ class IMAPEntity(object):
             get user imap configuration
             depend on host and username selector
             will return imap object for login and manipulating email
+            restored user connect on first call
             if not exist return None
         '''
         
@@ -144,6 +199,12 @@ class IMAPEntity(object):
         
         # if username exist return imap user config
         if imap_user.get(username):
+            if imap_user.get(username).get('imap') is None:
+                try:
+                    imap_user.get(username)['imap'] = self.create_imap(host, username)
+                except (imaplib.IMAP4.error, OSError) as e:
+                    print(e)
+                    
             return imap_user.get(username).get('imap')
             
         return None
@@ -163,7 +224,7 @@ class SMTPEntity(object):
         self.__smtp_entity = {}
         
     def add(self, host, username, password, port=smtplib.SMTP_PORT, local_hostname=None, source_address=None,
-        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, context=None, force=False):
+        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, context=None, force=False, timeout=None):
             
         '''
             add smtp entity to __smtp_entity
@@ -179,6 +240,7 @@ class SMTPEntity(object):
                 If omitted (or if host or port are '' and/or 0 respectively) the OS default behavior will be used.    
             force = False (default is false, to not override existing user), if exist will return false
                     True will force existing user with new configuration
+            timeout = socket timeout in seconds of connect and each blocking operation, None use socket default timeout
                     
             connection_type = EntityFlag.CONNECTION_PLAIN (if connection using ssl, may need keyfile, certfile, ssl_context parameter)
                 value should be one of connection_type=EntityFlag.CONNECTION_PLAIN|connection_type=EntityFlag.CONNECTION_SSL|connection_type=EntityFlag.CONNECTION_LMTP
@@ -192,50 +254,118 @@ class SMTPEntity(object):
             if not force:
                 return EntityFlag.ERROR_USER_EXIST
                  
+        if connection_type == EntityFlag.CONNECTION_SSL:
+            if port == smtplib.SMTP_PORT or port == smtplib.LMTP_PORT:
+                port = smtplib.SMTP_SSL_PORT
+                
+        elif connection_type == EntityFlag.CONNECTION_LMTP:
+            if port == smtplib.SMTP_PORT or port == smtplib.SMTP_SSL_PORT:
+                port = smtplib.LMTP_PORT
+                 
         # smtp is smtp object
         # also auto create smtp object when add smtp user
         try:
-            # SMTP SSL type
-            if connection_type == EntityFlag.CONNECTION_SSL:
-                if port == smtplib.SMTP_PORT or port == smtplib.LMTP_PORT:
-                    port = smtplib.SMTP_SSL_PORT
-                    
-                smtp = smtplib.SMTP_SSL(host=host,
-                    port=port,
-                    local_hostname=local_hostname,
-                    keyfile=keyfile,
-                    certfile=certfile,
-                    context=context,
-                    source_address=source_address)
-            # LMTP
-            elif connection_type == EntityFlag.CONNECTION_LMTP:
-                if port == smtplib.SMTP_PORT or port == smtplib.SMTP_SSL_PORT:
-                    port = smtplib.LMTP_PORT
-                    
-                smtp = smtplib.LMTP(host, port, local_hostname, source_address)
-            # SMTP PLAIN
-            else:
-                smtp = smtplib.SMTP(host=host,
-                    port=port,
-                    local_hostname=local_hostname,
-                    source_address=source_address)
+            smtp = self.__connect(host, port, local_hostname, source_address,
+                connection_type, keyfile, certfile, context, timeout)
                 
         except smtplib.SMTPException:
-            return SMTPUser.ERROR_UNKNOWN_HOST
+            return EntityFlag.ERROR_UNKNOWN_HOST
              
         self.__smtp_entity.get(host)[username] = {
             'password':password,
             'port':port,
+            'connection_type':connection_type,
             'local_hostname':local_hostname,
             'source_address':source_address,
             'keyfile':keyfile,
             'certfile':certfile,
             'context':context,
+            'timeout':timeout,
             'smtp':smtp,
+            'rcpt_limit':100,
             'is_login':False}
         
         return True
         
+    def restore(self, host, username, password, port=smtplib.SMTP_PORT, local_hostname=None, source_address=None,
+        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, context=None, rcpt_limit=100, timeout=None):
+        '''
+            add smtp user without connecting to server
+            smtp object is created on first get_smtp, used for restoring snapshot
+            existing user is not overridden
+        '''
+        
+        if self.__smtp_entity.get(host, {}).get(username):
+            return EntityFlag.ERROR_USER_EXIST
+            
+        self.__smtp_entity.setdefault(host, {})[username] = {
+            'password':password,
+            'port':port,
+            'connection_type':connection_type,
+            'local_hostname':local_hostname,
+            'source_address':source_address,
+            'keyfile':keyfile,
+            'certfile':certfile,
+            'context':context,
+            'timeout':timeout,
+            'smtp':None,
+            'rcpt_limit':rcpt_limit,
+            'is_login':False}
+            
+        return True
+        
+    def __connect(self, host, port, local_hostname, source_address, connection_type, keyfile, certfile, context, timeout=None):
+        '''
+            create new smtp object
+            depend on connection type
+        '''
+        
+        # smtplib default is global socket timeout, only override if set
+        options = {'timeout':timeout} if timeout is not None else {}
+        
+        # SMTP SSL type
+        if connection_type == EntityFlag.CONNECTION_SSL:
+            return smtplib.SMTP_SSL(host=host,
+                port=port,
+                local_hostname=local_hostname,
+                keyfile=keyfile,
+                certfile=certfile,
+                context=context,
+                source_address=source_address,
+                **options)
+        # LMTP
+        elif connection_type == EntityFlag.CONNECTION_LMTP:
+            return smtplib.LMTP(host, port, local_hostname, source_address, **options)
+            
+        # SMTP PLAIN
+        return smtplib.SMTP(host=host,
+            port=port,
+            local_hostname=local_hostname,
+            source_address=source_address,
+            **options)
+            
+    def create_smtp(self, host, username):
+        '''
+            create new smtp object using existing smtp user configuration
+            the new smtp object is not login yet
+            used for additional connection, ex: connection pool
+            if smtp user not exist return None
+        '''
+        
+        if not self.__smtp_entity.get(host) or not self.__smtp_entity.get(host).get(username):
+            return None
+            
+        smtp_user = self.get(host, username)
+        return self.__connect(host,
+            smtp_user.get('port'),
+            smtp_user.get('local_hostname'),
+            smtp_user.get('source_address'),
+            smtp_user.get('connection_type', EntityFlag.CONNECTION_PLAIN),
+            smtp_user.get('keyfile'),
+            smtp_user.get('certfile'),
+            smtp_user.get('context'),
+            smtp_user.get('timeout'))
+        
     def get(self, host, username=None):
         '''
             get user smtp configuration
@@ -268,6 +398,7 @@ class SMTPEntity(object):
             get user smtp configuration
             depend on host and username selector
             will return smtp object for login and manipulating email
+            restored user connect on first call
             if not exist return None
         '''
         
@@ -275,6 +406,12 @@ class SMTPEntity(object):
         
         # if username exist return smtp user config
         if smtp_entity.get(username):
+            if smtp_entity.get(username).get('smtp') is None:
+                try:
+                    smtp_entity.get(username)['smtp'] = self.create_smtp(host, username)
+                except (smtplib.SMTPException, OSError) as e:
+                    print(e)
+                    
             return smtp_entity.get(username).get('smtp')
             
         return None
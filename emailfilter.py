@@ -231,6 +231,34 @@ class EmailFilter(object):
         self.__filter_email.append('OR')
         return self
         
+    def set_gmail_raw(self, query):
+        '''
+            add gmail search query using X-GM-RAW (gmail only)
+            same syntax as gmail web search box
+            ex: 'has:attachment in:unread larger:1M'
+        '''
+        
+        self.__filter_email.append('X-GM-RAW "' + query.replace('\\', '\\\\').replace('"', '\\"') + '"')
+        return self
+        
+    def set_gmail_label(self, label):
+        '''
+            add filter email with gmail label using X-GM-LABELS (gmail only)
+            if label contain space add double quote:
+            ex: '"My Label"'
+        '''
+        
+        self.__filter_email.append('X-GM-LABELS ' + label)
+        return self
+        
+    def set_gmail_msgid(self, msgid):
+        '''
+            add filter gmail message id using X-GM-MSGID (gmail only)
+        '''
+        
+        self.__filter_email.append('X-GM-MSGID ' + str(msgid))
+        return self
+        
     def generate(self):
         '''
             return all into list of filter
@@ -0,0 +1,402 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import email.header
+import email.utils
+import os
+import sqlite3
+import threading
+
+class DedupeIndex(object):
+    '''
+        cross mailbox duplicate email index of one imap user
+        email identified by Message-ID and RFC822.SIZE
+        body_hash is hash of cached body, only email with cached body can be used as link source
+        so same email filed in many mailbox is fetched and stored once
+    '''
+
+    def __init__(self, filename):
+        '''
+            filename = sqlite database file, created if not exist
+        '''
+
+        dir_path = os.path.dirname(filename)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+        self.__lock = threading.RLock()
+        self.__db = sqlite3.connect(filename, check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS message (
+            mailbox TEXT NOT NULL,
+            uid TEXT NOT NULL,
+            message_id TEXT,
+            size INTEGER,
+            body_hash TEXT,
+            PRIMARY KEY (mailbox, uid))''')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS message_key ON message (message_id, size)')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS message_body ON message (body_hash)')
+        self.__db.commit()
+
+    def add(self, mailbox, uid, message_id, size, body_hash=None):
+        '''
+            add or replace email in index
+            existing body_hash is kept if body_hash not set
+        '''
+
+        with self.__lock:
+            self.__db.execute('''INSERT INTO message (mailbox, uid, message_id, size, body_hash) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (mailbox, uid) DO UPDATE SET message_id = excluded.message_id, size = excluded.size,
+                body_hash = COALESCE(excluded.body_hash, message.body_hash)''',
+                (mailbox, str(uid), message_id, size, body_hash))
+            self.__db.commit()
+
+    def add_many(self, mailbox, messages):
+        '''
+            add many email of mailbox in one transaction
+            messages = [(uid, message_id, size)]
+        '''
+
+        with self.__lock:
+            self.__db.executemany('''INSERT INTO message (mailbox, uid, message_id, size) VALUES (?, ?, ?, ?)
+                ON CONFLICT (mailbox, uid) DO UPDATE SET message_id = excluded.message_id, size = excluded.size''',
+                [(mailbox, str(uid), message_id, size) for uid, message_id, size in messages])
+            self.__db.commit()
+
+    def get(self, mailbox, uid):
+        '''
+            get indexed email as dictionary
+            return None if not exist
+        '''
+
+        with self.__lock:
+            row = self.__db.execute('SELECT * FROM message WHERE mailbox = ? AND uid = ?', (mailbox, str(uid))).fetchone()
+
+        return dict(row) if row else None
+
+    def set_body_hash(self, mailbox, uid, body_hash):
+        '''
+            set hash of cached body
+        '''
+
+        with self.__lock:
+            self.__db.execute('UPDATE message SET body_hash = ? WHERE mailbox = ? AND uid = ?', (body_hash, mailbox, str(uid)))
+            self.__db.commit()
+
+    def find(self, message_id, size, mailbox=None, uid=None):
+        '''
+            find other email with same Message-ID and size which body already cached
+            mailbox and uid = email to exclude from result, usually the email being looked up
+            return dictionary of email or None
+        '''
+
+        if not message_id or size is None:
+            return None
+
+        with self.__lock:
+            rows = self.__db.execute('''SELECT * FROM message WHERE message_id = ? AND size = ? AND body_hash IS NOT NULL''',
+                (message_id, size)).fetchall()
+
+        for row in rows:
+            if (row['mailbox'], row['uid']) != (mailbox, str(uid)):
+                return dict(row)
+
+        return None
+
+    def copy(self, mailbox, uid, dest_mailbox, dest_uid):
+        '''
+            copy index of email to other mailbox, ex: after COPY or MOVE command
+        '''
+
+        source = self.get(mailbox, uid)
+        if source:
+            self.add(dest_mailbox, dest_uid, source.get('message_id'), source.get('size'), source.get('body_hash'))
+
+    def remove(self, mailbox, uids=None):
+        '''
+            remove email from index
+            if uids not set will remove all email in mailbox
+        '''
+
+        with self.__lock:
+            if uids is None:
+                self.__db.execute('DELETE FROM message WHERE mailbox = ?', (mailbox,))
+            else:
+                self.__db.executemany('DELETE FROM message WHERE mailbox = ? AND uid = ?', [(mailbox, str(uid)) for uid in uids])
+
+            self.__db.commit()
+
+    def get_count(self, body_hash=None):
+        '''
+            count indexed email
+            body_hash = count email sharing the same cached body
+        '''
+
+        with self.__lock:
+            if body_hash:
+                return self.__db.execute('SELECT COUNT(*) FROM message WHERE body_hash = ?', (body_hash,)).fetchone()[0]
+
+            return self.__db.execute('SELECT COUNT(*) FROM message').fetchone()[0]
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+class AddressIndex(object):
+    '''
+        normalized email address index of one imap user
+        map each address and domain in From, To, CC, BCC and Delivered-To header into email uid per mailbox
+        contact table aggregate number of email for each address, used for top correspondent and autocomplete
+    '''
+
+    FIELDS = ('from', 'to', 'cc', 'bcc', 'delivered_to')
+
+    def __init__(self, filename):
+        '''
+            filename = sqlite database file, created if not exist
+        '''
+
+        dir_path = os.path.dirname(filename)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+        self.__lock = threading.RLock()
+        self.__db = sqlite3.connect(filename, check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS address (
+            mailbox TEXT NOT NULL,
+            uid TEXT NOT NULL,
+            field TEXT NOT NULL,
+            address TEXT NOT NULL,
+            domain TEXT NOT NULL,
+            date REAL,
+            PRIMARY KEY (mailbox, uid, field, address))''')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS address_address ON address (address, mailbox)')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS address_domain ON address (domain, mailbox)')
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS contact (
+            address TEXT PRIMARY KEY,
+            name TEXT,
+            name_key TEXT,
+            domain TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            last_date REAL)''')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS contact_name ON contact (name_key)')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS contact_count ON contact (count)')
+        self.__db.commit()
+
+    def add_many(self, mailbox, messages):
+        '''
+            add email header into index in one transaction
+            messages = [(uid, {'from':'Jhon <jhon@mail.com>', 'to':'...', 'cc':None}, timestamp)]
+            existing address of uid is replaced
+        '''
+
+        with self.__lock:
+            self.__remove(mailbox, [uid for uid, headers, date in messages])
+
+            rows = {}
+            contacts = {}
+            for uid, headers, date in messages:
+                for field in self.FIELDS:
+                    for name, address in _parse_addresses(headers.get(field)):
+                        domain = address.rpartition('@')[2]
+                        contact = contacts.setdefault(address, {'name':'', 'domain':domain, 'count':0, 'date':None})
+                        contact['name'] = name or contact.get('name')
+
+                        # count is number of address row, same address repeated in one field is one row
+                        key = (str(uid), field, address)
+                        if key not in rows:
+                            contact['count'] += 1
+                        rows[key] = (mailbox, str(uid), field, address, domain, date)
+
+                        if date and (contact.get('date') is None or date > contact.get('date')):
+                            contact['date'] = date
+
+            self.__db.executemany('INSERT OR REPLACE INTO address VALUES (?, ?, ?, ?, ?, ?)', list(rows.values()))
+            self.__db.executemany('''INSERT INTO contact (address, name, name_key, domain, count, last_date) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (address) DO UPDATE SET count = contact.count + excluded.count,
+                name = CASE WHEN excluded.name != '' THEN excluded.name ELSE contact.name END,
+                name_key = CASE WHEN excluded.name != '' THEN excluded.name_key ELSE contact.name_key END,
+                last_date = MAX(COALESCE(contact.last_date, 0), COALESCE(excluded.last_date, 0))''',
+                [(address, contact.get('name'), contact.get('name').lower(), contact.get('domain'), contact.get('count'),
+                    contact.get('date')) for address, contact in contacts.items()])
+            self.__db.commit()
+
+    def add(self, mailbox, uid, headers, date=None):
+        '''
+            add one email header into index, see add_many
+        '''
+
+        self.add_many(mailbox, [(uid, headers, date)])
+
+    def __remove(self, mailbox, uids=None):
+        '''
+            remove address of email and update contact count
+            caller hold the lock and commit
+        '''
+
+        if uids is None:
+            counts = self.__db.execute('SELECT address, COUNT(*) FROM address WHERE mailbox = ? GROUP BY address',
+                (mailbox,)).fetchall()
+            self.__db.execute('DELETE FROM address WHERE mailbox = ?', (mailbox,))
+        else:
+            counts = {}
+            for uid in uids:
+                for row in self.__db.execute('SELECT address FROM address WHERE mailbox = ? AND uid = ?', (mailbox, str(uid))):
+                    counts[row[0]] = counts.get(row[0], 0) + 1
+
+            counts = list(counts.items())
+            self.__db.executemany('DELETE FROM address WHERE mailbox = ? AND uid = ?', [(mailbox, str(uid)) for uid in uids])
+
+        self.__db.executemany('UPDATE contact SET count = count - ? WHERE address = ?', [(count, address) for address, count in counts])
+        self.__db.execute('DELETE FROM contact WHERE count <= 0')
+
+    def remove(self, mailbox, uids=None):
+        '''
+            remove email from index
+            if uids not set will remove all email in mailbox
+        '''
+
+        with self.__lock:
+            self.__remove(mailbox, uids)
+            self.__db.commit()
+
+    def copy(self, mailbox, uid, dest_mailbox, dest_uid):
+        '''
+            copy address of email to other mailbox, ex: after COPY or MOVE command
+        '''
+
+        with self.__lock:
+            rows = self.__db.execute('SELECT field, address, domain, date FROM address WHERE mailbox = ? AND uid = ?',
+                (mailbox, str(uid))).fetchall()
+
+            # address already indexed for destination is replaced, not counted twice
+            self.__remove(dest_mailbox, [dest_uid])
+            self.__db.executemany('INSERT OR REPLACE INTO address VALUES (?, ?, ?, ?, ?, ?)',
+                [(dest_mailbox, str(dest_uid), row['field'], row['address'], row['domain'], row['date']) for row in rows])
+            self.__db.executemany('UPDATE contact SET count = count + 1 WHERE address = ?', [(row['address'],) for row in rows])
+            self.__db.commit()
+
+    def search(self, address=None, domain=None, mailbox=None, fields=None):
+        '''
+            search email by address or domain
+            address = 'jhon@mail.com', domain = 'mail.com'
+            mailbox = only search in mailbox, default all mailbox
+            fields = ['from'] only search in header field, default all field
+            return {'INBOX':['30411', '30415']}
+        '''
+
+        query = 'SELECT DISTINCT mailbox, uid FROM address WHERE '
+        if address:
+            query += 'address = ?'
+            params = [address.strip().lower()]
+        else:
+            query += 'domain = ?'
+            params = [(domain or '').strip().lower().lstrip('@')]
+
+        if mailbox:
+            query += ' AND mailbox = ?'
+            params.append(mailbox)
+
+        if fields:
+            query += ' AND field IN (' + ', '.join('?' for field in fields) + ')'
+            params.extend(fields)
+
+        result = {}
+        with self.__lock:
+            for row in self.__db.execute(query, params):
+                result.setdefault(row['mailbox'], []).append(row['uid'])
+
+        for uids in result.values():
+            uids.sort(key=int)
+
+        return result
+
+    def get_top(self, limit=10, fields=None, mailbox=None, domain=False):
+        '''
+            get top correspondent by number of email
+            fields = ['from'] only count header field, ex: top sender
+            domain = True will aggregate by domain
+            return [{'address':'jhon@mail.com', 'name':'Jhon', 'count':120, 'last_date':timestamp}]
+        '''
+
+        key = 'domain' if domain else 'address'
+        with self.__lock:
+            if not fields and not mailbox:
+                if domain:
+                    rows = self.__db.execute('''SELECT domain AS address, '' AS name, SUM(count) AS count, MAX(last_date) AS last_date
+                        FROM contact GROUP BY domain ORDER BY count DESC LIMIT ?''', (limit,)).fetchall()
+                else:
+                    rows = self.__db.execute('''SELECT address, name, count, last_date FROM contact
+                        ORDER BY count DESC LIMIT ?''', (limit,)).fetchall()
+
+                return [dict(row) for row in rows]
+
+            query = 'SELECT ' + key + ' AS address, COUNT(*) AS count, MAX(date) AS last_date FROM address WHERE 1'
+            params = []
+            if mailbox:
+                query += ' AND mailbox = ?'
+                params.append(mailbox)
+
+            if fields:
+                query += ' AND field IN (' + ', '.join('?' for field in fields) + ')'
+                params.extend(fields)
+
+            query += ' GROUP BY ' + key + ' ORDER BY count DESC LIMIT ?'
+            params.append(limit)
+
+            top = [dict(row) for row in self.__db.execute(query, params).fetchall()]
+            for contact in top:
+                row = None if domain else self.__db.execute('SELECT name FROM contact WHERE address = ?', (contact.get('address'),)).fetchone()
+                contact['name'] = row[0] if row else ''
+
+        return top
+
+    def autocomplete(self, prefix, limit=10):
+        '''
+            get contact which address or name start with prefix, most used first
+            return [{'address':'jhon@mail.com', 'name':'Jhon Doe', 'count':120}]
+        '''
+
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        # range query on index instead of LIKE
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self.__lock:
+            rows = self.__db.execute('''SELECT address, name, count FROM contact WHERE address >= ? AND address < ?
+                UNION SELECT address, name, count FROM contact WHERE name_key >= ? AND name_key < ?
+                ORDER BY count DESC LIMIT ?''', (prefix, end, prefix, end, limit)).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+def _parse_addresses(value):
+    '''
+        parse address header into list of (decoded name, normalized address)
+    '''
+
+    if not value:
+        return []
+
+    addresses = []
+    for name, address in email.utils.getaddresses([str(value)]):
+        address = address.strip().lower()
+        if '@' not in address:
+            continue
+
+        try:
+            name = str(email.header.make_header(email.header.decode_header(name)))
+        except Exception:
+            pass
+
+        addresses.append((name.strip(), address))
+
+    return addresses
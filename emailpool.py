@@ -0,0 +1,600 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import selectors
+import smtplib
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+
+from emailutil import refresh_capabilities
+
+def is_socket_open(sock):
+    '''
+        check without server round trip if connection is still open
+        closed by server is detected from readable socket without data
+    '''
+
+    if sock is None:
+        return False
+
+    try:
+        # selectors instead of select.select, which fail for file descriptor >= 1024
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ)
+            if not selector.select(0):
+                return True
+
+        # peek raw socket, also work for ssl socket
+        return len(socket.socket.recv(sock, 1, socket.MSG_PEEK)) > 0
+
+    except (OSError, ValueError):
+        return False
+
+class IMAPPool(object):
+    '''
+        pool of login imap connection for one imap user
+        - connection created on demand until max_size
+        - idle connection checked with NOOP before reused
+        - idle connection kept alive with NOOP, see keepalive
+        safe to use from many thread
+    '''
+
+    def __init__(self, imap_entity, host, username, max_size=4, check_interval=60):
+        '''
+            imap_entity = IMAPEntity object
+            host = 'imap.gmail.com'
+            username = 'jhondoe@mail.com'
+            max_size = maximum connection in pool
+            check_interval = connection idle more than check_interval seconds checked with NOOP before reused
+        '''
+
+        self.__imap_entity = imap_entity
+        self.__host = host
+        self.__username = username
+        self.__max_size = max_size
+        self.__check_interval = check_interval
+
+        self.__idle = []
+        self.__size = 0
+        # number of thread waiting for connection, see is_wanted
+        self.__waiting = 0
+        self.__condition = threading.Condition()
+
+    def get_max_size(self):
+        return self.__max_size
+
+    def set_max_size(self, max_size):
+        '''
+            change maximum connection in pool
+            existing connection above max_size closed on release
+        '''
+
+        with self.__condition:
+            self.__max_size = max_size
+            self.__condition.notify_all()
+
+    def __create(self):
+        '''
+            create and login new imap object
+        '''
+
+        imap = self.__imap_entity.create_imap(self.__host, self.__username)
+        imap.login(self.__username, self.__imap_entity.get(self.__host, self.__username).get('password'))
+        refresh_capabilities(imap)
+        return imap
+
+    def __close(self, imap):
+        try:
+            imap.logout()
+        except Exception:
+            try:
+                imap.shutdown()
+            except Exception:
+                pass
+
+    def __unselect(self, imap):
+        '''
+            leave selected mailbox before connection returned to pool
+            UNSELECT if supported, else CLOSE same as imap_logout
+            return False if connection can't be reused
+        '''
+
+        if imap.state != 'SELECTED':
+            return True
+
+        try:
+            if 'UNSELECT' in imap.capabilities:
+                return imap.unselect()[0] == 'OK'
+
+            return imap.close()[0] == 'OK'
+
+        except Exception:
+            return False
+
+    def __is_alive(self, connection, check_interval):
+        '''
+            check idle connection with NOOP
+            recently used connection only checked without round trip
+        '''
+
+        if not is_socket_open(connection.get('imap').sock):
+            return False
+
+        if time.time() - connection.get('last_used') < check_interval:
+            return True
+
+        try:
+            return connection.get('imap').noop()[0] == 'OK'
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None):
+        '''
+            get login imap object from pool
+            wait until other thread release connection if pool is full
+            dead connection replaced with new login connection
+            return None if timeout
+        '''
+
+        with self.__condition:
+            self.__waiting += 1
+            try:
+                while not self.__idle and self.__size >= self.__max_size:
+                    if not self.__condition.wait(timeout):
+                        return None
+            finally:
+                self.__waiting -= 1
+
+            connection = None
+            if self.__idle:
+                connection = self.__idle.pop()
+            else:
+                self.__size += 1
+
+        if connection:
+            if self.__is_alive(connection, self.__check_interval):
+                return connection.get('imap')
+
+            self.__close(connection.get('imap'))
+
+        try:
+            return self.__create()
+        except Exception:
+            with self.__condition:
+                self.__size -= 1
+                self.__condition.notify()
+            raise
+
+    def release(self, imap, discard=False):
+        '''
+            return imap object to pool
+            discard = True will logout the imap object, ex: after connection error
+        '''
+
+        # selected mailbox of previous user must not leak to next user of the connection
+        if not discard and not self.__unselect(imap):
+            discard = True
+
+        with self.__condition:
+            if not discard and self.__size <= self.__max_size:
+                self.__idle.append({'imap':imap, 'last_used':time.time()})
+                self.__condition.notify()
+                return
+
+            self.__size -= 1
+            self.__condition.notify()
+
+        self.__close(imap)
+
+    def is_wanted(self):
+        '''
+            check if other thread is waiting for connection
+            low priority user (ex: prefetch) should release connection
+        '''
+
+        with self.__condition:
+            return self.__waiting > 0 and not self.__idle and self.__size >= self.__max_size
+
+    def keepalive(self, idle_time=300):
+        '''
+            send NOOP to idle connection unused for more than idle_time seconds
+            so server and network don't drop it, dead connection is closed
+            return {'checked':1, 'closed':0}
+        '''
+
+        with self.__condition:
+            now = time.time()
+            stale = [connection for connection in self.__idle if now - connection.get('last_used') >= idle_time]
+            self.__idle = [connection for connection in self.__idle if connection not in stale]
+
+        closed = 0
+        for connection in stale:
+            if self.__is_alive(connection, 0):
+                connection['last_used'] = time.time()
+                with self.__condition:
+                    self.__idle.append(connection)
+                    self.__condition.notify()
+            else:
+                self.__close(connection.get('imap'))
+                closed += 1
+                with self.__condition:
+                    self.__size -= 1
+                    self.__condition.notify()
+
+        return {'checked':len(stale), 'closed':closed}
+
+    def get_state(self):
+        '''
+            get liveness state of pool without server round trip
+            {'size':3, 'idle':2, 'in_use':1, 'open':2, 'idle_time':[12.3, 60.1]}
+            open is number of idle connection which socket still open
+        '''
+
+        with self.__condition:
+            now = time.time()
+            idle = list(self.__idle)
+            size = self.__size
+
+        return {'size':size, 'idle':len(idle), 'in_use':size - len(idle),
+            'open':sum(1 for connection in idle if is_socket_open(connection.get('imap').sock)),
+            'idle_time':[now - connection.get('last_used') for connection in idle]}
+
+    @contextmanager
+    def connection(self, timeout=None):
+        '''
+            use imap object from pool with with statement
+            connection discarded if exception raised
+
+            with pool.connection() as imap:
+                imap.select('INBOX')
+        '''
+
+        imap = self.acquire(timeout)
+        if imap is None:
+            raise TimeoutError('no imap connection available in pool')
+
+        try:
+            yield imap
+        except Exception:
+            self.release(imap, discard=True)
+            raise
+        else:
+            self.release(imap)
+
+    def close(self):
+        '''
+            logout all idle connection in pool
+        '''
+
+        with self.__condition:
+            idle = self.__idle
+            self.__idle = []
+            self.__size -= len(idle)
+
+        for connection in idle:
+            self.__close(connection.get('imap'))
+
+
+class SMTPPool(object):
+    '''
+        pool of login smtp connection for one smtp user
+        - connection created on demand until max_size
+        - idle connection checked with NOOP before reused
+        - connection recycled after max_age seconds or max_messages message
+        - new connection login automatically
+        - idle connection kept alive with NOOP, see keepalive
+        safe to use from many thread
+    '''
+
+    def __init__(self, smtp_entity, host, username, max_size=4, max_age=300, max_messages=100, check_interval=30):
+        '''
+            smtp_entity = SMTPEntity object
+            host = 'smtp.gmail.com'
+            username = 'jhondoe@mail.com'
+            max_size = maximum connection in pool
+            max_age = connection older than max_age seconds is closed and replaced
+            max_messages = connection used more than max_messages is closed and replaced
+            check_interval = connection idle more than check_interval seconds checked with NOOP before reused
+        '''
+
+        self.__smtp_entity = smtp_entity
+        self.__host = host
+        self.__username = username
+        self.__max_size = max_size
+        self.__max_age = max_age
+        self.__max_messages = max_messages
+        self.__check_interval = check_interval
+
+        self.__idle = []
+        self.__in_use = {}
+        self.__size = 0
+        self.__condition = threading.Condition()
+
+    def get_max_size(self):
+        return self.__max_size
+
+    def set_max_size(self, max_size):
+        '''
+            change maximum connection in pool
+            existing connection above max_size closed on release
+        '''
+
+        with self.__condition:
+            self.__max_size = max_size
+            self.__condition.notify_all()
+
+    def __create(self):
+        '''
+            create and login new smtp object
+        '''
+
+        smtp = self.__smtp_entity.create_smtp(self.__host, self.__username)
+
+        password = self.__smtp_entity.get(self.__host, self.__username).get('password')
+        if password:
+            smtp.login(self.__username, password)
+
+        now = time.time()
+        return {'smtp':smtp, 'created':now, 'last_used':now, 'messages':0}
+
+    def __close(self, connection):
+        try:
+            connection.get('smtp').quit()
+        except Exception:
+            try:
+                connection.get('smtp').close()
+            except Exception:
+                pass
+
+    def __is_expired(self, connection):
+        '''
+            check if connection should be recycled by age or message count
+        '''
+
+        return (time.time() - connection.get('created') > self.__max_age or
+            connection.get('messages') >= self.__max_messages)
+
+    def __is_alive(self, connection, check_interval=None):
+        '''
+            check idle connection with NOOP
+            recently used connection only checked without round trip
+        '''
+
+        if not is_socket_open(connection.get('smtp').sock):
+            return False
+
+        if check_interval is None:
+            check_interval = self.__check_interval
+
+        if time.time() - connection.get('last_used') < check_interval:
+            return True
+
+        try:
+            return connection.get('smtp').noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None):
+        '''
+            get login smtp object from pool
+            wait until other thread release connection if pool is full
+            expired or dead connection replaced with new login connection
+            return None if timeout
+        '''
+
+        with self.__condition:
+            while not self.__idle and self.__size >= self.__max_size:
+                if not self.__condition.wait(timeout):
+                    return None
+
+            connection = None
+            if self.__idle:
+                connection = self.__idle.pop()
+            else:
+                self.__size += 1
+
+        if connection and (self.__is_expired(connection) or not self.__is_alive(connection)):
+            self.__close(connection)
+            connection = None
+
+        if not connection:
+            try:
+                connection = self.__create()
+            except Exception:
+                with self.__condition:
+                    self.__size -= 1
+                    self.__condition.notify()
+                raise
+
+        with self.__condition:
+            self.__in_use[id(connection.get('smtp'))] = connection
+
+        return connection.get('smtp')
+
+    def release(self, smtp, discard=False, messages=1):
+        '''
+            return smtp object to pool
+            discard = True will close the smtp object, ex: after connection error
+            messages = number of message sent using the smtp object
+        '''
+
+        with self.__condition:
+            connection = self.__in_use.pop(id(smtp), None)
+            if connection is None:
+                # not acquired from this pool or already released
+                return
+
+            connection['last_used'] = time.time()
+            connection['messages'] += messages
+
+            if not discard and self.__size <= self.__max_size and not self.__is_expired(connection):
+                self.__idle.append(connection)
+                self.__condition.notify()
+                return
+
+            self.__size -= 1
+            self.__condition.notify()
+
+        self.__close(connection)
+
+    def keepalive(self, idle_time=60):
+        '''
+            send NOOP to idle connection unused for more than idle_time seconds
+            expired or dead connection is closed
+            return {'checked':1, 'closed':0}
+        '''
+
+        with self.__condition:
+            now = time.time()
+            stale = [connection for connection in self.__idle
+                if now - connection.get('last_used') >= idle_time or self.__is_expired(connection)]
+            self.__idle = [connection for connection in self.__idle if connection not in stale]
+
+        closed = 0
+        for connection in stale:
+            if not self.__is_expired(connection) and self.__is_alive(connection, 0):
+                connection['last_used'] = time.time()
+                with self.__condition:
+                    self.__idle.append(connection)
+                    self.__condition.notify()
+            else:
+                self.__close(connection)
+                closed += 1
+                with self.__condition:
+                    self.__size -= 1
+                    self.__condition.notify()
+
+        return {'checked':len(stale), 'closed':closed}
+
+    def get_state(self):
+        '''
+            get liveness state of pool without server round trip
+            {'size':3, 'idle':2, 'in_use':1, 'open':2, 'idle_time':[12.3, 60.1]}
+            open is number of idle connection which socket still open
+        '''
+
+        with self.__condition:
+            now = time.time()
+            idle = list(self.__idle)
+            size = self.__size
+
+        return {'size':size, 'idle':len(idle), 'in_use':size - len(idle),
+            'open':sum(1 for connection in idle if is_socket_open(connection.get('smtp').sock)),
+            'idle_time':[now - connection.get('last_used') for connection in idle]}
+
+    @contextmanager
+    def connection(self, timeout=None):
+        '''
+            use smtp object from pool with with statement
+            connection discarded on error, transaction may be left half done
+            except server reply error (ex: 550 on MAIL FROM) when RSET succeed
+
+            with pool.connection() as smtp:
+                smtp.send_message(message)
+        '''
+
+        smtp = self.acquire(timeout)
+        if smtp is None:
+            raise TimeoutError('no smtp connection available in pool')
+
+        try:
+            yield smtp
+        except smtplib.SMTPResponseException:
+            self.release(smtp, discard=not self.__reset(smtp))
+            raise
+        except BaseException:
+            self.release(smtp, discard=True)
+            raise
+        else:
+            self.release(smtp)
+
+    def __reset(self, smtp):
+        '''
+            abort current transaction with RSET
+            return True if connection can be used again
+        '''
+
+        try:
+            return smtp.rset()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        '''
+            close all idle connection in pool
+        '''
+
+        with self.__condition:
+            idle = self.__idle
+            self.__idle = []
+            self.__size -= len(idle)
+
+        for connection in idle:
+            self.__close(connection)
+
+
+class KeepAlive(object):
+    '''
+        background keepalive of connection pool
+        every interval seconds, keepalive of each pool returned by get_pools is called
+        get_pools = function returning list of (pool, idle_time)
+    '''
+
+    def __init__(self, get_pools, interval=30):
+        self.__get_pools = get_pools
+        self.__interval = interval
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    def run_pending(self):
+        '''
+            keepalive all pool once
+            return total {'checked':3, 'closed':1}
+        '''
+
+        result = {'checked':0, 'closed':0}
+        for pool, idle_time in self.__get_pools():
+            try:
+                checked = pool.keepalive(idle_time)
+                result['checked'] += checked.get('checked')
+                result['closed'] += checked.get('closed')
+            except Exception as e:
+                print(e)
+
+        return result
+
+    def __work(self):
+        while not self.__stop_event.wait(self.__interval):
+            self.run_pending()
+
+    def start(self):
+        '''
+            start keepalive thread
+        '''
+
+        if self.is_running():
+            return
+
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__work, daemon=True)
+        self.__thread.start()
+
+    def stop(self, wait=True):
+        '''
+            stop keepalive thread
+        '''
+
+        self.__stop_event.set()
+        if wait and self.__thread:
+            self.__thread.join()
+
+        self.__thread = None
+
+    def is_running(self):
+        return self.__thread is not None and self.__thread.is_alive()
@@ -0,0 +1,281 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import email.header
+import struct
+import sys
+
+# header field of message record, interned so every record share the same key
+FIELD_NAMES = tuple(sys.intern(name) for name in
+    ('From', 'To', 'CC', 'BCC', 'Subject', 'Date', 'MessageID', 'InReplyTo', 'References'))
+FIELD_INDEX = dict((name, index) for index, name in enumerate(FIELD_NAMES))
+
+# header name to field index
+HEADER_INDEX = {b'from':0, b'to':1, b'cc':2, b'bcc':3, b'subject':4, b'date':5,
+    b'message-id':6, b'in-reply-to':7, b'references':8}
+
+# fetch item to get only header field of message record
+FETCH_FIELDS = '(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER.FIELDS (FROM TO CC BCC SUBJECT DATE MESSAGE-ID IN-REPLY-TO REFERENCES)])'
+
+# system flag stored as bit in serialized record
+SYSTEM_FLAGS = tuple(sys.intern(flag) for flag in ('\\Seen', '\\Answered', '\\Flagged', '\\Deleted', '\\Draft', '\\Recent'))
+
+# uid, size, system flag bit
+RECORD_HEAD = struct.Struct('<IIB')
+NO_SIZE = 0xFFFFFFFF
+
+# decoded value of field not accessed yet, None is valid decoded value of missing header
+NOT_DECODED = object()
+
+def parse_header_fields(header):
+    '''
+        get raw value of message record field from header bytes
+        folded line is unfolded, only first header with the same name is used
+        return tuple of bytes or None aligned with FIELD_NAMES
+    '''
+
+    values = [None] * len(FIELD_NAMES)
+    index = None
+    for line in bytes(header).split(b'\n'):
+        line = line.rstrip(b'\r')
+        if line[:1] in (b' ', b'\t'):
+            if index is not None:
+                values[index] += b' ' + line.strip()
+            continue
+
+        name, separator, value = line.partition(b':')
+        index = HEADER_INDEX.get(name.strip().lower()) if separator else None
+        if index is not None:
+            if values[index] is None:
+                values[index] = value.strip()
+            else:
+                index = None
+
+    return tuple(values)
+
+def decode_header_value(value):
+    '''
+        decode raw header bytes into str, including RFC 2047 encoded word
+    '''
+
+    if value is None:
+        return None
+
+    text = value.decode('UTF-8', 'replace')
+    if '=?' not in text:
+        return text
+
+    try:
+        return str(email.header.make_header(email.header.decode_header(text)))
+    except Exception:
+        return text
+
+class MessageRecord(object):
+    '''
+        compact message listing record
+        header value kept as raw bytes, each field decoded on its first access
+        support dictionary style get with the same key as cached email dictionary
+        record.get('Subject'), record['ID'], record.get('Flags')
+    '''
+
+    __slots__ = ('uid', 'size', 'flags', '_raw', '_decoded')
+
+    def __init__(self, uid, raw, size=None, flags=()):
+        '''
+            uid = email_id
+            raw = tuple of raw header bytes aligned with FIELD_NAMES, see parse_header_fields
+            size = RFC822.SIZE
+            flags = ['\\Seen']
+        '''
+
+        self.uid = int(uid)
+        self.size = int(size) if size is not None else None
+        self.flags = tuple(sys.intern(flag) for flag in flags)
+        self._raw = raw
+        self._decoded = None
+
+    @classmethod
+    def from_header(cls, uid, header, size=None, flags=()):
+        '''
+            create record from header bytes or memoryview
+        '''
+
+        return cls(uid, parse_header_fields(header), size, flags)
+
+    @classmethod
+    def from_fetch(cls, fetch_item):
+        '''
+            create record from parsed fetch item, see FETCH_FIELDS
+            return None if fetch item has no UID
+        '''
+
+        if not fetch_item.get('UID'):
+            return None
+
+        header = b''
+        for key, value in fetch_item.items():
+            if key.startswith('BODY[') and value is not None:
+                header = value
+                break
+
+        return cls.from_header(fetch_item.get('UID'), header, fetch_item.get('RFC822.SIZE'), fetch_item.get('FLAGS') or ())
+
+    def get_raw(self, name):
+        '''
+            get raw header bytes of field name
+        '''
+
+        return self._raw[FIELD_INDEX[name]]
+
+    def get(self, key, default=None):
+        if key == 'ID':
+            return str(self.uid)
+
+        if key == 'Size':
+            return self.size
+
+        if key == 'Flags':
+            return list(self.flags)
+
+        index = FIELD_INDEX.get(key)
+        if index is None:
+            return default
+
+        # listing usually read only few field, ex: From, Subject and Date
+        if self._decoded is None:
+            self._decoded = [NOT_DECODED] * len(FIELD_NAMES)
+
+        value = self._decoded[index]
+        if value is NOT_DECODED:
+            value = decode_header_value(self._raw[index])
+            self._decoded[index] = value
+
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        if key not in FIELD_INDEX and key not in ('ID', 'Size', 'Flags'):
+            raise KeyError(key)
+
+        return self.get(key)
+
+    def keys(self):
+        return ('ID', 'Size', 'Flags') + FIELD_NAMES
+
+    def to_dict(self):
+        '''
+            convert into cached email dictionary
+        '''
+
+        return dict((key, self.get(key)) for key in self.keys())
+
+    def to_bytes(self):
+        '''
+            serialize record into compact binary
+            uid, size, system flag bit, other flag and length prefixed raw header value
+        '''
+
+        flag_bits = 0
+        other_flags = []
+        for flag in self.flags:
+            if flag in SYSTEM_FLAGS:
+                flag_bits |= 1 << SYSTEM_FLAGS.index(flag)
+            else:
+                other_flags.append(flag.encode('UTF-8'))
+
+        data = bytearray(RECORD_HEAD.pack(self.uid, NO_SIZE if self.size is None else self.size, flag_bits))
+        _write_varint(data, len(other_flags))
+        for flag in other_flags:
+            _write_varint(data, len(flag))
+            data += flag
+
+        # length + 1, so 0 is None
+        for value in self._raw:
+            if value is None:
+                _write_varint(data, 0)
+            else:
+                _write_varint(data, len(value) + 1)
+                data += value
+
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        '''
+            unserialize record from compact binary
+            return (record, next offset)
+        '''
+
+        uid, size, flag_bits = RECORD_HEAD.unpack_from(data, offset)
+        offset += RECORD_HEAD.size
+
+        flags = [flag for i, flag in enumerate(SYSTEM_FLAGS) if flag_bits & (1 << i)]
+        count, offset = _read_varint(data, offset)
+        for i in range(count):
+            length, offset = _read_varint(data, offset)
+            flags.append(bytes(data[offset:offset + length]).decode('UTF-8'))
+            offset += length
+
+        raw = []
+        for i in range(len(FIELD_NAMES)):
+            length, offset = _read_varint(data, offset)
+            if length:
+                raw.append(bytes(data[offset:offset + length - 1]))
+                offset += length - 1
+            else:
+                raw.append(None)
+
+        return cls(uid, tuple(raw), None if size == NO_SIZE else size, flags), offset
+
+    def __repr__(self):
+        return 'MessageRecord(%d, %r)' % (self.uid, self.get('Subject'))
+
+def write_records(records, fp):
+    '''
+        write records into binary file object
+        each record prefixed by its length
+    '''
+
+    for record in records:
+        data = record.to_bytes()
+        prefix = bytearray()
+        _write_varint(prefix, len(data))
+        fp.write(prefix)
+        fp.write(data)
+
+def read_records(fp):
+    '''
+        read records written by write_records from binary file object
+        return list of MessageRecord
+    '''
+
+    data = fp.read()
+    records = []
+    offset = 0
+    while offset < len(data):
+        length, offset = _read_varint(data, offset)
+        records.append(MessageRecord.from_bytes(data, offset)[0])
+        offset += length
+
+    return records
+
+def _write_varint(data, number):
+    while number >= 0x80:
+        data.append((number & 0x7F) | 0x80)
+        number >>= 7
+
+    data.append(number)
+
+def _read_varint(data, offset):
+    number = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, offset
+
+        shift += 7
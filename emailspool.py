@@ -0,0 +1,395 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import json
+import os
+import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+
+from emailthrottle import Backoff
+
+class SpoolFlag(object):
+    '''
+        status of spooled message
+    '''
+    PREPARING = 'preparing'
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+class EmailSpool(object):
+    '''
+        persistent outbound message queue
+        message saved to spool directory and indexed in sqlite database
+        background worker send due message with per host rate limit
+        temporary failure (4xx, disconnected) retried with exponential backoff
+        queue survive process restart
+    '''
+
+    def __init__(self, directory, send, rate=1.0, max_attempts=8, base_delay=60, max_delay=3600, workers=2):
+        '''
+            directory = spool directory, contain spool.db and message file
+            send = function(entry, message_file) send message and return refused recipient like smtplib sendmail
+            rate = maximum message per second for each smtp host
+            max_attempts = message failed permanently after max_attempts temporary failure
+            base_delay = first retry delay in seconds, doubled for each attempt until max_delay
+            workers = number of background worker thread
+        '''
+
+        self.__directory = directory
+        self.__send = send
+        self.__rate = rate
+        self.__host_rate = {}
+        self.__max_attempts = max_attempts
+        # retry delay only, attempts of each message saved in spool database
+        self.__backoff = Backoff(base_delay, max_delay)
+        self.__workers = workers
+
+        # next time message can be sent to smtp host
+        self.__host_next = {}
+        # function writing message file of preparing message by spool id, see enqueue
+        self.__prepare = {}
+        self.__threads = []
+        self.__stop_event = threading.Event()
+        self.__condition = threading.Condition()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.__db = sqlite3.connect(directory + os.path.sep + 'spool.db', check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS spool (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            host TEXT NOT NULL,
+            username TEXT NOT NULL,
+            from_addr TEXT NOT NULL,
+            to_addrs TEXT NOT NULL,
+            mail_options TEXT,
+            rcpt_options TEXT,
+            message_file TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            last_error TEXT,
+            created REAL NOT NULL)''')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS spool_due ON spool (status, next_attempt)')
+
+        # message in sending state when process stopped is sent again
+        self.__db.execute('UPDATE spool SET status = ? WHERE status = ?', (SpoolFlag.QUEUED, SpoolFlag.SENDING))
+        # message file not completed when process stopped
+        rows = self.__db.execute('SELECT message_file FROM spool WHERE status = ?', (SpoolFlag.PREPARING,)).fetchall()
+        self.__db.execute('UPDATE spool SET status = ?, last_error = ? WHERE status = ?',
+            (SpoolFlag.FAILED, 'message file not prepared before stop', SpoolFlag.PREPARING))
+        self.__db.commit()
+
+        for row in rows:
+            self.__remove_file(row['message_file'])
+
+    def set_rate(self, host, rate):
+        '''
+            set maximum message per second for smtp host
+        '''
+
+        with self.__condition:
+            self.__host_rate[host] = rate
+            self.__condition.notify_all()
+
+    def get_directory(self):
+        return self.__directory
+
+    def create_message_file(self):
+        '''
+            create new message file path inside spool directory
+        '''
+
+        return self.__directory + os.path.sep + uuid.uuid4().hex + '.eml'
+
+    def enqueue(self, host, username, message_file, from_addr, to_addrs, mail_options=[], rcpt_options=[], prepare=None):
+        '''
+            add message to queue
+            message_file = path of message file inside spool directory, see create_message_file
+            prepare = function(message_file) writing the message file, run by spool worker
+                so caller doesn't wait for message generation, message is preparing until written
+                message failed if prepare raise exception or process stopped before it run
+            return id of spooled message
+        '''
+
+        status = SpoolFlag.PREPARING if prepare else SpoolFlag.QUEUED
+        with self.__condition:
+            cursor = self.__db.execute('''INSERT INTO spool (host, username, from_addr, to_addrs, mail_options,
+                rcpt_options, message_file, status, next_attempt, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (host, username, from_addr, json.dumps(list(to_addrs)), json.dumps(list(mail_options)),
+                json.dumps(list(rcpt_options)), message_file, status, time.time(), time.time()))
+            self.__db.commit()
+
+            if prepare:
+                self.__prepare[cursor.lastrowid] = prepare
+
+            self.__condition.notify()
+
+            return cursor.lastrowid
+
+    def get(self, spool_id):
+        '''
+            get spooled message entry
+            return None if not exist
+        '''
+
+        with self.__condition:
+            row = self.__db.execute('SELECT * FROM spool WHERE id = ?', (spool_id,)).fetchone()
+
+        return self.__to_entry(row) if row else None
+
+    def get_count(self, status=None):
+        '''
+            count spooled message
+            status = SpoolFlag.QUEUED|SpoolFlag.SENT|SpoolFlag.FAILED, default all
+        '''
+
+        with self.__condition:
+            if status:
+                return self.__db.execute('SELECT COUNT(*) FROM spool WHERE status = ?', (status,)).fetchone()[0]
+
+            return self.__db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+    def clean(self, status=SpoolFlag.SENT):
+        '''
+            remove spooled message entry with status
+        '''
+
+        with self.__condition:
+            rows = self.__db.execute('SELECT message_file FROM spool WHERE status = ?', (status,)).fetchall()
+            self.__db.execute('DELETE FROM spool WHERE status = ?', (status,))
+            self.__db.commit()
+
+        for row in rows:
+            self.__remove_file(row['message_file'])
+
+    def __to_entry(self, row):
+        entry = dict(row)
+        for key in ('to_addrs', 'mail_options', 'rcpt_options'):
+            entry[key] = json.loads(entry.get(key) or '[]')
+
+        return entry
+
+    def __remove_file(self, message_file):
+        try:
+            os.remove(message_file)
+        except OSError:
+            pass
+
+    def __claim_prepare(self):
+        '''
+            get oldest preparing message
+            return (spool id, message file, prepare function) or None
+        '''
+
+        with self.__condition:
+            if not self.__prepare:
+                return None
+
+            spool_id = next(iter(self.__prepare))
+            prepare = self.__prepare.pop(spool_id)
+            row = self.__db.execute('SELECT message_file FROM spool WHERE id = ?', (spool_id,)).fetchone()
+
+            return spool_id, row['message_file'], prepare
+
+    def __run_prepare(self, spool_id, message_file, prepare):
+        '''
+            write message file of preparing message, then queue it for sending
+        '''
+
+        try:
+            prepare(message_file)
+
+        except Exception as e:
+            with self.__condition:
+                self.__db.execute('UPDATE spool SET status = ?, last_error = ? WHERE id = ?', (SpoolFlag.FAILED, repr(e), spool_id))
+                self.__db.commit()
+
+            self.__remove_file(message_file)
+            return
+
+        with self.__condition:
+            self.__db.execute('UPDATE spool SET status = ?, next_attempt = ? WHERE id = ?', (SpoolFlag.QUEUED, time.time(), spool_id))
+            self.__db.commit()
+            self.__condition.notify()
+
+    def __claim(self):
+        '''
+            get due message which smtp host is not rate limited
+            mark it as sending
+            return (entry, wait seconds until next due message)
+        '''
+
+        now = time.time()
+        with self.__condition:
+            # rate limited host is filtered in query, so its message can't hide message of other host
+            limited = [host for host, next_time in self.__host_next.items() if next_time > now]
+            row = self.__db.execute('''SELECT * FROM spool WHERE status = ? AND next_attempt <= ?
+                AND host NOT IN (%s) ORDER BY next_attempt LIMIT 1''' % ', '.join('?' * len(limited)),
+                [SpoolFlag.QUEUED, now] + limited).fetchone()
+
+            if row:
+                rate = self.__host_rate.get(row['host'], self.__rate)
+                if rate:
+                    self.__host_next[row['host']] = now + 1.0 / rate
+
+                self.__db.execute('UPDATE spool SET status = ? WHERE id = ?', (SpoolFlag.SENDING, row['id']))
+                self.__db.commit()
+
+                return self.__to_entry(row), 0
+
+            # earliest due message of each host
+            wait = None
+            for host, next_attempt in self.__db.execute('''SELECT host, MIN(next_attempt) FROM spool
+                WHERE status = ? GROUP BY host''', (SpoolFlag.QUEUED,)):
+                due = max(next_attempt, self.__host_next.get(host, 0)) - now
+                wait = due if wait is None else min(wait, due)
+
+            return None, wait if wait is None else max(wait, 0)
+
+    def __is_temporary(self, error):
+        '''
+            4xx reply and connection problem is temporary failure
+        '''
+
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+
+        return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError))
+
+    def __retry(self, entry, to_addrs, error):
+        '''
+            schedule temporary failed message with exponential backoff
+            failed permanently after max_attempts
+        '''
+
+        attempts = entry.get('attempts') + 1
+        if attempts >= self.__max_attempts:
+            self.__finish(entry, SpoolFlag.FAILED, error)
+            return
+
+        delay = self.__backoff.get_delay(attempts)
+
+        with self.__condition:
+            self.__db.execute('''UPDATE spool SET status = ?, attempts = ?, next_attempt = ?, to_addrs = ?, last_error = ?
+                WHERE id = ?''', (SpoolFlag.QUEUED, attempts, time.time() + delay, json.dumps(to_addrs), error, entry.get('id')))
+            self.__db.commit()
+
+    def __finish(self, entry, status, error=None):
+        with self.__condition:
+            self.__db.execute('UPDATE spool SET status = ?, attempts = ?, last_error = ? WHERE id = ?',
+                (status, entry.get('attempts') + 1, error, entry.get('id')))
+            self.__db.commit()
+
+        self.__remove_file(entry.get('message_file'))
+
+    def process(self, entry):
+        '''
+            send one claimed message entry and update its status
+        '''
+
+        try:
+            with open(entry.get('message_file'), 'rb') as message_file:
+                refused = self.__send(entry, message_file) or {}
+
+        except smtplib.SMTPRecipientsRefused as e:
+            # nobody get the message, recipient refused with 4xx is still retried
+            refused = e.recipients
+            if not any(400 <= code < 500 for code, resp in refused.values()):
+                self.__finish(entry, SpoolFlag.FAILED, repr(e))
+                return
+
+        except Exception as e:
+            if self.__is_temporary(e):
+                self.__retry(entry, entry.get('to_addrs'), repr(e))
+            else:
+                self.__finish(entry, SpoolFlag.FAILED, repr(e))
+            return
+
+        # recipient refused with 4xx retried later, 5xx is permanent
+        temporary = [to_addr for to_addr, (code, resp) in refused.items() if 400 <= code < 500]
+        if temporary:
+            self.__retry(entry, temporary, repr(refused))
+        else:
+            self.__finish(entry, SpoolFlag.SENT, repr(refused) if refused else None)
+
+    def run_pending(self):
+        '''
+            send all due message in current thread
+            return number of processed message
+        '''
+
+        processed = 0
+        while True:
+            prepare = self.__claim_prepare()
+            if prepare:
+                self.__run_prepare(*prepare)
+                continue
+
+            entry, wait = self.__claim()
+            if not entry:
+                return processed
+
+            self.process(entry)
+            processed += 1
+
+    def __work(self):
+        while not self.__stop_event.is_set():
+            # claim and wait under same lock, so notify of enqueue between them is not lost
+            with self.__condition:
+                prepare = self.__claim_prepare()
+                entry, wait = self.__claim() if not prepare else (None, 0)
+                if not prepare and not entry:
+                    if not self.__stop_event.is_set():
+                        self.__condition.wait(min(wait, 5) if wait is not None else 5)
+
+                    continue
+
+            if prepare:
+                self.__run_prepare(*prepare)
+            else:
+                self.process(entry)
+
+    def start(self):
+        '''
+            start background worker
+        '''
+
+        self.__stop_event.clear()
+        for i in range(self.__workers - len(self.__threads)):
+            thread = threading.Thread(target=self.__work, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self, wait=True):
+        '''
+            stop background worker
+            message being sent is finished first if wait is True
+            preparing message is also written when wait is True, so it is sent after restart
+        '''
+
+        self.__stop_event.set()
+        with self.__condition:
+            self.__condition.notify_all()
+
+        if wait:
+            for thread in self.__threads:
+                thread.join()
+
+            while True:
+                prepare = self.__claim_prepare()
+                if not prepare:
+                    break
+
+                self.__run_prepare(*prepare)
+
+        self.__threads = []
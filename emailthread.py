@@ -0,0 +1,344 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import email.utils
+import json
+import os
+import re
+import threading
+
+from emailutil import _parse_fetch_tokens, _tokenize_fetch
+
+# reply and forward prefix of subject, ex: 'Re: Fwd: RE[2]: hello'
+SUBJECT_PREFIX = re.compile(r'^\s*(?:(?:re|fw|fwd|aw|sv)(?:\[\d+\])?\s*:\s*)+', re.I)
+
+# message id inside References and In-Reply-To header
+MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+
+def normalize_subject(subject):
+    '''
+        normalize subject for thread grouping
+        'Re: Fwd:  Hello  World' will return ('hello world', True)
+        return (normalized subject, is reply)
+    '''
+
+    subject = subject or ''
+    match = SUBJECT_PREFIX.match(subject)
+    if match:
+        subject = subject[match.end():]
+
+    return ' '.join(subject.split()).lower(), match is not None
+
+def parse_date(date):
+    '''
+        parse Date header into timestamp
+        return 0 if not valid
+    '''
+
+    try:
+        return email.utils.parsedate_to_datetime(date).timestamp()
+    except Exception:
+        return 0
+
+class ThreadIndex(object):
+    '''
+        incremental conversation thread index of one mailbox (JWZ threading algorithm)
+        thread built from Message-ID, In-Reply-To, References and normalized Subject
+        new email added in place without rebuilding the whole index
+        saved as json file
+    '''
+
+    def __init__(self, filename=None):
+        '''
+            filename = json file of index, loaded if exist
+        '''
+
+        self.__filename = filename
+        self.__lock = threading.RLock()
+
+        # message id to container {'uid', 'parent', 'children', 'subject', 'date'}
+        # container without uid is referenced email which is not in mailbox
+        self.__containers = {}
+
+        # normalized subject to root message id
+        self.__subjects = {}
+
+        # uid to message id
+        self.__uids = {}
+
+        if filename and os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                data = json.load(f)
+
+            self.__containers = data.get('containers', {})
+            self.__subjects = data.get('subjects', {})
+            self.__uids = dict((container.get('uid'), message_id)
+                for message_id, container in self.__containers.items() if container.get('uid'))
+
+    def clear(self):
+        '''
+            remove all email from index
+        '''
+
+        with self.__lock:
+            self.__containers = {}
+            self.__subjects = {}
+            self.__uids = {}
+
+    def save(self, filename=None):
+        '''
+            save index to json file
+            written to temporary file then replaced, so reader never get partial index
+        '''
+
+        filename = filename or self.__filename
+        temp_file = '%s.%d.tmp' % (filename, threading.get_ident())
+        with self.__lock:
+            with open(temp_file, 'w') as f:
+                json.dump({'containers':self.__containers, 'subjects':self.__subjects}, f)
+
+            os.replace(temp_file, filename)
+
+    def __get_container(self, message_id):
+        container = self.__containers.get(message_id)
+        if container is None:
+            container = {'uid':None, 'parent':None, 'children':[], 'subject':'', 'date':0}
+            self.__containers[message_id] = container
+
+        return container
+
+    def __is_ancestor(self, message_id, other_id):
+        '''
+            check if message_id is other_id or ancestor of other_id
+        '''
+
+        while other_id is not None:
+            if other_id == message_id:
+                return True
+
+            other_id = self.__containers.get(other_id, {}).get('parent')
+
+        return False
+
+    def __unlink(self, message_id):
+        container = self.__containers.get(message_id)
+        parent = self.__containers.get(container.get('parent'))
+        if parent and message_id in parent.get('children'):
+            parent.get('children').remove(message_id)
+
+        container['parent'] = None
+
+    def __link(self, parent_id, message_id):
+        '''
+            set parent of message_id, link that create loop is ignored
+        '''
+
+        if self.__is_ancestor(message_id, parent_id):
+            return False
+
+        self.__unlink(message_id)
+        self.__get_container(message_id)['parent'] = parent_id
+        self.__get_container(parent_id).get('children').append(message_id)
+
+        return True
+
+    def add(self, uid, message_id=None, in_reply_to=None, references=None, subject=None, date=None):
+        '''
+            add email to index
+            uid = email_id in mailbox
+            message_id, in_reply_to, references, subject, date = header value of email
+        '''
+
+        uid = str(uid)
+        with self.__lock:
+            if uid in self.__uids:
+                self.remove([uid])
+
+            ids = MESSAGE_ID.findall(message_id or '')
+            message_id = ids[0] if ids else '<' + uid + '@pxemail>'
+
+            # duplicate Message-ID got own container
+            if self.__containers.get(message_id, {}).get('uid'):
+                message_id = '<' + uid + '@pxemail>'
+
+            container = self.__get_container(message_id)
+            normalized, is_reply = normalize_subject(subject)
+            container['uid'] = uid
+            container['subject'] = normalized
+            container['date'] = parse_date(date) if date else 0
+            self.__uids[uid] = message_id
+
+            references = MESSAGE_ID.findall(references or '')
+            for reply_id in MESSAGE_ID.findall(in_reply_to or '')[:1]:
+                if not references or references[-1] != reply_id:
+                    references.append(reply_id)
+
+            references = [reference for reference in references if reference != message_id]
+
+            # link reference chain, existing parent is kept
+            for parent_id, child_id in zip(references, references[1:]):
+                if self.__get_container(child_id).get('parent') is None:
+                    self.__link(parent_id, child_id)
+
+            # own references always win
+            if references:
+                self.__link(references[-1], message_id)
+
+            # reply without references grouped by subject
+            elif is_reply and normalized:
+                root_id = self.__subjects.get(normalized)
+                if root_id and root_id in self.__containers:
+                    self.__link(root_id, message_id)
+
+            if normalized and container.get('parent') is None and not is_reply:
+                root_id = self.__subjects.get(normalized)
+                if not root_id or root_id not in self.__containers or self.__containers.get(root_id).get('parent'):
+                    self.__subjects[normalized] = message_id
+
+    def remove(self, uids):
+        '''
+            remove email from index
+            container still kept while referenced by other email
+        '''
+
+        with self.__lock:
+            for uid in uids:
+                message_id = self.__uids.pop(str(uid), None)
+                container = self.__containers.get(message_id)
+                if not container:
+                    continue
+
+                container['uid'] = None
+                self.__prune(message_id)
+
+    def __prune(self, message_id):
+        '''
+            remove empty container without children
+        '''
+
+        while message_id is not None:
+            container = self.__containers.get(message_id)
+            if not container or container.get('uid') or container.get('children'):
+                return
+
+            parent_id = container.get('parent')
+            self.__unlink(message_id)
+            del self.__containers[message_id]
+
+            if self.__subjects.get(container.get('subject')) == message_id:
+                del self.__subjects[container.get('subject')]
+
+            message_id = parent_id
+
+    def get_thread_id(self, uid):
+        '''
+            get message id of thread root of email
+        '''
+
+        with self.__lock:
+            message_id = self.__uids.get(str(uid))
+            while message_id and self.__containers.get(message_id, {}).get('parent'):
+                message_id = self.__containers.get(message_id).get('parent')
+
+            return message_id
+
+    def get_sorted(self, reverse=True):
+        '''
+            get uid sorted by Date header, newest first if reverse
+        '''
+
+        with self.__lock:
+            return sorted(self.__uids, key=lambda uid: (self.__containers.get(self.__uids.get(uid)).get('date'), int(uid)),
+                reverse=reverse)
+
+    def __build(self, message_id):
+        '''
+            build thread node of container
+            empty container is replaced with its children
+            return list of node
+        '''
+
+        container = self.__containers.get(message_id)
+        children = []
+        for child_id in container.get('children'):
+            children.extend(self.__build(child_id))
+
+        children.sort(key=lambda node: node.get('date'))
+
+        if container.get('uid') is None:
+            return children
+
+        return [{'uid':container.get('uid'), 'date':container.get('date'), 'children':children}]
+
+    def get_threads(self):
+        '''
+            get all thread, newest thread first
+            each node is {'uid':'30411', 'date':timestamp, 'children':[node]}
+            empty root with many children has uid None
+        '''
+
+        with self.__lock:
+            threads = []
+            for message_id, container in self.__containers.items():
+                if container.get('parent') is not None:
+                    continue
+
+                nodes = self.__build(message_id)
+                if len(nodes) > 1 and container.get('uid') is None:
+                    # email in thread reference the same missing email
+                    nodes = [{'uid':None, 'date':nodes[0].get('date'), 'children':nodes}]
+
+                threads.extend(nodes)
+
+        threads.sort(key=_latest_date, reverse=True)
+        return threads
+
+def _latest_date(node):
+    return max([node.get('date') or 0] + [_latest_date(child) for child in node.get('children')])
+
+def parse_thread_response(data):
+    '''
+        parse THREAD response (RFC 5256) into thread node
+        b'(2)(3 6 (4 23)(44 7 96))' will return
+        [{'uid':'2', 'children':[]}, {'uid':'3', 'children':[{'uid':'6', 'children':[...]}]}]
+    '''
+
+    threads = []
+    for item in data:
+        if not item:
+            continue
+
+        for thread in _parse_fetch_tokens(_tokenize_fetch([item]))[0]:
+            if isinstance(thread, list):
+                threads.extend(_parse_thread(thread))
+
+    return threads
+
+def _parse_thread(items):
+    '''
+        convert one parsed thread list into list of sibling node
+    '''
+
+    nodes = []
+    parent = None
+    for item in items:
+        if isinstance(item, list):
+            children = _parse_thread(item)
+            if parent:
+                parent.get('children').extend(children)
+            else:
+                nodes.extend(children)
+            continue
+
+        node = {'uid':item, 'children':[]}
+        if parent:
+            parent.get('children').append(node)
+        else:
+            nodes.append(node)
+
+        parent = node
+
+    return nodes
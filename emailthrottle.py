@@ -0,0 +1,116 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import imaplib
+import random
+import re
+import threading
+import time
+
+# server is busy or limiting the account, matched only on response code
+# ex: Gmail '[THROTTLED]', RFC 5530 '[UNAVAILABLE]' '[LIMIT]' '[INUSE]',
+# Gmail '[ALERT] Too many simultaneous connections', Exchange 'Server Unavailable. 15'
+THROTTLE_RESPONSE = re.compile(r'\[(?:THROTTLED|UNAVAILABLE|LIMIT|INUSE)\]|\[ALERT\] (?:too many|try again later)|\bserver unavailable\. \d+', re.I)
+
+def is_throttled(error):
+    '''
+        check if error or response message is server throttling
+        error = imaplib.IMAP4.error (include abort), or text of NO/BYE response as str, bytes or list of response
+        other exception is never throttling, even if the message look like one
+    '''
+
+    if isinstance(error, (list, tuple)):
+        return any(is_throttled(item) for item in error)
+
+    if isinstance(error, BaseException) and not isinstance(error, imaplib.IMAP4.error):
+        return False
+
+    if isinstance(error, (bytes, bytearray)):
+        error = error.decode('UTF-8', 'replace')
+
+    return THROTTLE_RESPONSE.search(str(error)) is not None
+
+def is_disconnected(error):
+    '''
+        check if error is dropped connection (BYE, socket error, timeout)
+    '''
+
+    return isinstance(error, (imaplib.IMAP4.abort, OSError, EOFError))
+
+class Backoff(object):
+    '''
+        exponential backoff of one account
+        shared by all connection of the account, so every worker slow down when server throttle
+    '''
+
+    def __init__(self, base_delay=1, max_delay=300):
+        '''
+            base_delay = first delay in seconds, doubled for each failure until max_delay
+        '''
+
+        self.__base_delay = base_delay
+        self.__max_delay = max_delay
+        self.__failures = 0
+        self.__until = 0
+        self.__lock = threading.Lock()
+
+    def set_delay(self, base_delay=1, max_delay=300):
+        with self.__lock:
+            self.__base_delay = base_delay
+            self.__max_delay = max_delay
+
+    def failure(self):
+        '''
+            record throttled or failed operation
+            return delay in seconds before next operation
+        '''
+
+        with self.__lock:
+            self.__failures += 1
+            delay = self.get_delay(self.__failures)
+            self.__until = max(self.__until, time.time() + delay)
+
+            return delay
+
+    def get_delay(self, failures):
+        '''
+            delay in seconds after given number of consecutive failure
+            doubled for each failure until max_delay, with up to 10% jitter
+        '''
+
+        delay = min(self.__base_delay * (2 ** (failures - 1)), self.__max_delay)
+        return delay + random.uniform(0, delay * 0.1)
+
+    def success(self):
+        '''
+            record successful operation, delay start from base_delay again
+        '''
+
+        with self.__lock:
+            self.__failures = 0
+
+    def wait(self):
+        '''
+            sleep until backoff delay passed
+            return slept seconds
+        '''
+
+        with self.__lock:
+            delay = self.__until - time.time()
+
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+
+        return 0
+
+    def get_state(self):
+        '''
+            {'failures':3, 'delay':seconds until next operation allowed}
+        '''
+
+        with self.__lock:
+            return {'failures':self.__failures, 'delay':max(self.__until - time.time(), 0)}
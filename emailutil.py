@@ -0,0 +1,350 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import re
+
+# start of untagged fetch response as returned by imaplib
+# ex: b'12 (UID 30411 FLAGS (\\Seen) BODY[HEADER] {342}'
+FETCH_START = re.compile(rb'^\d+ \(')
+
+# token in fetch response attribute list
+FETCH_TOKEN = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}$|(?:[^\s()"\[\]{}]|\[[^\]]*\])+(?:<\d+>)?')
+
+def uid_set(uids):
+    '''
+        compress list of uid into imap sequence set
+        ['1', '2', '3', '7', '9', '10'] will return '1:3,7,9:10'
+    '''
+
+    numbers = sorted(set(int(uid) for uid in uids))
+    ranges = []
+
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+
+    return ','.join(str(start) if start == end else '%d:%d' % (start, end) for start, end in ranges)
+
+def uid_list(sequence_set):
+    '''
+        expand imap sequence set into list of uid
+        '1:3,7' will return ['1', '2', '3', '7']
+    '''
+
+    uids = []
+    for part in str(sequence_set).split(','):
+        start, _, end = part.partition(':')
+        start, end = int(start), int(end or start)
+        uids.extend(str(number) for number in range(min(start, end), max(start, end) + 1))
+
+    return uids
+
+def quote_mailbox(mailbox):
+    '''
+        quote mailbox name for imap command
+        '[Gmail]/All Mail' will return '"[Gmail]/All Mail"'
+    '''
+
+    if mailbox.startswith('"') and mailbox.endswith('"'):
+        return mailbox
+
+    return '"' + mailbox.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def unquote_mailbox(mailbox):
+    '''
+        remove quote from mailbox name
+        '"[Gmail]/All Mail"' will return '[Gmail]/All Mail'
+    '''
+
+    if len(mailbox) > 1 and mailbox.startswith('"') and mailbox.endswith('"'):
+        return mailbox[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+
+    return mailbox
+
+def parse_copyuid(response, code=True):
+    '''
+        parse COPYUID response code (UIDPLUS)
+        '[COPYUID 38505 304,319:320 3956:3958] done' will return
+        ('38505', {'304':'3956', '319':'3957', '320':'3958'})
+        code = False if response is value of response code only, as returned by imap.response('COPYUID')
+            ex: '38505 304,319:320 3956:3958'
+    '''
+
+    if isinstance(response, bytes):
+        response = response.decode('UTF-8', 'replace')
+
+    pattern = r'(\d+) ([\d:,]+) ([\d:,]+)'
+    match = re.search(r'\[COPYUID ' + pattern + r'\]', response, re.I) if code else re.match(pattern, response.strip())
+    if not match:
+        return None, {}
+
+    return match.group(1), dict(zip(uid_list(match.group(2)), uid_list(match.group(3))))
+
+def parse_modified(response):
+    '''
+        parse MODIFIED response code of conditional STORE (CONDSTORE)
+        '[MODIFIED 7,9:10] Conditional STORE failed' will return ['7', '9', '10']
+    '''
+
+    if isinstance(response, bytes):
+        response = response.decode('UTF-8', 'replace')
+
+    match = re.search(r'\[MODIFIED ([\d:,]+)\]', response, re.I)
+    if not match:
+        return []
+
+    return uid_list(match.group(1))
+
+def imap_command(imap, name, *args):
+    '''
+        run imap command and return (status, tagged response text)
+        imaplib public method only return untagged data, response code of tagged response
+        ex: [COPYUID ...], [MODIFIED ...] is only available here
+        untagged data stay in imap object, read it with imap.response('FETCH')
+        raise imaplib.IMAP4.error on BAD response
+
+        imap_command(imap, 'UID', 'COPY', '1:3', 'Archive')
+    '''
+
+    # imaplib has no public method returning tagged response
+    status, data = imap._simple_command(name, *args)
+    text = data[-1] if data else b''
+    if isinstance(text, bytes):
+        text = text.decode('UTF-8', 'replace')
+
+    return status, text or ''
+
+def refresh_capabilities(imap):
+    '''
+        read capability of imap object again, call after login
+        imaplib only keep capability of greeting, many server (Gmail, Dovecot)
+        advertise extension like CONDSTORE, MOVE, UIDPLUS after authentication
+        return new capabilities
+    '''
+
+    status, data = imap.capability()
+    if status == 'OK' and data and data[-1]:
+        capability = data[-1]
+        if isinstance(capability, bytes):
+            capability = capability.decode('ASCII', 'replace')
+
+        imap.capabilities = tuple(capability.upper().split())
+
+    return imap.capabilities
+
+def chunk_list(items, size):
+    '''
+        split list into chunk with maximum size
+        chunk_list(['1', '2', '3'], 2) will yield ['1', '2'] then ['3']
+    '''
+
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _tokenize_fetch(segments):
+    '''
+        tokenize fetch segments
+        segments is list of bytes (response text) and tuple (literal value)
+    '''
+
+    tokens = []
+    for segment in segments:
+        if isinstance(segment, tuple):
+            tokens.append(segment)
+            continue
+
+        for token in FETCH_TOKEN.findall(segment):
+            # literal size marker, the value already in next segment
+            if token.startswith(b'{'):
+                continue
+
+            tokens.append(token)
+
+    return tokens
+
+def _parse_fetch_tokens(tokens, index=0):
+    '''
+        convert tokens into nested list
+        return (list, next index)
+    '''
+
+    result = []
+    while index < len(tokens):
+        token = tokens[index]
+        index += 1
+
+        if isinstance(token, tuple):
+            result.append(token[0])
+        elif token == b'(':
+            value, index = _parse_fetch_tokens(tokens, index)
+            result.append(value)
+        elif token == b')':
+            return result, index
+        elif token.startswith(b'"'):
+            result.append(token[1:-1].replace(b'\\"', b'"').replace(b'\\\\', b'\\').decode('UTF-8', 'replace'))
+        elif token.upper() == b'NIL':
+            result.append(None)
+        else:
+            result.append(token.decode('UTF-8', 'replace'))
+
+    return result, index
+
+def parse_fetch_response(data):
+    '''
+        parse imaplib fetch response into list of fetch item
+        each item is dictionary with uppercase item name as key
+        ex: [{'UID':'30411', 'FLAGS':['\\Seen'], 'RFC822.SIZE':'1234', 'BODY[HEADER]':b'...'}]
+
+        literal value returned as bytes
+        list value returned as list
+    '''
+
+    messages = []
+    for item in data:
+        if item is None:
+            continue
+
+        head = item[0] if isinstance(item, tuple) else item
+        if FETCH_START.match(head):
+            # skip sequence number
+            head = head.split(b' ', 1)[1]
+            messages.append([])
+
+        if not messages:
+            continue
+
+        if isinstance(item, tuple):
+            messages[-1].append(head)
+            messages[-1].append((item[1],))
+        else:
+            messages[-1].append(head)
+
+    fetched = []
+    for segments in messages:
+        parsed, index = _parse_fetch_tokens(_tokenize_fetch(segments))
+        attributes = parsed[0] if parsed and isinstance(parsed[0], list) else parsed
+
+        fetch_item = {}
+        for i in range(0, len(attributes) - 1, 2):
+            fetch_item[str(attributes[i]).upper()] = attributes[i + 1]
+
+        fetched.append(fetch_item)
+
+    return fetched
+
+def _parse_response_line(item):
+    '''
+        parse untagged response line into nested list
+        item is bytes or tuple of (bytes, literal) from imaplib
+    '''
+
+    segments = [item[0], (item[1],)] if isinstance(item, tuple) else [item]
+    return _parse_fetch_tokens(_tokenize_fetch(segments))[0]
+
+def _decode_name(name):
+    if isinstance(name, bytes):
+        return name.decode('UTF-8', 'replace')
+
+    return name
+
+def parse_list_response(data):
+    '''
+        parse imaplib LIST response
+        b'(\\HasNoChildren) "/" "INBOX"' will return
+        [{'flags':['\\HasNoChildren'], 'delimiter':'/', 'name':'INBOX'}]
+    '''
+
+    mailboxes = []
+    for item in data:
+        if item is None:
+            continue
+
+        parsed = _parse_response_line(item)
+        if len(parsed) < 3:
+            continue
+
+        mailboxes.append({'flags':parsed[0] or [], 'delimiter':parsed[1], 'name':_decode_name(parsed[2])})
+
+    return mailboxes
+
+def parse_status_response(data):
+    '''
+        parse imaplib STATUS response
+        b'"INBOX" (MESSAGES 231 UIDNEXT 44292)' will return
+        {'INBOX':{'MESSAGES':231, 'UIDNEXT':44292}}
+    '''
+
+    status = {}
+    for item in data:
+        if item is None:
+            continue
+
+        parsed = _parse_response_line(item)
+        if len(parsed) < 2 or not isinstance(parsed[1], list):
+            continue
+
+        attributes = parsed[1]
+        status[_decode_name(parsed[0])] = dict((str(attributes[i]).upper(), int(attributes[i + 1]))
+            for i in range(0, len(attributes) - 1, 2))
+
+    return status
+
+def join_chunks(chunks, size):
+    '''
+        join small bytes chunk until reach size
+        used to reduce number of write or BDAT command
+        if every chunk end with CRLF the joined chunk also end with CRLF
+    '''
+
+    buffer = []
+    buffer_size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffer_size += len(chunk)
+
+        if buffer_size >= size:
+            yield b''.join(buffer)
+            buffer = []
+            buffer_size = 0
+
+    if buffer:
+        yield b''.join(buffer)
+
+def dot_stuff(chunks):
+    '''
+        dot stuffing for smtp DATA command (RFC 5321 section 4.5.2)
+        line starting with '.' get additional '.'
+        chunk may end in the middle of line, but should not split CRLF, ex: from MessageBuilder.generate_stream
+    '''
+
+    line_start = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+
+        if line_start and chunk.startswith(b'.'):
+            chunk = b'.' + chunk
+
+        yield chunk.replace(b'\r\n.', b'\r\n..')
+        line_start = chunk.endswith(b'\r\n')
+
+def read_chunks(fp, size):
+    '''
+        read binary file object in chunk
+        chunk extended to end of line, so every chunk start at line start
+    '''
+
+    while True:
+        chunk = fp.read(size)
+        if not chunk:
+            return
+
+        if not chunk.endswith(b'\n'):
+            chunk += fp.readline()
+
+        yield chunk
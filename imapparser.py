@@ -0,0 +1,350 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import email.parser
+import imaplib
+import itertools
+import re
+import threading
+import weakref
+
+from emailutil import FETCH_TOKEN, uid_set, _parse_fetch_tokens
+
+# untagged fetch response line
+# ex: b'* 12 FETCH (UID 30411 FLAGS (\\Seen) BODY[HEADER] {342}'
+UNTAGGED_FETCH = re.compile(rb'\* \d+ FETCH ', re.I)
+
+# untagged search response line
+UNTAGGED_SEARCH = re.compile(rb'\* SEARCH\b', re.I)
+
+# literal size marker at the end of response line
+LITERAL = re.compile(rb'\{(\d+)\}$')
+
+# UID item of fetch response, unsolicited fetch (ex: flags changed by other client) has no UID
+FETCH_UID = re.compile(rb'[( ]UID \d', re.I)
+
+# untagged response with number, ex: b'* 23 EXISTS'
+UNTAGGED_STATUS = re.compile(rb'\* (\d+) ([A-Z-]+)(?: (.*))?$', re.I | re.S)
+
+# other untagged response, ex: b'* OK [UIDNEXT 4392] Predicted next UID'
+UNTAGGED_RESPONSE = re.compile(rb'\* ([A-Z-]+)(?: (.*))?$', re.I | re.S)
+
+# response code of status response
+RESPONSE_CODE = re.compile(rb'\[([A-Z-]+)(?: ([^\]]*))?\]', re.I)
+
+def append_untagged(imap, line):
+    '''
+        store untagged response line read directly from socket into imap object
+        so imap.response() and next imaplib command see EXISTS, EXPUNGE, FETCH, ...
+        the same as if the line is read by imaplib
+        line = response line without CRLF and without literal
+    '''
+
+    line = bytes(line)
+    match = UNTAGGED_STATUS.match(line)
+    if match:
+        typ, data = match.group(2), match.group(1) + (b' ' + match.group(3) if match.group(3) else b'')
+    else:
+        match = UNTAGGED_RESPONSE.match(line)
+        if not match:
+            return
+
+        typ, data = match.group(1), match.group(2) or b''
+
+    # imaplib has no public method to add untagged response
+    typ = typ.decode('ASCII').upper()
+    imap._append_untagged(typ, data)
+
+    code = RESPONSE_CODE.match(data) if typ in ('OK', 'NO', 'BAD') else None
+    if code:
+        imap._append_untagged(code.group(1).decode('ASCII').upper(), code.group(2) or b'')
+
+class ResponseReader(object):
+    '''
+        read imap response line and literal from imap connection
+        response line read into one reusable buffer, buffer grow for long line (ex: huge SEARCH result)
+        literal read directly from socket into own buffer and returned as memoryview
+        never read past the end of response line, so imaplib can continue using the connection
+    '''
+
+    def __init__(self, imap, buffer_size=8192):
+        '''
+            imap = imaplib.IMAP4 object
+            buffer_size = initial size of line buffer
+        '''
+
+        # weak reference, parser is kept per imap object in get_parser
+        self.__imap = weakref.proxy(imap)
+        self.__buffer = bytearray(buffer_size)
+        self.__size = 0
+
+    def readline(self):
+        '''
+            read one response line into line buffer
+            return size of line without CRLF, line is available from get_buffer
+        '''
+
+        file = self.__imap.file
+        self.__size = 0
+
+        while True:
+            # peek don't consume, so only bytes until end of line is read
+            peeked = file.peek(1)
+            if not peeked:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+
+            index = peeked.find(b'\n')
+            size = index + 1 if index >= 0 else len(peeked)
+
+            if self.__size + size > len(self.__buffer):
+                self.__buffer.extend(bytes(max(self.__size + size - len(self.__buffer), len(self.__buffer))))
+
+            with memoryview(self.__buffer) as view:
+                file.readinto(view[self.__size:self.__size + size])
+
+            self.__size += size
+            if index >= 0:
+                break
+
+        end = self.__size
+        while end and self.__buffer[end - 1] in b'\r\n':
+            end -= 1
+
+        return end
+
+    def get_buffer(self):
+        '''
+            get line buffer
+            content is only valid until next readline
+        '''
+
+        return self.__buffer
+
+    def read_literal(self, size):
+        '''
+            read literal with size directly into new buffer
+            return memoryview of literal
+        '''
+
+        literal = bytearray(size)
+        view = memoryview(literal)
+        read = 0
+
+        while read < size:
+            count = self.__imap.file.readinto(view[read:])
+            if not count:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+
+            read += count
+
+        return view
+
+class FetchParser(object):
+    '''
+        incremental imap response parser
+        command written directly to imap connection and response parsed while reading
+        FETCH yield one record for each message as soon as it received
+        literal value returned as memoryview without copying, see decode_literal and literal_to_message
+    '''
+
+    # tag of command written by parser, see send_command
+    __tag = itertools.count(1)
+
+    def __init__(self, imap, buffer_size=8192):
+        '''
+            imap = imaplib.IMAP4 object, parser can be reused for same imap object
+        '''
+
+        self.__imap = weakref.proxy(imap)
+        self.__reader = ResponseReader(imap, buffer_size)
+
+    def send_command(self, command):
+        '''
+            write command with new tag to imap connection
+            return the tag
+        '''
+
+        tag = 'PXF%d' % next(FetchParser.__tag)
+        self.__imap.send(('%s %s\r\n' % (tag, command)).encode('UTF-8'))
+
+        return tag.encode('ASCII')
+
+    def __read_response(self, tag):
+        '''
+            read response until tagged completion
+            yield (is_fetch, tokens) for each untagged response
+            raise imaplib.IMAP4.error if command not completed with OK
+        '''
+
+        reader = self.__reader
+        while True:
+            end = reader.readline()
+            line = reader.get_buffer()
+
+            if line.startswith(tag + b' ', 0, end):
+                status, _, msg = bytes(line[len(tag) + 1:end]).partition(b' ')
+                if status.upper() != b'OK':
+                    raise imaplib.IMAP4.error('%s command error: %s %s' % (tag.decode('ASCII'),
+                        status.decode('ASCII', 'replace'), msg.decode('UTF-8', 'replace')))
+
+                return
+
+            if line.startswith(b'* BYE', 0, end):
+                raise imaplib.IMAP4.abort(bytes(line[:end]).decode('UTF-8', 'replace'))
+
+            match = UNTAGGED_FETCH.match(line, 0, end)
+            if match:
+                # unsolicited fetch is also kept for imaplib
+                if not FETCH_UID.search(line, 0, end) and not LITERAL.search(line, 0, end):
+                    append_untagged(self.__imap, line[:end])
+
+                yield True, self.__tokenize(match.end(), end)
+                continue
+
+            match = UNTAGGED_SEARCH.match(line, 0, end)
+            if match:
+                yield False, self.__tokenize(match.end(), end)
+                continue
+
+            # other untagged response (EXISTS, EXPUNGE...) is kept for imaplib
+            # response with literal is rare outside FETCH, skip it
+            if not LITERAL.search(line, 0, end):
+                append_untagged(self.__imap, line[:end])
+
+            while True:
+                literal = LITERAL.search(line, 0, end)
+                if not literal:
+                    break
+
+                reader.read_literal(int(literal.group(1)))
+                end = reader.readline()
+                line = reader.get_buffer()
+
+    def __tokenize(self, start, end):
+        '''
+            tokenize response from line buffer
+            continue with next line after literal
+            literal token is tuple of (memoryview,)
+        '''
+
+        reader = self.__reader
+        tokens = []
+
+        while True:
+            line = reader.get_buffer()
+            literal_size = None
+
+            for match in FETCH_TOKEN.finditer(line, start, end):
+                token = match.group()
+                if token.startswith(b'{'):
+                    literal_size = int(token[1:-1])
+                else:
+                    tokens.append(token)
+
+            if literal_size is None:
+                return tokens
+
+            tokens.append((reader.read_literal(literal_size),))
+            end = reader.readline()
+            start = 0
+
+    def fetch(self, email_ids, items, modifiers=None):
+        '''
+            UID FETCH email_ids then yield parsed record of each message
+            email_ids = list of uid or sequence set string '1:100'
+            items = '(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER])'
+            modifiers = '(CHANGEDSINCE 12345)' (CONDSTORE)
+
+            yield dictionary with uppercase item name as key, same as parse_fetch_response
+            but literal value is memoryview
+            {'UID':'30411', 'FLAGS':['\\Seen'], 'RFC822.SIZE':'1234', 'BODY[HEADER]':memoryview}
+
+            unsolicited fetch response (without UID) also yielded
+            the command must be completed before other command sent to imap object
+        '''
+
+        if not isinstance(email_ids, str):
+            email_ids = uid_set(email_ids)
+
+        command = 'UID FETCH %s %s' % (email_ids, items)
+        if modifiers:
+            command += ' ' + modifiers
+
+        responses = self.__read_response(self.send_command(command))
+        try:
+            for is_fetch, tokens in responses:
+                if not is_fetch:
+                    continue
+
+                parsed, index = _parse_fetch_tokens(tokens)
+                attributes = parsed[0] if parsed and isinstance(parsed[0], list) else parsed
+
+                record = {}
+                for i in range(0, len(attributes) - 1, 2):
+                    record[str(attributes[i]).upper()] = attributes[i + 1]
+
+                yield record
+        finally:
+            # generator closed early, read the rest of response so connection can be used again
+            for response in responses:
+                pass
+
+    def search(self, *criterion):
+        '''
+            UID SEARCH with criterion, ex: search('UNSEEN') or search('UID', '100:*')
+            return list of uid
+            search result line can be any length
+        '''
+
+        email_ids = []
+        for is_fetch, tokens in self.__read_response(self.send_command('UID SEARCH ' + ' '.join(criterion))):
+            if is_fetch:
+                continue
+
+            for token in tokens:
+                # (MODSEQ 12345) at the end of CONDSTORE search result
+                if token == b'(':
+                    break
+
+                email_ids.append(token.decode('ASCII'))
+
+        return email_ids
+
+# one parser for each imap object, so the line buffer is reused
+_parsers = weakref.WeakKeyDictionary()
+_parsers_lock = threading.Lock()
+
+def get_parser(imap):
+    '''
+        get FetchParser of imap object
+        created on first call
+    '''
+
+    with _parsers_lock:
+        parser = _parsers.get(imap)
+        if not parser:
+            parser = FetchParser(imap)
+            _parsers[imap] = parser
+
+        return parser
+
+def decode_literal(literal, encoding='UTF-8', errors='replace'):
+    '''
+        decode literal (bytes or memoryview) into str without intermediate bytes copy
+    '''
+
+    if literal is None:
+        return None
+
+    return str(literal, encoding, errors)
+
+def literal_to_message(literal, headersonly=False):
+    '''
+        parse literal (bytes or memoryview) into email.message.Message
+        same as email.message_from_bytes
+    '''
+
+    return email.parser.Parser().parsestr(decode_literal(literal, 'ASCII', 'surrogateescape'), headersonly)
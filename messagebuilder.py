@@ -5,7 +5,16 @@
 '''
 
 import smtplib, os
+import base64
+import mimetypes
+import re
+import tempfile
+import threading
+import time
+import uuid
 from os.path import basename
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
@@ -13,8 +22,114 @@ from email.mime.audio import MIMEAudio
 from email.mime.image import MIMEImage
 from email.mime.message import MIMEMessage
 
-from email.utils import COMMASPACE, formatdate
+from email.utils import COMMASPACE, formatdate, getaddresses
 from email import encoders
+from email.policy import SMTP
+
+# file read size when streaming attachment, multiple of 57 bytes (one 76 chars base64 line)
+STREAM_CHUNK_SIZE = 57 * 16384
+
+# generated message bigger than this is spooled to temporary file on disk
+SPOOL_MAX_SIZE = 1024 * 1024 * 5
+
+# template placeholder, ex: {name}
+PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+def substitute(text, values):
+    '''
+        replace {placeholder} in text with value
+        unknown placeholder is not replaced
+    '''
+    
+    return PLACEHOLDER.sub(lambda match: str(values[match.group(1)]) if match.group(1) in values else match.group(0), text)
+
+def add_disposition(part, attachment):
+    '''
+        add attachment disposition header using file name
+    '''
+
+    part.add_header('Content-Disposition', 'attachment', filename=basename(attachment.get('file')))
+
+def build_part(attachment):
+    '''
+        build mime part of attachment
+    '''
+
+    part = None
+    is_file = False
+
+    if attachment.get('type') == 'application':
+        with open(attachment.get('file'), 'rb') as f:
+            part = MIMEApplication(
+                f.read(),
+                attachment.get('mime_type'),
+                attachment.get('encoder'),
+                **attachment.get('param'))
+        is_file = True
+
+    elif attachment.get('type') == 'image':
+        with open(attachment.get('file'), 'rb') as f:
+            part = MIMEImage(
+                f.read(),
+                attachment.get('mime_type'),
+                attachment.get('encoder'),
+                **attachment.get('param'))
+        is_file = True
+
+    elif attachment.get('type') == 'audio':
+        with open(attachment.get('file'), 'rb') as f:
+            part = MIMEAudio(
+                f.read(),
+                attachment.get('mime_type'),
+                attachment.get('encoder'),
+                **attachment.get('param'))
+        is_file = True
+
+    elif attachment.get('type') == 'base':
+        part = MIMEBase(
+            attachment.get('main_mime'),
+            attachment.get('mime_type'),
+            **attachment.get('param'))
+        with open(attachment.get('file'), 'rb') as f:
+            part.set_payload(f.read())
+        attachment.get('encoder')(part)
+        is_file = True
+
+    elif attachment.get('type') == 'message':
+        part = MIMEMessage(
+            attachment.get('msg'),
+            attachment.get('mime_type'))
+
+    elif attachment.get('type') == 'text':
+        if os.path.isfile(attachment.get('file')):
+            with open(attachment.get('file'), 'r') as f:
+                part = MIMEText(
+                    f.read(),
+                    attachment.get('mime_type'),
+                    attachment.get('charset'))
+            is_file = True
+
+        else:
+            part = MIMEText(
+                attachment.get('file'),
+                attachment.get('mime_type'),
+                attachment.get('charset'))
+
+    if part and attachment.get('disposition') and is_file:
+        add_disposition(part, attachment)
+
+    return part
+
+def build_part_timed(attachment):
+    '''
+        build mime part of attachment and measure build time
+        return (part, seconds)
+    '''
+    
+    start = time.time()
+    part = build_part(attachment)
+    
+    return part, time.time() - start
 
 
 class MessageBuilder(object):
@@ -39,6 +154,14 @@ class MessageBuilder(object):
         self.__rcpt_options = []
         self.__mail_options = []
         
+        # template mode, see set_template
+        self.__is_template = False
+        self.__template_parts = {}
+        self.__template_lock = threading.Lock()
+        
+        # attachment build time of last generate
+        self.__timing = []
+        
     def set_CC(self, CC):
         '''
             CC should be in list string of email address format
@@ -57,6 +180,16 @@ class MessageBuilder(object):
         self.__message['BCC'] = COMMASPACE.join(BCC)
         return self
         
+    def set_header(self, name, value):
+        '''
+            set custom header, existing header with the same name is replaced
+            set_header('Reply-To', 'support@domain.com')
+        '''
+        
+        del self.__message[name]
+        self.__message[name] = value
+        return self
+        
     def set_mail_options(self, mail_options=[]):
         '''
             add mail options
@@ -83,6 +216,18 @@ class MessageBuilder(object):
         
     def get_rcpt_options(self):
         return self.__rcpt_options
+        
+    def get_envelope(self):
+        '''
+            get smtp envelope of message
+            return (from_addr, [to_addrs]), to_addrs include To, CC and BCC
+        '''
+        
+        from_addr = getaddresses([self.__message.get('From', '')])[0][1]
+        to_addrs = [addr for name, addr in getaddresses(self.__message.get_all('To', []) +
+            self.__message.get_all('CC', []) + self.__message.get_all('BCC', [])) if addr]
+            
+        return from_addr, to_addrs
             
     def attach_application(self, file_path, mime_type='octet-stream', encoder=encoders.encode_base64, disposition=True, **param):
         '''
@@ -130,7 +275,7 @@ class MessageBuilder(object):
                 'file':file_path,
                 'mime_type':mime_type,
                 'encoder':encoder,
-                'param':param,
+                'param':params,
                 'disposition':disposition,
                 'type':'image',
             })
@@ -153,6 +298,21 @@ class MessageBuilder(object):
             
         return self
 
+    def attach_part(self, part):
+        '''
+            attach already built mime part
+            the part is not built or encoded again on generate
+            example:
+                attach_part(MIMEText('halo'))
+        '''
+        
+        self.__message_attachment.append({
+                'part':part,
+                'type':'part'
+            })
+            
+        return self
+
     def attach_audio(self, file_path, mime_type=None, encoder=encoders.encode_base64, disposition=True, **param):
         '''
             attach audio
@@ -190,73 +350,277 @@ class MessageBuilder(object):
 
         return self
         
-    def generate(self):
+    def __get_mime(self, attachment):
         '''
-            generate message to send with send message
+            get (main type, sub type) of file attachment
+            guess from file name if mime type not set
         '''
-
-        for attachment in self.__message_attachment:
-            part = None
-            f = None
+        
+        if attachment.get('type') == 'application':
+            return 'application', attachment.get('mime_type')
             
-            if attachment.get('type') == 'application':
-                f = open(attachment.get('file'), 'rb')
-                part = MIMEApplication(
-                    f.read(),
+        if attachment.get('type') == 'base':
+            return attachment.get('main_mime'), attachment.get('mime_type')
+            
+        if attachment.get('mime_type'):
+            return attachment.get('type'), attachment.get('mime_type')
+        
+        guessed = mimetypes.guess_type(attachment.get('file'))[0]
+        if guessed and guessed.startswith(attachment.get('type') + '/'):
+            return tuple(guessed.split('/', 1))
+            
+        return 'application', 'octet-stream'
+        
+    def set_template(self, is_template=True):
+        '''
+            set message as template for mail merge
+            attachment is built and encoded once then reused by every render and generate
+            subject and text (not text file) may contain {placeholder}
+            render() set template mode automatically
+            set_template(False) will clear cached attachment, ex: after attachment file changed
+            
+            template = MessageBuilder('amru.rosyada@gmail.com', [], 'Invoice for {name}')
+            template.attach_text('Hello {name}').attach_application('/home/amru/invoice.pdf').set_template()
+            message = template.render(['john@gmail.com'], name='John')
+        '''
+        
+        self.__is_template = is_template
+        self.__template_parts = {}
+        return self
+        
+    def is_template(self):
+        return self.__is_template
+        
+    def __get_template_part(self, index, attachment):
+        '''
+            get cached (part, encoded bytes) of attachment
+            built on first call
+        '''
+        
+        with self.__template_lock:
+            if index not in self.__template_parts:
+                part = build_part(attachment)
+                del part['MIME-Version']
+                self.__template_parts[index] = (part, self.__part_bytes(part))
+                
+            return self.__template_parts.get(index)
+        
+    def render(self, msg_to, CC=None, BCC=None, **values):
+        '''
+            create personalized message from template
+            msg_to = ['john@gmail.com']
+            CC, BCC = override CC and BCC of template, [] remove it
+            values = placeholder value, ex: name='John'
+            
+            CC, BCC and custom header of template is copied to rendered message
+            only header and text is built for each render
+            attachment use cached part from template
+            return new MessageBuilder
+        '''
+        
+        message = MessageBuilder(self.__message.get('From'), msg_to, substitute(self.__message.get('Subject', ''), values))
+        message.set_mail_options(self.__mail_options).set_rcpt_options(self.__rcpt_options)
+        
+        # header of MessageBuilder constructor and multipart container is already set
+        for name, value in self.__message.items():
+            if name.lower() not in ('from', 'to', 'subject', 'content-type', 'mime-version'):
+                message.__message[name] = value
+        
+        if CC is not None:
+            del message.__message['CC']
+            if CC:
+                message.set_CC(CC)
+            
+        if BCC is not None:
+            del message.__message['BCC']
+            if BCC:
+                message.set_BCC(BCC)
+        
+        self.__is_template = True
+        
+        for index, attachment in enumerate(self.__message_attachment):
+            if not self.__is_cacheable(attachment):
+                message.attach_text(substitute(attachment.get('file'), values),
                     attachment.get('mime_type'),
-                    attachment.get('encoder'),
-                    **attachment.get('param'))
+                    attachment.get('charset'),
+                    attachment.get('disposition'))
                     
-            elif attachment.get('type') == 'image':
-                f = open(attachment.get('file'), 'rb')
-                part = MIMEImage(
-                    f.read(),
-                    attachment.get('mime_type'),
-                    attachment.get('encoder'),
-                    **attachment.get('param'))
+            elif attachment.get('type') == 'part':
+                message.__message_attachment.append(attachment)
+                
+            else:
+                part, data = self.__get_template_part(index, attachment)
+                message.__message_attachment.append({
+                        'part':part,
+                        'data':data,
+                        'type':'part'
+                    })
+                    
+        return message
+        
+    def __is_cacheable(self, attachment):
+        '''
+            text (not text file) is personalized, other attachment can be cached
+        '''
+        
+        return not (attachment.get('type') == 'text' and not os.path.isfile(attachment.get('file')))
+        
+    def __part_bytes(self, part):
+        '''
+            flatten mime part to bytes with CRLF line ending
+        '''
+        
+        return part.as_bytes(policy=SMTP)
+        
+    def __is_streamable(self, attachment):
+        '''
+            file attachment with base64 encoder can be encoded in chunk
+        '''
+        
+        return (attachment.get('type') in ('application', 'image', 'audio', 'base') and
+            attachment.get('encoder') is encoders.encode_base64)
+        
+    def generate(self, max_workers=None, use_process=False):
+        '''
+            generate message to send with send message
+            every call return new message object
             
-            elif attachment.get('type') == 'audio':
-                f = open(attachment.get('file'), 'rb')
-                part = MIMEAudio(
-                    f.read(),
-                    attachment.get('mime_type'),
-                    attachment.get('encoder'),
-                    **attachment.get('param'))
+            max_workers = read and encode attachment concurrently using max_workers thread
+            use_process = True will use process instead of thread (custom encoder should be picklable)
+            attachment always attached in original order
+            build time of each attachment available from get_timing()
+        '''
+        
+        message = MIMEMultipart()
+        for name, value in self.__message.items():
+            if name.lower() not in ('content-type', 'mime-version'):
+                message[name] = value
+        
+        parts = {}
+        build = []
+        for index, attachment in enumerate(self.__message_attachment):
+            if attachment.get('type') == 'part':
+                parts[index] = attachment.get('part')
+            elif self.__is_template and self.__is_cacheable(attachment):
+                parts[index] = self.__get_template_part(index, attachment)[0]
+            else:
+                build.append(index)
+        
+        attachments = [self.__message_attachment[index] for index in build]
+        if max_workers and len(build) > 1:
+            executor_class = ProcessPoolExecutor if use_process else ThreadPoolExecutor
+            with executor_class(max_workers=max_workers) as executor:
+                built = list(executor.map(build_part_timed, attachments))
+        else:
+            built = [build_part_timed(attachment) for attachment in attachments]
+        
+        self.__timing = []
+        for index, attachment, (part, seconds) in zip(build, attachments, built):
+            # MIME-Version only in message header, same as template part and generate_stream
+            del part['MIME-Version']
+            parts[index] = part
+            self.__timing.append({
+                    'index':index,
+                    'type':attachment.get('type'),
+                    'file':attachment.get('file') if attachment.get('type') != 'text' or os.path.isfile(attachment.get('file')) else None,
+                    'seconds':seconds
+                })
+
+        for index in range(len(self.__message_attachment)):
+            if parts.get(index):
+                message.attach(parts.get(index))
+
+        return message
+        
+    def get_timing(self):
+        '''
+            get build time of each attachment from last generate
+            [{'index':1, 'type':'application', 'file':'/home/amru/timesheet.xlsx', 'seconds':0.25}]
+        '''
+        
+        return self.__timing
+        
+    def generate_stream(self, chunk_size=STREAM_CHUNK_SIZE):
+        '''
+            generate message as bytes chunk with CRLF line ending
+            file attachment is read and base64 encoded chunk by chunk
+            so attachment never fully loaded into memory
+            output is same as generate() with SMTP policy, except the boundary
+            every chunk start at line start or with CRLF of boundary delimiter, see dot_stuff
+            
+            BCC header is not included, like smtplib send_message
+            use get_envelope() to get BCC recipient
             
-            elif attachment.get('type') == 'base':
-                f = open(attachment.get('file'), 'rb')
-                part = MIMEBase(
-                    attachment.get('mime_main'),
-                    attachment.get('mime_type'))
-                part.set_payload(open(attachment.get('file'), "rb").read())
-                attachment.get('encoder')(part)
+            for chunk in message.generate_stream():
+                sock.sendall(chunk)
+        '''
+        
+        # read size should be multiple of 57 bytes, so each encoded chunk end in complete line
+        chunk_size = max(chunk_size // 57, 1) * 57
+        # same boundary format as email.generator, so header folded same as generate()
+        boundary = '===============' + '%019d' % (uuid.uuid4().int % 10 ** 19) + '=='
+        
+        headers = MIMEMultipart(boundary=boundary)
+        for name, value in self.__message.items():
+            if name.lower() not in ('bcc', 'content-type', 'mime-version'):
+                headers[name] = value
+        
+        yield b''.join(SMTP.fold_binary(name, value) for name, value in headers.items()) + b'\r\n'
+        
+        # delimiter is CRLF--boundary, CRLF before first boundary is not needed without preamble
+        delimiter = b'--' + boundary.encode('ASCII')
+        for index, attachment in enumerate(self.__message_attachment):
+            yield (b'\r\n' if index else b'') + delimiter + b'\r\n'
+            
+            if attachment.get('type') == 'part':
+                yield attachment.get('data') or self.__part_bytes(attachment.get('part'))
+                
+            elif self.__is_template and self.__is_cacheable(attachment):
+                yield self.__get_template_part(index, attachment)[1]
+                
+            elif self.__is_streamable(attachment):
+                main_type, sub_type = self.__get_mime(attachment)
+                part = MIMEBase(main_type, sub_type, **attachment.get('param'))
+                del part['MIME-Version']
+                part['Content-Transfer-Encoding'] = 'base64'
+                if attachment.get('disposition'):
+                    add_disposition(part, attachment)
                     
-            elif attachment.get('type') == 'message':
-                part = MIMEMessage(
-                    attachment.get('msg'),
-                    attachment.get('mime_type'))
-                                    
-            elif attachment.get('type') == 'text':
-                if os.path.isfile(attachment.get('file')):
-                    f = open(attachment.get('file'), 'rb')
-                    part = MIMEText(
-                        f.read(),
-                        attachmentEncoders.encode_base64.get('mime_type'),
-                        attachment.get('charset'))
+                yield b''.join(SMTP.fold_binary(name, value) for name, value in part.items()) + b'\r\n'
+                
+                with open(attachment.get('file'), 'rb') as f:
+                    while True:
+                        data = f.read(chunk_size)
+                        if not data:
+                            break
+                            
+                        yield base64.encodebytes(data).replace(b'\n', b'\r\n')
                         
-                else:
-                    part = MIMEText(
-                        attachment.get('file'),
-                        attachment.get('mime_type'),
-                        attachment.get('charset'))
+            else:
+                part = build_part(attachment)
+                del part['MIME-Version']
+                yield self.__part_bytes(part)
+        
+        # multipart without part still has one empty part, same as email.generator
+        if not self.__message_attachment:
+            yield delimiter + b'\r\n'
             
-            if part:            
-                if attachment.get('disposition') and f:
-                    part.add_header('Content-Disposition', 'attachment; filename="' + f.name + '"')
-                    
-                self.__message.attach(part)
-
-            if f:
-                f.close()
-
-        return self.__message
\ No newline at end of file
+        yield b'\r\n' + delimiter + b'--\r\n'
+        
+    def generate_file(self, max_size=SPOOL_MAX_SIZE, chunk_size=STREAM_CHUNK_SIZE):
+        '''
+            generate message into temporary file object
+            message written chunk by chunk from generate_stream
+            kept in memory until bigger than max_size, then moved to temporary file on disk
+            return binary file object at position 0, with CRLF line ending
+            
+            with message.generate_file() as message_file:
+                pyemail.imap_append_message(message_file, 'Drafts')
+        '''
+        
+        message_file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        for chunk in self.generate_stream(chunk_size):
+            message_file.write(chunk)
+            
+        message_file.seek(0)
+        return message_file
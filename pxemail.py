@@ -5,19 +5,45 @@
 '''
 
 import email
+import hashlib
 import imaplib
+import io
+import itertools
 import smtplib
 import pickle
 import copy
 import json
 import os
+import queue
+import re
+import shutil
+import threading
+import time
 
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from email.generator import BytesGenerator
 from email.parser import HeaderParser
+from urllib.parse import quote
 from pickle import Pickler, Unpickler
 
+from emailbatch import FetchBatcher, is_body_fetch, get_fetch_size
+from emailcache import FlagCache
+from emailcodec import CacheCodec, CodecError, get_codec, decode_cache
+from emaildeadline import Deadline, DeadlineExceeded
 from emailentity import IMAPEntity, SMTPEntity, EntityFlag
 from emailfilter import EmailFilter
-from messagebuilder import MessageBuilder
+from emailindex import DedupeIndex, AddressIndex
+from emailpool import IMAPPool, SMTPPool, KeepAlive, is_socket_open
+from emailrecord import MessageRecord, FETCH_FIELDS, write_records, read_records
+from emailspool import EmailSpool, SpoolFlag
+from emailthrottle import Backoff, is_throttled, is_disconnected
+from emailthread import ThreadIndex, parse_thread_response, parse_date
+from imapparser import get_parser, decode_literal, literal_to_message, append_untagged
+from emailutil import uid_set, uid_list, chunk_list, parse_fetch_response, parse_copyuid, quote_mailbox, unquote_mailbox
+from emailutil import refresh_capabilities, parse_modified, imap_command
+from emailutil import parse_list_response, parse_status_response, join_chunks, dot_stuff, read_chunks
+from messagebuilder import MessageBuilder, STREAM_CHUNK_SIZE
 
 class PxEmail(object):
     '''
@@ -38,16 +64,342 @@ class PxEmail(object):
         self.__smtp_entity = SMTPEntity()
         
         self.__imap_local_dir = os.getcwd() + os.path.sep + 'pxemail_cache'
+        self.__imap_flag_cache = FlagCache()
+        self.__imap_pool = {}
+        # local index of user and mailbox by filename, see __imap_get_index
+        self.__imap_index = {}
+        # codec of cached email file, see imap_set_cache_codec
+        self.__imap_cache_codec = get_codec()
+        self.__imap_cache_allow_pickle = False
+        # sync state of restored mailbox which flags not loaded yet, see restore
+        self.__imap_snapshot_state = {}
+        # adaptive fetch batcher of user and fetch item, see imap_get_batcher
+        self.__imap_batcher = {}
+        self.__imap_batch_limit = {'min_count':1, 'max_count':1000, 'min_bytes':65536, 'max_bytes':16777216, 'target_time':1.0}
+        # throttling backoff of each user, see imap_call
+        self.__imap_backoff = {}
+        self.__imap_retry = {'base_delay':1, 'max_delay':300, 'max_retries':8}
+        # background body prefetch after listing, see imap_set_prefetch
+        self.__imap_prefetch = {'count':0, 'max_size':1048576, 'unseen_first':True}
+        self.__imap_prefetch_worker = {}
+        self.__imap_lock = threading.RLock()
+        # tag for command written directly to imap socket, see imap_append_message
+        self.__imap_tag = itertools.count(1)
+        
+        self.__smtp_pool = {}
+        self.__smtp_lock = threading.RLock()
+        self.__smtp_spool = None
+        
+        # background NOOP of pooled connection, see keepalive_start
+        self.__keepalive = None
+        self.__keepalive_idle_time = {'imap':300, 'smtp':60}
         
         # this will be override when call imap_set_active(host, username)
-        self.__active_imap_user = {'host':'', 'username':''}
+        # mailbox will be override when call imap_mailbox_select(mailbox)
+        self.__active_imap_user = {'host':'', 'username':'', 'mailbox':None}
         self.__active_smtp_user = {'host':'', 'username':''}
         
+        # own connection of imap session, see imap_session(host, username)
+        self.__imap_session = None
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''
+            logout imap session when leaving with statement
+        '''
+        
+        if self.__imap_session:
+            self.imap_logout()
+        
+    ####################################
+    ####### SNAPSHOT FUNCTIONALITY ######
+    ####################################
+    def snapshot(self, filename, save_password=False):
+        '''
+            save warm start snapshot of this object as json file
+            file is created readable only by owner (0600)
+            - imap and smtp user, password only included if save_password is True
+              by default password is kept outside the file, ex: keyring, and given by restore get_password
+            - active imap user with selected mailbox and active smtp user
+            - cache directory and cache codec
+            - cached flags of each mailbox, saved beside cached email as .flags
+            - sync state of each mailbox at the time of snapshot
+            - conversation thread index in memory
+            ssl context is not saved, default context is used after restore
+            
+            return {'status':'OK', 'msg':filename}
+        '''
+        
+        try:
+            imap_users = {}
+            for host, users in self.__imap_entity.get_all().items():
+                for username, imap_user in users.items():
+                    imap_users.setdefault(host, {})[username] = dict((key, imap_user.get(key))
+                        for key in ('password', 'port', 'connection_type', 'keyfile', 'certfile', 'timeout')
+                        if save_password or key != 'password')
+            
+            smtp_users = {}
+            for host, users in self.__smtp_entity.get_all().items():
+                for username, smtp_user in users.items():
+                    smtp_users.setdefault(host, {})[username] = dict((key, smtp_user.get(key))
+                        for key in ('password', 'port', 'local_hostname', 'source_address', 'connection_type',
+                            'keyfile', 'certfile', 'rcpt_limit', 'timeout')
+                        if save_password or key != 'password')
+            
+            mailboxes = []
+            for namespace in self.__imap_flag_cache.get_namespaces():
+                host, username, mailbox = namespace
+                if not mailbox:
+                    continue
+                
+                # restored flags not loaded yet, .flags file is still the same
+                if not self.__imap_flag_cache.is_loaded(namespace):
+                    state = self.__imap_snapshot_state.get(namespace, {})
+                else:
+                    dir_path = self.__imap_cache_dir(username, mailbox)
+                    try:
+                        with open(dir_path + os.path.sep + '.syncstate', 'r') as f:
+                            state = json.load(f)
+                    except Exception:
+                        state = {}
+                    
+                    flags = dict((email_id, sorted(email_flags))
+                        for email_id, email_flags in self.__imap_flag_cache.get(namespace).items())
+                    self.__write_json(dir_path + os.path.sep + '.flags', flags)
+                    
+                mailboxes.append({'host':host, 'username':username, 'mailbox':mailbox, 'state':state})
+            
+            with self.__imap_lock:
+                indexes = list(self.__imap_index.values())
+                
+            for index in indexes:
+                if isinstance(index, ThreadIndex):
+                    index.save()
+            
+            active = self.imap_get_active()
+            self.__write_json(filename, {
+                'version':1,
+                'directory':self.__imap_local_dir,
+                'cache_codec':self.__imap_cache_codec.NAME,
+                'cache_allow_pickle':self.__imap_cache_allow_pickle,
+                'imap':imap_users,
+                'smtp':smtp_users,
+                'imap_active':{'host':active.get('host'), 'username':active.get('username'),
+                    'mailbox':active.get('mailbox'), 'readonly':active.get('readonly', False)},
+                'smtp_active':dict(self.smtp_get_active()),
+                'mailboxes':mailboxes}, 0o600)
+            
+            return {'status':'OK', 'msg':filename}
+            
+        except Exception as e:
+            print(e)
+            return {'status':'NO', 'msg':str(e)}
+            
+    def restore(self, filename, get_password=None):
+        '''
+            restore snapshot saved by snapshot(filename)
+            get_password = function('imap'|'smtp', host, username) return password
+                of user saved without password, see snapshot save_password
+            nothing is connected or loaded when restoring
+            - user connect on first use, ex: imap_login
+            - selected mailbox is selected again after imap_login
+            - cached flags of mailbox loaded on first access
+            - sync state of mailbox synced after the snapshot is reset to snapshot state
+              so imap_sync only fetch changes since snapshot instead of full resync
+            existing user is not overridden
+            
+            return {'status':'OK', 'msg':{'imap':2, 'smtp':1, 'mailboxes':12}}
+        '''
+        
+        try:
+            with open(filename, 'r') as f:
+                snapshot = json.load(f)
+            
+            self.__imap_local_dir = snapshot.get('directory') or self.__imap_local_dir
+            self.imap_set_cache_codec(snapshot.get('cache_codec'), snapshot.get('cache_allow_pickle', False))
+            
+            for host, users in snapshot.get('imap', {}).items():
+                for username, imap_user in users.items():
+                    password = imap_user.get('password')
+                    if password is None and get_password:
+                        password = get_password('imap', host, username)
+                        
+                    self.__imap_entity.restore(host, username, password, imap_user.get('port'),
+                        imap_user.get('connection_type'), imap_user.get('keyfile'), imap_user.get('certfile'),
+                        timeout=imap_user.get('timeout'))
+            
+            for host, users in snapshot.get('smtp', {}).items():
+                for username, smtp_user in users.items():
+                    source_address = smtp_user.get('source_address')
+                    password = smtp_user.get('password')
+                    if password is None and get_password:
+                        password = get_password('smtp', host, username)
+                        
+                    self.__smtp_entity.restore(host, username, password, smtp_user.get('port'),
+                        smtp_user.get('local_hostname'), tuple(source_address) if source_address else None,
+                        smtp_user.get('connection_type'), smtp_user.get('keyfile'), smtp_user.get('certfile'),
+                        rcpt_limit=smtp_user.get('rcpt_limit', 100), timeout=smtp_user.get('timeout'))
+            
+            active = snapshot.get('imap_active') or {}
+            if self.__imap_entity.is_entity_exist(active.get('host'), active.get('username')):
+                self.__active_imap_user.update(active)
+                
+            active = snapshot.get('smtp_active') or {}
+            if self.__smtp_entity.get_all().get(active.get('host'), {}).get(active.get('username')):
+                self.__active_smtp_user.update(active)
+            
+            restored = 0
+            for mailbox_state in snapshot.get('mailboxes', []):
+                namespace = (mailbox_state.get('host'), mailbox_state.get('username'), mailbox_state.get('mailbox'))
+                dir_path = self.__imap_cache_dir(namespace[1], namespace[2])
+                if not os.path.isfile(dir_path + os.path.sep + '.flags'):
+                    continue
+                
+                # flags is only valid for sync state at the time of snapshot
+                state = mailbox_state.get('state') or {}
+                try:
+                    with open(dir_path + os.path.sep + '.syncstate', 'r') as f:
+                        current_state = json.load(f)
+                except Exception:
+                    current_state = {}
+                    
+                if current_state != state:
+                    self.__write_json(dir_path + os.path.sep + '.syncstate', state)
+                
+                self.__imap_snapshot_state[namespace] = state
+                self.__imap_flag_cache.restore(namespace,
+                    lambda flags_file=dir_path + os.path.sep + '.flags': self.__load_json(flags_file))
+                restored += 1
+            
+            return {'status':'OK', 'msg':{'imap':sum(len(users) for users in snapshot.get('imap', {}).values()),
+                'smtp':sum(len(users) for users in snapshot.get('smtp', {}).values()), 'mailboxes':restored}}
+            
+        except Exception as e:
+            print(e)
+            return {'status':'NO', 'msg':str(e)}
+            
+    def __write_json(self, filename, data, mode=None):
+        '''
+            write json file, replaced after written so reader never get partial file
+            mode = file permission, ex: 0o600 for file with password, default follow umask
+        '''
+        
+        dir_path = os.path.dirname(filename)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+            
+        temp_file = '%s.%d.tmp' % (filename, threading.get_ident())
+        if mode is None:
+            with open(temp_file, 'w') as f:
+                json.dump(data, f)
+        else:
+            # permission set before data written, left over temp file is also restricted
+            fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+            with os.fdopen(fd, 'w') as f:
+                if hasattr(os, 'fchmod'):
+                    os.fchmod(fd, mode)
+                json.dump(data, f)
+            
+        os.replace(temp_file, filename)
+        
+    def __load_json(self, filename):
+        '''
+            load json file, return None if failed
+        '''
+        
+        try:
+            with open(filename, 'r') as f:
+                return json.load(f)
+                
+        except Exception as e:
+            print(e)
+            
+        return None
+        
+    ####################################
+    ####### KEEPALIVE FUNCTIONALITY #####
+    ####################################
+    def keepalive_start(self, imap_idle_time=300, smtp_idle_time=60, interval=30):
+        '''
+            start background keepalive of pooled imap and smtp connection
+            idle connection unused for more than idle_time seconds is checked with NOOP
+            before server or network drop it, dead connection is closed
+            so pooled connection is reused instead of reconnect
+            
+            imap_idle_time = imap server autologout is at least 30 minutes but NAT and load balancer drop earlier
+            smtp_idle_time = smtp server timeout is usually 5 minutes
+            interval = seconds between each check
+        '''
+        
+        with self.__imap_lock:
+            self.__keepalive_idle_time.update({'imap':imap_idle_time, 'smtp':smtp_idle_time})
+            if self.__keepalive:
+                self.__keepalive.stop()
+                
+            self.__keepalive = KeepAlive(self.__get_keepalive_pools, interval)
+            self.__keepalive.start()
+            
+    def keepalive_stop(self, wait=True):
+        '''
+            stop background keepalive
+        '''
+        
+        with self.__imap_lock:
+            if self.__keepalive:
+                self.__keepalive.stop(wait)
+                self.__keepalive = None
+                
+    def keepalive_run(self):
+        '''
+            keepalive all pooled connection once
+            return {'checked':3, 'closed':1}
+        '''
+        
+        return KeepAlive(self.__get_keepalive_pools).run_pending()
+        
+    def __get_keepalive_pools(self):
+        with self.__imap_lock:
+            pools = [(pool, self.__keepalive_idle_time.get('imap')) for pool in self.__imap_pool.values()]
+            
+        with self.__smtp_lock:
+            pools += [(pool, self.__keepalive_idle_time.get('smtp')) for pool in self.__smtp_pool.values()]
+            
+        return pools
+        
+    def get_liveness(self):
+        '''
+            get liveness state of all connection without server round trip
+            {
+                'keepalive':True,
+                'imap':[{'host':'imap.gmail.com', 'username':'jhondoe@gmail.com', 'login':True, 'connected':True,
+                    'pool':{'size':3, 'idle':2, 'in_use':1, 'open':2, 'idle_time':[12.3, 60.1]}}],
+                'smtp':[...]
+            }
+            connected is socket state of user connection, see imap_get and smtp_get
+            pool is None if user has no connection pool
+        '''
+        
+        liveness = {'keepalive':self.__keepalive is not None and self.__keepalive.is_running(), 'imap':[], 'smtp':[]}
+        
+        for protocol, entity, pools in (('imap', self.__imap_entity, self.__imap_pool), ('smtp', self.__smtp_entity, self.__smtp_pool)):
+            for host, users in entity.get_all().items():
+                for username, user in users.items():
+                    # restored user is not connected until used
+                    connection = user.get(protocol)
+                    pool = pools.get((host, username))
+                    liveness.get(protocol).append({'host':host, 'username':username, 'login':user.get('is_login'),
+                        'connected':connection is not None and is_socket_open(connection.sock),
+                        'pool':pool.get_state() if pool else None})
+                    
+        return liveness
+        
     ####################################
     ####### IMAP4 FUNCTIONALITY #########
     ####################################
     def imap_add(self, host, username, password, port=imaplib.IMAP4_PORT,
-        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, ssl_context=None, force=False):
+        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, ssl_context=None, force=False, timeout=None):
         '''
             add imap user to __imap_user
             host = 'ex@mail.com'
@@ -56,13 +408,15 @@ class PxEmail(object):
             port = 143 (default is imap port or custom port depend on connection preference)
             force = False (default is false, to not override existing user), if exist will return false
                 True will force existing user with new configuration
+            timeout = socket timeout in seconds of connect and each blocking operation, None wait forever
+                also applied to pooled connection, per call limit is deadline parameter, ex: imap_get_search
                     
             connection_type = EntityFlag.CONNECTION_PLAIN (if connection using ssl, may need keyfile, certfile, ssl_context parameter)
                 value should be one of EntityFlag.CONNECTION_PLAIN|CONNECTION_SSL
         '''
         
         return self.__imap_entity.add(host, username, password, port,
-            connection_type, keyfile, certfile, ssl_context, force)
+            connection_type, keyfile, certfile, ssl_context, force, timeout)
     
     def imap_serialize(self, filename):
         '''
@@ -78,13 +432,15 @@ class PxEmail(object):
                 imap_entity_item = copy.copy(imap_entity.get(entity))
                 imap_entity_dump[entity] = {}
                 for imap_user in imap_entity_item:
-                    imap_entity_dump[entity][imap_user] = imap_entity_item.get(imap_user)
+                    imap_entity_dump[entity][imap_user] = dict(imap_entity_item.get(imap_user))
                     imap_entity_dump.get(entity).get(imap_user)['imap'] = None
             
             # serialize imap user         
-            Pickler(open(filename + '.imap.entity', 'wb'), protocol=pickle.HIGHEST_PROTOCOL).dump(imap_entity_dump)
+            with open(filename + '.imap.entity', 'wb') as f:
+                Pickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(imap_entity_dump)
             # serialize imap directory
-            Pickler(open(filename + '.imap.maildir', 'wb'), protocol=pickle.HIGHEST_PROTOCOL).dump(self.__imap_local_dir)
+            with open(filename + '.imap.maildir', 'wb') as f:
+                Pickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(self.__imap_local_dir)
         except Exception as e:
             print(e)
             
@@ -95,13 +451,107 @@ class PxEmail(object):
         '''
         
         try:
-            return {'entity':Unpickler(open(filename + '.imap.entity', 'rb')).load(),
-                'maildir':Unpickler(open(filename + '.imap.maildir', 'rb')).load()}
+            with open(filename + '.imap.entity', 'rb') as f:
+                entity = Unpickler(f).load()
+            with open(filename + '.imap.maildir', 'rb') as f:
+                maildir = Unpickler(f).load()
+                
+            return {'entity':entity, 'maildir':maildir}
         except Exception as e:
             print(e)
             
         return None
         
+    def imap_session(self, host, username, mailbox=None, readonly=False, pooled=False, timeout=None):
+        '''
+            create imap session for one imap user
+            session is PxEmail object sharing imap user, smtp user, cache and connection pool with this object
+            but has own imap connection, active user, selected mailbox and cache namespace
+            so each thread can work with own session without overwrite other thread active user
+            
+            mailbox = 'INBOX', if set mailbox will be selected after login
+            pooled = True will use connection from imap_get_pool, returned to pool on logout
+            timeout = seconds to wait for pooled connection, 0 only use spare connection
+            return None if imap user not exist, login failed or no pooled connection before timeout
+            
+            with pyemail.imap_session('imap.gmail.com', 'jhondoe@gmail.com', 'INBOX') as session:
+                session.imap_get_search('UNSEEN')
+        '''
+        
+        if not self.__imap_entity.is_entity_exist(host, username):
+            return None
+            
+        session = self.__create_session()
+        session.__active_imap_user = {'host':host, 'username':username, 'mailbox':None, 'is_login':False}
+        session.__active_smtp_user = dict(self.__active_smtp_user)
+        
+        if pooled:
+            imap = session.imap_get_pool().acquire(timeout)
+            if imap is None:
+                return None
+                
+            session.__imap_session = {'imap':imap, 'pool':session.imap_get_pool()}
+            session.__active_imap_user['is_login'] = True
+        else:
+            session.__imap_session = {'imap':self.__imap_entity.create_imap(host, username), 'pool':None}
+            if session.imap_login() != EntityFlag.SUCCESS_USER_LOGIN:
+                session.imap_logout()
+                return None
+        
+        if mailbox:
+            session.imap_mailbox_select(mailbox, readonly)
+            
+        return session
+        
+    def __create_session(self):
+        '''
+            create empty session object
+            share user, cache, index and pool with this object
+            active user, selected mailbox and connection are own state of the session
+            keepalive is owned by this object, not stopped or started from session
+        '''
+        
+        session = type(self).__new__(type(self))
+        
+        session.__imap_entity = self.__imap_entity
+        session.__smtp_entity = self.__smtp_entity
+        
+        session.__imap_local_dir = self.__imap_local_dir
+        session.__imap_flag_cache = self.__imap_flag_cache
+        session.__imap_pool = self.__imap_pool
+        session.__imap_index = self.__imap_index
+        session.__imap_cache_codec = self.__imap_cache_codec
+        session.__imap_cache_allow_pickle = self.__imap_cache_allow_pickle
+        session.__imap_snapshot_state = self.__imap_snapshot_state
+        session.__imap_batcher = self.__imap_batcher
+        session.__imap_batch_limit = self.__imap_batch_limit
+        session.__imap_backoff = self.__imap_backoff
+        session.__imap_retry = self.__imap_retry
+        session.__imap_prefetch = self.__imap_prefetch
+        session.__imap_prefetch_worker = self.__imap_prefetch_worker
+        session.__imap_lock = self.__imap_lock
+        session.__imap_tag = self.__imap_tag
+        
+        session.__smtp_pool = self.__smtp_pool
+        session.__smtp_lock = self.__smtp_lock
+        session.__smtp_spool = self.__smtp_spool
+        
+        session.__keepalive = None
+        session.__keepalive_idle_time = self.__keepalive_idle_time
+        
+        session.__active_imap_user = {'host':'', 'username':'', 'mailbox':None}
+        session.__active_smtp_user = {'host':'', 'username':''}
+        session.__imap_session = None
+        
+        return session
+        
+    def imap_is_session(self):
+        '''
+            check if this object is imap session created by imap_session(host, username)
+        '''
+        
+        return self.__imap_session is not None
+        
     def imap_get_user(self, host, username=None):
         '''
             get user imap configuration
@@ -120,6 +570,7 @@ class PxEmail(object):
         
         self.__active_imap_user['host'] = host
         self.__active_imap_user['username'] = username
+        self.__active_imap_user['mailbox'] = None
         
     def imap_get(self):
         '''
@@ -127,19 +578,29 @@ class PxEmail(object):
             depend on host and username selector
         '''
         
+        if self.__imap_session:
+            return self.__imap_session.get('imap')
+        
         host = self.imap_get_active().get('host')
         username = self.imap_get_active().get('username')
         return self.__imap_entity.get_imap(host, username)
         
-    def imap_is_connected(self):
+    def imap_is_connected(self, noop=True):
         '''
             check if conneected to server or not
             online or not
+            noop = False only check the socket without server round trip
         '''
         
-        try:
-            imap_get().noop()
+        imap = self.imap_get()
+        if imap is None or not is_socket_open(imap.sock):
+            return False
+            
+        if not noop:
             return True
+            
+        try:
+            return imap.noop()[0] == 'OK'
         except Exception:
             return False
             
@@ -156,6 +617,23 @@ class PxEmail(object):
         
         host = self.imap_get_active().get('host')
         username = self.imap_get_active().get('username')
+        
+        # imap session only renew own connection
+        if self.__imap_session:
+            mailbox = self.imap_get_active().get('mailbox')
+            
+            if self.__imap_session.get('pool'):
+                self.__imap_session['imap'] = self.__imap_session.get('pool').acquire()
+                self.__active_imap_user['is_login'] = True
+                if mailbox:
+                    self.imap_mailbox_select(mailbox, self.imap_get_active().get('readonly', False))
+                    
+                return EntityFlag.SUCCESS_USER_LOGIN
+            
+            # imap_login select the mailbox again
+            self.__imap_session['imap'] = self.__imap_entity.create_imap(host, username)
+            return self.imap_login()
+        
         imap_user = self.imap_get_user(host, username)
         
         self.imap_add(
@@ -167,7 +645,8 @@ class PxEmail(object):
             imap_user.get('keyfile'),
             imap_user.get('certfile'),
             imap_user.get('ssl_context'),
-            force=True)
+            force=True,
+            timeout=imap_user.get('timeout'))
             
         return self.imap_login()
         
@@ -185,6 +664,9 @@ class PxEmail(object):
             if already login return true
         '''
         
+        if self.__imap_session:
+            return self.imap_get_active().get('is_login')
+        
         host = self.imap_get_active().get('host')
         username = self.imap_get_active().get('username')
         return self.imap_get_user(host, username).get('is_login')
@@ -206,7 +688,17 @@ class PxEmail(object):
         if imap:
             try:
                 imap.login(username, password)
-                self.imap_get_user(host, username)['is_login'] = True
+                refresh_capabilities(imap)
+                if self.__imap_session:
+                    self.__active_imap_user['is_login'] = True
+                else:
+                    self.imap_get_user(host, username)['is_login'] = True
+                    
+                # reconnected or restored from snapshot, select the mailbox again
+                mailbox = self.imap_get_active().get('mailbox')
+                if mailbox:
+                    self.imap_mailbox_select(mailbox, self.imap_get_active().get('readonly', False))
+                    
                 return EntityFlag.SUCCESS_USER_LOGIN
                 
             except imaplib.IMAP4.error as e:
@@ -215,98 +707,1703 @@ class PxEmail(object):
             
         return EntityFlag.ERROR_USER_NOT_EXIST
         
-    def imap_logout(self):
+    def imap_logout(self):
+        '''
+            logout from specific imap object
+            return
+            EntityFlag.SUCCESS_USER_LOGOUT|EntityFlag.SUCCESS_USER_LOGOUT
+        '''
+        
+        if self.__imap_session:
+            return self.__imap_session_logout()
+        
+        try:
+            host = self.imap_get_active().get('host')
+            username = self.imap_get_active().get('username')
+            self.imap_get_user(host, username)['is_login'] = False
+            if self.imap_get().state == 'SELECTED':
+                self.imap_get().close()
+            self.imap_get().logout()
+            self.imap_get().shutdown()
+            return EntityFlag.SUCCESS_USER_LOGOUT
+        except Exception:
+            return EntityFlag.ERROR_USER_LOGOUT
+            
+    def __imap_session_logout(self):
+        '''
+            logout own connection of imap session
+            pooled connection returned to pool
+        '''
+        
+        imap = self.__imap_session.get('imap')
+        pool = self.__imap_session.get('pool')
+        is_login = self.__active_imap_user.get('is_login')
+        self.__active_imap_user['is_login'] = False
+        
+        if not imap:
+            return EntityFlag.ERROR_USER_LOGOUT
+        
+        self.__imap_session['imap'] = None
+        
+        if pool:
+            pool.release(imap, discard=not is_login)
+            return EntityFlag.SUCCESS_USER_LOGOUT
+        
+        try:
+            if imap.state == 'SELECTED':
+                imap.close()
+            imap.logout()
+            return EntityFlag.SUCCESS_USER_LOGOUT
+        except Exception:
+            return EntityFlag.ERROR_USER_LOGOUT
+        
+        
+    def imap_get_list(self):
+        '''
+            return list of mailbox list
+            directory default to top level
+            pattern default match to any
+        '''
+        
+        status, msg = self.imap_get().list()
+        
+        try:
+            msg = [mailbox.decode('UTF-8') for mailbox in msg]
+        except Exception as e:
+            print(e)
+        
+        return {'status':status, 'msg':msg}
+            
+    def imap_get_pool(self, max_size=None):
+        '''
+            get connection pool of current active user
+            pool is created on first call with max_size or 4 connection
+            max_size will grow existing pool if bigger than current max size
+        '''
+        
+        host = self.imap_get_active().get('host')
+        username = self.imap_get_active().get('username')
+        
+        with self.__imap_lock:
+            pool = self.__imap_pool.get((host, username))
+            if not pool:
+                pool = IMAPPool(self.__imap_entity, host, username, max_size or 4)
+                self.__imap_pool[(host, username)] = pool
+            elif max_size and pool.get_max_size() < max_size:
+                pool.set_max_size(max_size)
+        
+        return pool
+        
+    def imap_get_status(self, mailboxes=None):
+        '''
+            get STATUS (MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ) of mailboxes
+            mailboxes = ['INBOX', 'Sent'], default is all selectable mailbox
+            HIGHESTMODSEQ only if server support CONDSTORE
+            use single LIST-STATUS command if server support it
+            
+            return
+            {
+                'status':'OK',
+                'msg':{'INBOX':{'MESSAGES':231, 'UIDNEXT':44292, 'UIDVALIDITY':1, 'HIGHESTMODSEQ':90060}}
+            }
+        '''
+        
+        imap = self.imap_get()
+        items = 'MESSAGES UIDNEXT UIDVALIDITY'
+        if 'CONDSTORE' in imap.capabilities:
+            items += ' HIGHESTMODSEQ'
+        
+        if mailboxes is None and 'LIST-STATUS' in imap.capabilities:
+            status, msg = imap.list('""', '* RETURN (STATUS (' + items + '))')
+            if status.lower() != 'ok':
+                return {'status':status, 'msg':msg}
+                
+            return {'status':status, 'msg':parse_status_response(imap.response('STATUS')[1])}
+        
+        if mailboxes is None:
+            status, msg = imap.list()
+            if status.lower() != 'ok':
+                return {'status':status, 'msg':msg}
+                
+            mailboxes = [mailbox.get('name') for mailbox in parse_list_response(msg)
+                if not set(flag.lower() for flag in mailbox.get('flags')) & set(['\\noselect', '\\nonexistent'])]
+        
+        mailbox_status = {}
+        for mailbox in mailboxes:
+            status, msg = imap.status(quote_mailbox(mailbox), '(' + items + ')')
+            if status.lower() == 'ok':
+                mailbox_status.update(parse_status_response(msg))
+        
+        return {'status':'OK', 'msg':mailbox_status}
+        
+    def imap_get_sync_state(self, mailbox=None):
+        '''
+            get last synced STATUS of mailbox from local cache
+            return empty dictionary if mailbox never synced
+        '''
+        
+        try:
+            with open(self.imap_get_cache_dir(mailbox) + os.path.sep + '.syncstate', 'r') as f:
+                return json.load(f)
+                
+        except Exception:
+            return {}
+        
+    def imap_set_sync_state(self, state, mailbox=None):
+        '''
+            save synced STATUS of mailbox to local cache
+        '''
+        
+        self.__write_json(self.imap_get_cache_dir(mailbox) + os.path.sep + '.syncstate', state)
+            
+    def imap_get_cached_ids(self, mailbox=None):
+        '''
+            get list of cached email_id in mailbox
+        '''
+        
+        dir_path = self.imap_get_cache_dir(mailbox)
+        if not os.path.isdir(dir_path):
+            return []
+            
+        return [email_id for email_id in os.listdir(dir_path) if email_id.isdigit()]
+        
+    def imap_get_dedupe_index(self):
+        '''
+            get cross mailbox duplicate email index of current active user
+            index saved in local cache directory of user as .dedupe.db
+        '''
+        
+        return self.__imap_get_index(DedupeIndex, self.imap_get_cache_dir('') + os.path.sep + '.dedupe.db')
+        
+    def imap_get_address_index(self):
+        '''
+            get address index of current active user
+            index saved in local cache directory of user as .address.db, updated by imap_sync
+        '''
+        
+        return self.__imap_get_index(AddressIndex, self.imap_get_cache_dir('') + os.path.sep + '.address.db')
+        
+    def __imap_get_index(self, index_class, filename):
+        '''
+            get index object saved as filename
+            created on first call and shared with imap session
+        '''
+        
+        with self.__imap_lock:
+            index = self.__imap_index.get(filename)
+            if not index:
+                index = index_class(filename)
+                self.__imap_index[filename] = index
+        
+        return index
+        
+    def imap_get_thread_index(self, mailbox=None):
+        '''
+            get conversation thread index of mailbox
+            index saved beside cached email as .threadindex, updated by imap_sync
+            mailbox default is selected mailbox
+        '''
+        
+        if mailbox is None:
+            mailbox = self.imap_get_active().get('mailbox')
+            
+        dir_path = self.imap_get_cache_dir(mailbox)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+            
+        return self.__imap_get_index(ThreadIndex, dir_path + os.path.sep + '.threadindex')
+        
+    def imap_search_address(self, address=None, domain=None, mailbox=None, fields=None):
+        '''
+            search email from/to address or domain in local address index without server round trip
+            address = 'jhon@mail.com' or domain = 'mail.com'
+            mailbox = only search in mailbox, default all synced mailbox
+            fields = ['from', 'to', 'cc', 'bcc', 'delivered_to'], default all
+            
+            return {'status':'OK', 'msg':{'INBOX':['30411', '30415'], 'Sent':['120']}}
+        '''
+        
+        return {'status':'OK', 'msg':self.imap_get_address_index().search(address, domain, mailbox, fields)}
+        
+    def imap_get_top_correspondents(self, limit=10, fields=None, mailbox=None, domain=False):
+        '''
+            get address with most email from local address index
+            fields = ['from'] for top sender, ['to', 'cc'] for top recipient, default all
+            domain = True will aggregate by domain
+            
+            return {'status':'OK', 'msg':[{'address':'jhon@mail.com', 'name':'Jhon', 'count':120, 'last_date':timestamp}]}
+        '''
+        
+        return {'status':'OK', 'msg':self.imap_get_address_index().get_top(limit, fields, mailbox, domain)}
+        
+    def imap_autocomplete_address(self, prefix, limit=10):
+        '''
+            get contact which address or name start with prefix from local address index, most used first
+            
+            return {'status':'OK', 'msg':[{'address':'jhon@mail.com', 'name':'Jhon Doe', 'count':120}]}
+        '''
+        
+        return {'status':'OK', 'msg':self.imap_get_address_index().autocomplete(prefix, limit)}
+        
+    def imap_get_threads(self, use_server=True):
+        '''
+            get conversation thread of selected mailbox, newest thread first
+            use server THREAD=REFERENCES extension if available and use_server is True
+            otherwise use local thread index built by imap_sync
+            
+            return
+            {
+                'status':'OK',
+                'msg':[{'uid':'30411', 'children':[{'uid':'30415', 'children':[]}]}]
+            }
+        '''
+        
+        imap = self.imap_get()
+        if use_server and 'THREAD=REFERENCES' in imap.capabilities:
+            status, msg = imap.uid('THREAD', 'REFERENCES', 'UTF-8', 'ALL')
+            if status.lower() == 'ok':
+                threads = parse_thread_response(msg)
+                threads.reverse()
+                return {'status':status, 'msg':threads}
+        
+        return {'status':'OK', 'msg':self.imap_get_thread_index().get_threads()}
+        
+    def imap_get_sort(self, criteria='(REVERSE DATE)', *criterion):
+        '''
+            get email_id of selected mailbox sorted by criteria
+            use server SORT extension if available
+            otherwise only (DATE) or (REVERSE DATE) of all email sorted from local thread index
+            *criterion is search criterion, default is ALL
+        '''
+        
+        criterion = criterion or ('ALL',)
+        imap = self.imap_get()
+        if 'SORT' in imap.capabilities:
+            status, msg = imap.uid('SORT', criteria, 'UTF-8', *criterion)
+            email_ids = (msg[0] or b'').decode('UTF-8').split() if status.lower() == 'ok' else msg
+            return {'status':status, 'msg':email_ids}
+        
+        if criterion != ('ALL',) or criteria.upper() not in ('(DATE)', '(REVERSE DATE)'):
+            return {'status':'NO', 'msg':['SORT not supported by server']}
+            
+        return {'status':'OK', 'msg':self.imap_get_thread_index().get_sorted('REVERSE' in criteria.upper())}
+        
+    def __imap_link_duplicate(self, email_id, mailbox=None):
+        '''
+            link cached body of same email (Message-ID and size) from other mailbox or email_id
+            inline attachment file is hard linked
+            return linked email data or None if no duplicate
+        '''
+        
+        if mailbox is None:
+            mailbox = self.imap_get_active().get('mailbox')
+        
+        index = self.imap_get_dedupe_index()
+        indexed = index.get(mailbox, email_id)
+        if not indexed:
+            return None
+            
+        source = index.find(indexed.get('message_id'), indexed.get('size'), mailbox, email_id)
+        if not source:
+            return None
+            
+        source_data = self.imap_unserialize_email_from_file(source.get('uid'), source.get('mailbox'))
+        if not isinstance(source_data, dict) or source_data.get('Message') is None:
+            return None
+            
+        email_data = self.imap_unserialize_email_from_file(email_id, mailbox)
+        if not isinstance(email_data, dict):
+            email_data = dict(source_data)
+            
+        src_dir = self.imap_get_cache_dir(source.get('mailbox')) + os.path.sep + source.get('uid')
+        dest_dir = self.imap_init_serialize_dir(email_id, mailbox)
+        
+        for attachment in source_data.get('InlineAttachment') or []:
+            src_file = src_dir + os.path.sep + attachment.get('name')
+            dest_file = dest_dir + os.path.sep + attachment.get('name')
+            if not os.path.exists(src_file) or os.path.exists(dest_file):
+                continue
+                
+            try:
+                os.link(src_file, dest_file)
+            except OSError:
+                shutil.copyfile(src_file, dest_file)
+        
+        for key in ('Message', 'Attachment', 'InlineAttachment', 'BodyHash'):
+            email_data[key] = source_data.get(key)
+            
+        email_data['ID'] = email_id
+        self.imap_serialize_email_to_file(email_data, mailbox)
+        index.set_body_hash(mailbox, email_id, source.get('body_hash'))
+        
+        return email_data
+        
+    def imap_sync(self, mailboxes=None, max_workers=4, batch_size=100, gmail=False):
+        '''
+            sync header and flags of mailboxes to local cache
+            mailboxes = ['INBOX', 'Sent'], default is all selectable mailbox
+            throttled or dropped mailbox sync is retried with backoff from last completed email, see imap_call
+            batch_size = initial number of email in one FETCH, adapted to server, see imap_set_batch_limit
+            
+            STATUS of all mailbox compared with last synced state
+            unchanged mailbox is skipped
+            changed mailbox synced concurrently using max_workers pooled connection
+            
+            gmail = True and server is gmail (X-GM-EXT-1), only [Gmail]/All Mail is synced
+            same email in many label folder is downloaded once
+            label of each email taken from X-GM-LABELS, see imap_gmail_get_label
+            
+            return
+            {
+                'status':'OK',
+                'msg':{
+                    'synced':['INBOX'],
+                    'skipped':['Sent', 'Trash'],
+                    'failed':{'Spam':'error message'}
+                }
+            }
+        '''
+        
+        all_mail = None
+        if gmail and self.imap_is_gmail():
+            all_mail = self.imap_gmail_get_all_mail()
+            mailboxes = [all_mail]
+        
+        mailbox_status = self.imap_get_status(mailboxes)
+        if mailbox_status.get('status').lower() != 'ok':
+            return mailbox_status
+        
+        changed = []
+        skipped = []
+        for mailbox, status in mailbox_status.get('msg').items():
+            if self.imap_get_sync_state(mailbox) == status:
+                skipped.append(mailbox)
+            else:
+                changed.append(mailbox)
+        
+        synced = []
+        failed = {}
+        if changed:
+            self.imap_get_pool(max_workers)
+            
+            def sync_mailbox(mailbox):
+                # throttled or dropped sync continue from last completed batch
+                session = self.imap_session(self.imap_get_active().get('host'), self.imap_get_active().get('username'), pooled=True)
+                if session is None:
+                    raise imaplib.IMAP4.error('no imap connection for ' + mailbox)
+                    
+                try:
+                    session.imap_call(lambda: session.__imap_sync_mailbox(session.imap_get(), mailbox,
+                        mailbox_status.get('msg').get(mailbox), batch_size, mailbox == all_mail))
+                finally:
+                    session.imap_logout()
+            
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(changed))) as executor:
+                futures = dict((mailbox, executor.submit(sync_mailbox, mailbox)) for mailbox in changed)
+                
+            for mailbox, future in futures.items():
+                try:
+                    future.result()
+                    synced.append(mailbox)
+                except Exception as e:
+                    failed[mailbox] = str(e)
+        
+        return {'status':'OK', 'msg':{'synced':synced, 'skipped':skipped, 'failed':failed}}
+        
+    def __imap_sync_mailbox(self, imap, mailbox, mailbox_status, batch_size, gmail=False):
+        '''
+            sync one mailbox using given imap object
+            - reset cache if UIDVALIDITY changed
+            - fetch header of new email (UID >= last UIDNEXT)
+            - update flags changed since last HIGHESTMODSEQ (CONDSTORE) or all flags
+            - remove expunged email from cache
+            last completed email saved as .synccheckpoint after each batch, so failed sync continue from it
+            
+            gmail = True also sync X-GM-MSGID and X-GM-LABELS into gmail index
+            cached email with known X-GM-MSGID is relinked to new email_id instead of fetched again
+        '''
+        
+        status, msg = imap.select(quote_mailbox(mailbox), True)
+        if status.lower() != 'ok':
+            raise imaplib.IMAP4.error(msg)
+        
+        host = self.imap_get_active().get('host')
+        username = self.imap_get_active().get('username')
+        namespace = (host, username, mailbox)
+        state = self.imap_get_sync_state(mailbox)
+        gmail_index = self.imap_gmail_get_index(mailbox) if gmail else None
+        stale_dir = self.imap_get_cache_dir(mailbox) + '.stale'
+        
+        if state and state.get('UIDVALIDITY') != mailbox_status.get('UIDVALIDITY'):
+            # email_id is not valid anymore
+            if gmail:
+                # keep cached email to be relinked by X-GM-MSGID
+                shutil.rmtree(stale_dir, ignore_errors=True)
+                if os.path.isdir(self.imap_get_cache_dir(mailbox)):
+                    os.rename(self.imap_get_cache_dir(mailbox), stale_dir)
+                    
+                for message in gmail_index.values():
+                    message['stale'] = True
+            else:
+                shutil.rmtree(self.imap_get_cache_dir(mailbox), ignore_errors=True)
+                
+            self.__imap_flag_cache.remove(namespace)
+            self.imap_get_dedupe_index().remove(mailbox)
+            self.imap_get_address_index().remove(mailbox)
+            self.imap_get_thread_index(mailbox).clear()
+            state = {}
+        
+        uidnext = state.get('UIDNEXT', 1)
+        checkpoint_file = self.imap_get_cache_dir(mailbox) + os.path.sep + '.synccheckpoint'
+        checkpoint = self.__load_json(checkpoint_file) if os.path.isfile(checkpoint_file) else None
+        if not checkpoint or checkpoint.get('UIDVALIDITY') != mailbox_status.get('UIDVALIDITY'):
+            checkpoint = {'UIDVALIDITY':mailbox_status.get('UIDVALIDITY'), 'UID':0}
+            
+        parser = get_parser(imap)
+        thread_index = self.imap_get_thread_index(mailbox)
+        flag_fields = '(UID FLAGS X-GM-MSGID X-GM-THRID X-GM-LABELS)' if gmail else '(UID FLAGS)'
+        
+        # flags of already synced email
+        if state and uidnext > 1:
+            modifiers = None
+            if state.get('HIGHESTMODSEQ') and mailbox_status.get('HIGHESTMODSEQ'):
+                modifiers = '(CHANGEDSINCE %d)' % state.get('HIGHESTMODSEQ')
+                
+            for fetch_item in parser.fetch('1:%d' % (uidnext - 1), flag_fields, modifiers):
+                self.__imap_flag_cache.update_from_fetch(namespace, [fetch_item])
+                if gmail:
+                    self.__imap_gmail_update_index(gmail_index, fetch_item)
+        
+        # new email, n:* always return last email even if uid < n
+        # email until checkpoint already synced by previous failed sync
+        email_ids = sorted((email_id for email_id in parser.search('UID', '%d:*' % uidnext)
+            if int(email_id) >= uidnext and int(email_id) > checkpoint.get('UID')), key=int)
+        
+        batcher = self.imap_get_batcher('(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER])', batch_size)
+        for batch in batcher.batches(email_ids):
+            last_uid = int(batch[-1])
+            if gmail:
+                batch = self.__imap_gmail_relink(parser, namespace, mailbox, gmail_index, batch, stale_dir)
+                if not batch:
+                    continue
+                
+            indexed = []
+            addresses = []
+            for fetch_item in self.__imap_fetch_adaptive(parser, batch, '(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER])', batcher):
+                self.__imap_flag_cache.update_from_fetch(namespace, [fetch_item])
+                
+                if fetch_item.get('UID') and fetch_item.get('BODY[HEADER]') is not None:
+                    parsed_header = HeaderParser().parsestr(decode_literal(fetch_item.get('BODY[HEADER]')))
+                    email_data = self.imap_build_header(fetch_item.get('UID'), parsed_header, fetch_item.get('RFC822.SIZE'))
+                    self.imap_serialize_email_to_file(email_data, mailbox)
+                    indexed.append((email_data.get('ID'), email_data.get('MessageID'), email_data.get('Size')))
+                    
+                    thread_index.add(email_data.get('ID'), email_data.get('MessageID'), email_data.get('InReplyTo'),
+                        email_data.get('References'), email_data.get('Subject'), email_data.get('Date'))
+                    
+                    addresses.append((email_data.get('ID'), {'from':email_data.get('From'), 'to':email_data.get('To'),
+                        'cc':email_data.get('CC'), 'bcc':email_data.get('BCC'),
+                        'delivered_to':', '.join(parsed_header.get_all('Delivered-To') or [])}, parse_date(email_data.get('Date'))))
+            
+            self.imap_get_address_index().add_many(mailbox, addresses)
+            
+            # same email already cached in other mailbox, link the body instead of fetch it later
+            dedupe_index = self.imap_get_dedupe_index()
+            dedupe_index.add_many(mailbox, indexed)
+            for email_id, message_id, size in indexed:
+                if dedupe_index.find(message_id, size, mailbox, email_id):
+                    self.__imap_link_duplicate(email_id, mailbox)
+                    
+            checkpoint['UID'] = last_uid
+            self.__write_json(checkpoint_file, checkpoint)
+        
+        if gmail:
+            # stale email not found by X-GM-MSGID is deleted
+            shutil.rmtree(stale_dir, ignore_errors=True)
+            for msgid in [msgid for msgid, message in gmail_index.items() if message.get('stale')]:
+                del gmail_index[msgid]
+        
+        # remove expunged email
+        cached_ids = self.imap_get_cached_ids(mailbox)
+        if len(cached_ids) != mailbox_status.get('MESSAGES'):
+            server_ids = set(parser.search('ALL'))
+            expunged = [email_id for email_id in cached_ids if email_id not in server_ids]
+            
+            for email_id in expunged:
+                shutil.rmtree(self.imap_get_cache_dir(mailbox) + os.path.sep + email_id, ignore_errors=True)
+                
+            self.__imap_flag_cache.remove(namespace, expunged)
+            self.imap_get_dedupe_index().remove(mailbox, expunged)
+            self.imap_get_address_index().remove(mailbox, expunged)
+            thread_index.remove(expunged)
+            
+            if gmail:
+                expunged = set(expunged)
+                for msgid in [msgid for msgid, message in gmail_index.items() if message.get('uid') in expunged]:
+                    del gmail_index[msgid]
+        
+        if gmail:
+            self.imap_gmail_set_index(gmail_index, mailbox)
+            
+        thread_index.save()
+        self.imap_set_sync_state(mailbox_status, mailbox)
+        
+        if os.path.isfile(checkpoint_file):
+            os.remove(checkpoint_file)
+        
+    def imap_is_gmail(self):
+        '''
+            check if server support gmail imap extension (X-GM-EXT-1)
+        '''
+        
+        return 'X-GM-EXT-1' in self.imap_get().capabilities
+        
+    def imap_gmail_get_all_mail(self):
+        '''
+            get name of gmail All Mail mailbox
+            mailbox with \\All special use flag, default is [Gmail]/All Mail
+        '''
+        
+        status, msg = self.imap_get().list()
+        if status.lower() == 'ok':
+            for mailbox in parse_list_response(msg):
+                if '\\all' in [flag.lower() for flag in mailbox.get('flags')]:
+                    return mailbox.get('name')
+        
+        return '[Gmail]/All Mail'
+        
+    def imap_gmail_get_index(self, mailbox='[Gmail]/All Mail'):
+        '''
+            get gmail index of synced All Mail from local cache
+            return dictionary of X-GM-MSGID
+            {
+                '1278455344230334865':{'uid':'30411', 'thread':'1278455344230334865', 'labels':['\\Inbox', 'Work']}
+            }
+        '''
+        
+        try:
+            with open(self.imap_get_cache_dir(mailbox) + os.path.sep + '.gmindex', 'r') as f:
+                return json.load(f)
+                
+        except Exception:
+            return {}
+        
+    def imap_gmail_set_index(self, gmail_index, mailbox='[Gmail]/All Mail'):
+        '''
+            save gmail index to local cache
+        '''
+        
+        self.__write_json(self.imap_get_cache_dir(mailbox) + os.path.sep + '.gmindex', gmail_index)
+        
+    def imap_gmail_get_label(self, label, mailbox='[Gmail]/All Mail'):
+        '''
+            get email_id of All Mail with gmail label from local gmail index
+            label = '\\Inbox', '\\Sent', '\\Starred' or user label 'Work'
+            cached email can be read from All Mail cache without selecting label folder
+        '''
+        
+        return sorted((message.get('uid') for message in self.imap_gmail_get_index(mailbox).values()
+            if label in message.get('labels')), key=int)
+        
+    def __imap_gmail_update_index(self, gmail_index, fetch_item):
+        '''
+            update gmail index from fetch item with X-GM-MSGID and X-GM-LABELS
+        '''
+        
+        msgid = fetch_item.get('X-GM-MSGID')
+        if not msgid or not fetch_item.get('UID'):
+            return
+            
+        labels = [label if isinstance(label, str) else decode_literal(label) for label in fetch_item.get('X-GM-LABELS') or []]
+        message = gmail_index.setdefault(msgid, {})
+        message['labels'] = labels
+        message['thread'] = fetch_item.get('X-GM-THRID')
+        
+        # new email_id of known message is set by __imap_gmail_relink
+        if message.get('uid') is None:
+            message['uid'] = fetch_item.get('UID')
+        
+    def __imap_gmail_relink(self, parser, namespace, mailbox, gmail_index, batch, stale_dir):
+        '''
+            fetch X-GM-MSGID and X-GM-LABELS of new email
+            email already cached with other email_id (ex: after UIDVALIDITY changed) is relinked
+            return email_id which header need to be fetched
+        '''
+        
+        fetch_ids = []
+        for fetch_item in parser.fetch(batch, '(UID FLAGS X-GM-MSGID X-GM-THRID X-GM-LABELS)'):
+            email_id = fetch_item.get('UID')
+            if not email_id:
+                continue
+                
+            self.__imap_flag_cache.update_from_fetch(namespace, [fetch_item])
+            
+            message = gmail_index.get(fetch_item.get('X-GM-MSGID'), {})
+            src_id = message.get('uid')
+            stale = message.pop('stale', False)
+            src_dir = (stale_dir if stale else self.imap_get_cache_dir(mailbox)) + os.path.sep + str(src_id)
+            
+            if src_id is not None and ((src_id == email_id and not stale) or self.__imap_relink_cache(src_dir, src_id, email_id, mailbox)):
+                message['uid'] = email_id
+            else:
+                message['uid'] = None
+                fetch_ids.append(email_id)
+                
+            self.__imap_gmail_update_index(gmail_index, fetch_item)
+        
+        return fetch_ids
+        
+    def imap_mailbox_select(self, mailbox='INBOX', readonly=False):
+        '''
+            select mailbox from imap object
+            default is INBOX
+        '''
+            
+        status, msg = self.imap_get().select(quote_mailbox(mailbox), readonly)
+        
+        if status.lower() == 'ok':
+            self.__active_imap_user['mailbox'] = unquote_mailbox(mailbox)
+            self.__active_imap_user['readonly'] = readonly
+        
+        return {'status':status, 'msg':msg}
+        
+    def imap_get_namespace(self):
+        '''
+            get namespace of current active user and selected mailbox
+            return tuple of (host, username, mailbox)
+        '''
+        
+        active = self.imap_get_active()
+        return (active.get('host'), active.get('username'), active.get('mailbox'))
+    
+    def imap_get_search(self, *criterion, deadline=None):
+        '''
+            do search in imap
+            get email from imap object
+            *criterion is for search criterion ex: 'FROM', '"LDJ"' or '(FROM "LDJ")'
+            deadline = seconds or Deadline object, return {'status':'TIMEOUT', 'msg':[]} when exceeded
+                connection is closed if response not completed, see imap_call
+        '''
+        
+        # search result of huge mailbox is one very long line, read by parser without line limit
+        try:
+            return {'status':'OK', 'msg':self.__imap_run_deadline(Deadline.get(deadline),
+                get_parser(self.imap_get()).search, *criterion)}
+            
+        except DeadlineExceeded:
+            return {'status':'TIMEOUT', 'msg':[]}
+            
+        except imaplib.IMAP4.abort:
+            raise
+            
+        except imaplib.IMAP4.error as e:
+            return {'status':'NO', 'msg':[str(e)]}
+        
+    def __imap_run_deadline(self, deadline, operation, *args):
+        '''
+            run operation with socket timeout limited by remaining time of deadline
+            connection timed out in the middle of response can't be used again, it is closed
+            raise DeadlineExceeded
+        '''
+        
+        if deadline is None:
+            return operation(*args)
+        
+        imap = self.imap_get()
+        try:
+            with deadline.apply(imap.sock):
+                return operation(*args)
+                
+        except DeadlineExceeded as e:
+            # expired before command is sent, connection still usable
+            if e.__cause__ is not None:
+                self.__imap_close_timeout(imap)
+                
+            raise
+            
+    def __imap_close_timeout(self, imap):
+        '''
+            close connection left in unknown state by timeout
+            pooled connection is discarded on logout, imap_reconnect or imap_call connect again
+        '''
+        
+        if self.__imap_session:
+            self.__active_imap_user['is_login'] = False
+        else:
+            host = self.imap_get_active().get('host')
+            username = self.imap_get_active().get('username')
+            self.imap_get_user(host, username)['is_login'] = False
+        
+        try:
+            imap.shutdown()
+        except Exception:
+            pass
+        
+    def imap_get_fetch(self, email_id, *criterion, deadline=None):
+        '''
+            do fetch email information
+            for specific email_id
+            deadline = seconds or Deadline object, return {'status':'TIMEOUT', 'msg':[]} when exceeded
+        '''
+        
+        try:
+            status, msg = self.__imap_run_deadline(Deadline.get(deadline), self.imap_get().uid, 'fetch', email_id, *criterion)
+            
+        except DeadlineExceeded:
+            return {'status':'TIMEOUT', 'msg':[]}
+        
+        return {'status':status, 'msg':msg}
+        
+    def imap_iter_messages(self, email_filter, fields='(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER])', batch_size=100, prefetch=2, deadline=None):
+        '''
+            search then fetch email as generator
+            email_filter = EmailFilter object or search criterion string
+            fields = fetch item, default is header only, use '(UID FLAGS RFC822.SIZE BODY.PEEK[])' for full message
+            batch_size = initial number of email fetched in one FETCH command
+                adapted to measured latency and bytes, see imap_set_batch_limit
+                full message fetch is packed by RFC822.SIZE
+            prefetch = number of batch fetched in background while caller process current batch
+            deadline = seconds or Deadline object of the whole listing
+                DeadlineExceeded is raised after yielding completed batch, its continuation is sequence set
+                of email not yielded yet, continue with email_filter 'UID ' + continuation
+
+            yield parsed email
+            {
+                'ID':'30411',
+                'Flags':['\\Seen'],
+                'Size':1234,
+                'Email':email.message.Message,
+                'Fetch':{fetch item}
+            }
+
+            imap object is used by background fetch until generator exhausted or closed
+            don't use the same imap object while iterating
+        '''
+
+        yield from self.__imap_iter_fetch(email_filter, fields, batch_size, prefetch, self.imap_parse_fetch_item,
+            not is_body_fetch(fields), deadline)
+
+    def imap_iter_records(self, email_filter, batch_size=500, prefetch=2, deadline=None):
+        '''
+            search then fetch listing header as generator of compact MessageRecord
+            only From, To, CC, BCC, Subject, Date, Message-ID, In-Reply-To and References is fetched
+            header value decoded on first access, ex: record.get('Subject')
+            use for big listing instead of imap_iter_messages, see imap_save_records
+            deadline = seconds or Deadline object, see imap_iter_messages
+        '''
+
+        yield from self.__imap_iter_fetch(email_filter, FETCH_FIELDS, batch_size, prefetch, MessageRecord.from_fetch, True, deadline)
+
+    def imap_save_records(self, records, mailbox=None):
+        '''
+            save listing records into local cache of mailbox as compact binary .records file
+        '''
+
+        dir_path = self.imap_get_cache_dir(mailbox)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+        with open(dir_path + os.path.sep + '.records', 'wb') as f:
+            write_records(records, f)
+
+    def imap_load_records(self, mailbox=None):
+        '''
+            load listing records saved by imap_save_records
+            return empty list if not exist
+        '''
+
+        try:
+            with open(self.imap_get_cache_dir(mailbox) + os.path.sep + '.records', 'rb') as f:
+                return read_records(f)
+
+        except OSError:
+            return []
+
+    def __imap_iter_fetch(self, email_filter, fields, batch_size, prefetch, convert, listing=False, deadline=None):
+        '''
+            search then fetch in batch using background thread
+            yield convert(fetch_item) of each email
+            listing = True if only header is fetched, listed email body is prefetched, see imap_set_prefetch
+            deadline = Deadline, raise DeadlineExceeded with sequence set of email not yielded
+        '''
+
+        if isinstance(email_filter, EmailFilter):
+            email_filter = email_filter.generate()
+
+        deadline = Deadline.get(deadline)
+        search = self.imap_get_search(email_filter, deadline=deadline)
+        if search.get('status').lower() == 'timeout':
+            raise DeadlineExceeded('deadline exceeded: search not completed')
+            
+        if search.get('status').lower() != 'ok':
+            return
+
+        # keep uid as compact integer array for huge search result
+        email_ids = array('L', (int(email_id) for email_id in search.get('msg')))
+
+        parser = get_parser(self.imap_get())
+        namespace = self.imap_get_namespace()
+        batcher = self.imap_get_batcher(fields, batch_size)
+        batch_queue = queue.Queue(maxsize=max(prefetch, 1))
+        stop_event = threading.Event()
+
+        def put_batch(item):
+            # block when queue is full until caller consume previous batch
+            while not stop_event.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def fetch_batch():
+            try:
+                def fetch_sizes(chunk):
+                    email_sizes = dict((fetch_item.get('UID'), int(fetch_item.get('RFC822.SIZE')))
+                        for fetch_item in self.__imap_run_deadline(deadline, list, parser.fetch(chunk, '(UID RFC822.SIZE)'))
+                        if fetch_item.get('RFC822.SIZE'))
+                    return [email_sizes.get(str(email_id), 0) for email_id in chunk]
+
+                # size of each email, so batch of full message packed by size
+                # fetched by batcher chunk by chunk ahead of the next batch, not for the whole search result
+                sizes = fetch_sizes if is_body_fetch(fields) else None
+
+                for batch in batcher.batches(email_ids, sizes):
+                    if stop_event.is_set():
+                        return
+
+                    fetched = self.__imap_run_deadline(deadline, self.__imap_fetch_adaptive,
+                        parser, batch, fields, batcher, sizes is not None)
+                    self.__imap_flag_cache.update_from_fetch(namespace, fetched)
+                    put_batch((len(batch), fetched))
+
+                put_batch(None)
+
+            except Exception as e:
+                put_batch(e)
+
+        fetcher = threading.Thread(target=fetch_batch, daemon=True)
+        fetcher.start()
+
+        # email_id and size of listed email
+        listed = {}
+        # number of email_id in yielded batch, the rest is continuation of deadline
+        done = 0
+        completed = False
+
+        try:
+            while True:
+                fetched = batch_queue.get()
+                if fetched is None:
+                    completed = True
+                    break
+
+                if isinstance(fetched, DeadlineExceeded):
+                    raise DeadlineExceeded(str(fetched), uid_set(email_ids[done:]) or None) from fetched
+
+                if isinstance(fetched, Exception):
+                    raise fetched
+
+                count, fetched = fetched
+                done += count
+                for fetch_item in fetched:
+                    if not fetch_item.get('UID'):
+                        # unsolicited fetch response, ex: flags update from other client
+                        continue
+
+                    if listing:
+                        size = fetch_item.get('RFC822.SIZE')
+                        listed[fetch_item.get('UID')] = int(size) if size is not None else None
+
+                    yield convert(fetch_item)
+        finally:
+            stop_event.set()
+            fetcher.join()
+
+        # listing stopped by deadline, error or caller is not prefetched
+        if completed and listed and self.__imap_prefetch.get('count'):
+            try:
+                self.imap_prefetch(list(listed), namespace[2], listed)
+            except Exception as e:
+                print(e)
+
+    def imap_set_prefetch(self, count=10, max_size=1048576, unseen_first=True):
+        '''
+            enable predictive prefetch of email body after header listing
+            after imap_iter_messages or imap_iter_records the newest listed email is fetched
+            in background into local cache, so imap_get_fetch_content of them is served from cache
+            count = maximum email prefetched after each listing, 0 disable prefetch
+            max_size = email bigger than max_size bytes (RFC822.SIZE) is not prefetched
+            unseen_first = prefetch unread email before newest read email
+        '''
+
+        self.__imap_prefetch.update({'count':max(count, 0), 'max_size':max_size, 'unseen_first':unseen_first})
+        if not count:
+            self.imap_prefetch_cancel(all_users=True)
+
+    def imap_prefetch(self, email_ids, mailbox=None, sizes=None):
+        '''
+            fetch body of email_ids into local cache in background
+            prefetch run at low priority using spare pooled connection (see imap_get_pool), mailbox is examined
+            so email is not marked as seen, prefetch is skipped when no spare connection
+            and stopped when foreground thread wait for pooled connection
+            previous prefetch of the same user is cancelled
+
+            email_ids = candidate email_id, newest or unread email is choosen by the worker, see imap_set_prefetch
+            sizes = {email_id:RFC822.SIZE}, if not set size is taken from cached header
+            return True if prefetch worker started
+        '''
+
+        if not self.__imap_prefetch.get('count'):
+            return False
+
+        active = self.imap_get_active()
+        host = active.get('host')
+        username = active.get('username')
+        mailbox = mailbox or active.get('mailbox')
+        if not mailbox or not email_ids:
+            return False
+
+        self.imap_prefetch_cancel()
+
+        cancel = threading.Event()
+        worker = threading.Thread(target=self.__imap_prefetch_run,
+            args=(host, username, mailbox, list(email_ids), dict(sizes or {}), cancel), daemon=True)
+        with self.__imap_lock:
+            self.__imap_prefetch_worker[(host, username)] = {'thread':worker, 'cancel':cancel}
+
+        worker.start()
+        return True
+
+    def __imap_prefetch_select(self, host, username, mailbox, email_ids, sizes):
+        '''
+            choose email to prefetch from candidate email_ids
+            cached email is checked by reading only Message and Size of cache file
+            return list of email_id
+        '''
+
+        count = self.__imap_prefetch.get('count')
+        max_size = self.__imap_prefetch.get('max_size')
+        namespace = (host, username, mailbox)
+
+        def priority(email_id):
+            flags = self.__imap_flag_cache.get(namespace, email_id)
+            unseen = flags is not None and '\\Seen' not in flags
+            return (unseen and self.__imap_prefetch.get('unseen_first'), int(email_id))
+
+        # active user of self may change while worker run
+        cache_dir = self.__imap_cache_dir(username, mailbox)
+        selected = []
+        for email_id in sorted(set(str(email_id) for email_id in email_ids), key=priority, reverse=True):
+            if len(selected) >= count:
+                break
+
+            # don't create cache directory of email not prefetched
+            email_cache = {}
+            file = cache_dir + os.path.sep + email_id + os.path.sep + email_id
+            if os.path.isfile(file):
+                try:
+                    with open(file, 'rb') as f:
+                        email_cache = decode_cache(f.read(), self.__imap_cache_codec, self.__imap_cache_allow_pickle,
+                            keys=('Message', 'Size'))
+
+                except (OSError, CodecError):
+                    pass
+
+            if email_cache.get('Message'):
+                continue
+
+            size = sizes.get(email_id)
+            if size is None:
+                size = email_cache.get('Size')
+
+            if max_size and size is not None and size > max_size:
+                continue
+
+            selected.append(email_id)
+
+        return selected
+
+    def imap_prefetch_cancel(self, wait=False, all_users=False):
+        '''
+            cancel running prefetch of active user
+            email being fetched is completed, remaining email is not fetched
+            wait = True will wait until prefetch connection released
+            all_users = True cancel prefetch of every user
+        '''
+
+        active = self.imap_get_active()
+        with self.__imap_lock:
+            if all_users:
+                workers = list(self.__imap_prefetch_worker.values())
+                self.__imap_prefetch_worker.clear()
+            else:
+                worker = self.__imap_prefetch_worker.pop((active.get('host'), active.get('username')), None)
+                workers = [worker] if worker else []
+
+        for worker in workers:
+            worker.get('cancel').set()
+
+        if wait:
+            for worker in workers:
+                if worker.get('thread') is not threading.current_thread():
+                    worker.get('thread').join()
+
+    def imap_is_prefetching(self):
+        '''
+            check if prefetch of active user is running
+        '''
+
+        active = self.imap_get_active()
+        with self.__imap_lock:
+            worker = self.__imap_prefetch_worker.get((active.get('host'), active.get('username')))
+
+        return worker is not None and worker.get('thread').is_alive()
+
+    def __imap_prefetch_run(self, host, username, mailbox, email_ids, sizes, cancel):
+        '''
+            prefetch worker, fetch one email at a time so cancel and foreground wait checked between email
+        '''
+
+        session = None
+        try:
+            email_ids = self.__imap_prefetch_select(host, username, mailbox, email_ids, sizes)
+            if not email_ids or cancel.is_set():
+                return
+
+            session = self.imap_session(host, username, mailbox, readonly=True, pooled=True, timeout=0)
+            if session is None:
+                return
+
+            pool = session.imap_get_pool()
+            for email_id in email_ids:
+                if cancel.is_set() or pool.is_wanted():
+                    break
+
+                session.imap_get_fetch_content(email_id)
+
+        except Exception:
+            # prefetch is best effort, failed email is fetched again when requested
+            pass
+
+        finally:
+            if session:
+                session.imap_logout()
+
+            with self.__imap_lock:
+                worker = self.__imap_prefetch_worker.get((host, username))
+                if worker and worker.get('cancel') is cancel:
+                    del self.__imap_prefetch_worker[(host, username)]
+
+    def imap_set_backoff(self, base_delay=1, max_delay=300, max_retries=8):
+        '''
+            set throttling backoff of imap_call
+            base_delay = first delay in seconds, doubled for each failure until max_delay
+            max_retries = maximum retry of one operation
+        '''
+        
+        with self.__imap_lock:
+            self.__imap_retry.update({'base_delay':base_delay, 'max_delay':max_delay, 'max_retries':max_retries})
+            for backoff in self.__imap_backoff.values():
+                backoff.set_delay(base_delay, max_delay)
+                
+    def imap_get_backoff(self):
+        '''
+            get throttling backoff of current active user
+            shared with imap session of the same user
+            backoff.get_state() return {'failures':3, 'delay':seconds}
+        '''
+        
+        key = (self.imap_get_active().get('host'), self.imap_get_active().get('username'))
+        
+        with self.__imap_lock:
+            backoff = self.__imap_backoff.get(key)
+            if not backoff:
+                backoff = Backoff(self.__imap_retry.get('base_delay'), self.__imap_retry.get('max_delay'))
+                self.__imap_backoff[key] = backoff
+                
+        return backoff
+        
+    def imap_call(self, operation, *args, **kwargs):
+        '''
+            run imap operation of this object with throttling backoff
+            operation = method of this object or function using this object connection
+                ex: pyemail.imap_call(pyemail.imap_get_fetch, '30411', '(FLAGS)')
+            
+            - throttled response ([THROTTLED], [UNAVAILABLE], [LIMIT], [INUSE], ...) wait with exponential backoff
+            - dropped connection (BYE, socket error) reconnect with imap_reconnect then retry
+            - DeadlineExceeded is raised without retry, connection closed by timeout is reconnected on next call
+            backoff is shared by all session of the user, so every worker slow down together
+            operation should be safe to run again, ex: imap_sync continue from last completed email
+            
+            return operation result, last error raised or returned after max_retries
+        '''
+        
+        backoff = self.imap_get_backoff()
+        # connection closed by deadline timeout
+        reconnect = not self.imap_is_login()
+        attempt = 0
+        
+        while True:
+            backoff.wait()
+            
+            try:
+                if reconnect:
+                    # dropped pooled connection is discarded instead of returned to pool
+                    if self.__imap_session:
+                        self.__active_imap_user['is_login'] = False
+                        
+                    if self.imap_reconnect() != EntityFlag.SUCCESS_USER_LOGIN:
+                        raise imaplib.IMAP4.abort('reconnect failed')
+                        
+                    reconnect = False
+                    
+                result = operation(*args, **kwargs)
+                if not (isinstance(result, dict) and str(result.get('status')).lower() == 'no' and is_throttled(result.get('msg'))):
+                    backoff.success()
+                    return result
+                    
+                error = result
+                
+            except Exception as e:
+                # caller is out of time, don't wait for backoff
+                if isinstance(e, DeadlineExceeded) or (not is_throttled(e) and not is_disconnected(e)):
+                    raise
+                    
+                reconnect = reconnect or is_disconnected(e)
+                error = e
+                
+            attempt += 1
+            if attempt > self.__imap_retry.get('max_retries'):
+                if isinstance(error, Exception):
+                    raise error
+                    
+                return error
+                
+            # next backoff.wait sleep for the failure delay
+            backoff.failure()
+            
+    def imap_set_batch_limit(self, min_count=1, max_count=1000, min_bytes=65536, max_bytes=16777216, target_time=1.0):
+        '''
+            set bound of adaptive fetch batch
+            min_count, max_count = number of email in one FETCH command
+            min_bytes, max_bytes = total bytes in one FETCH command
+            target_time = target seconds of one FETCH command, batch grow while faster and shrink while slower
+        '''
+        
+        with self.__imap_lock:
+            self.__imap_batch_limit.update({'min_count':min_count, 'max_count':max_count,
+                'min_bytes':min_bytes, 'max_bytes':max_bytes, 'target_time':target_time})
+            
+            for batcher in self.__imap_batcher.values():
+                batcher.set_limit(**self.__imap_batch_limit)
+                
+    def imap_get_batcher(self, fields, count=100):
+        '''
+            get adaptive fetch batcher of current active user and fetch item
+            created on first call with count as initial batch size
+            kept for next call, so learned batch size is reused
+        '''
+        
+        key = (self.imap_get_active().get('host'), self.imap_get_active().get('username'), fields.upper())
+        
+        with self.__imap_lock:
+            batcher = self.__imap_batcher.get(key)
+            if not batcher:
+                batcher = FetchBatcher(count, **self.__imap_batch_limit)
+                self.__imap_batcher[key] = batcher
+                
+        return batcher
+        
+    def __imap_fetch_adaptive(self, parser, batch, fields, batcher, sized=False):
+        '''
+            fetch batch and record latency and bytes into batcher
+            batch rejected by server is split and fetched again
+            return list of fetch item
+        '''
+        
+        start = time.perf_counter()
+        try:
+            fetched = list(parser.fetch(batch, fields))
+            
+        except imaplib.IMAP4.abort:
+            raise
+            
+        except imaplib.IMAP4.error as e:
+            # throttled is handled by imap_call backoff, not by smaller batch
+            if len(batch) < 2 or is_throttled(e):
+                raise
+                
+            batcher.failure()
+            half = len(batch) // 2
+            return (self.__imap_fetch_adaptive(parser, batch[:half], fields, batcher, sized) +
+                self.__imap_fetch_adaptive(parser, batch[half:], fields, batcher, sized))
+            
+        batcher.record(len(batch), get_fetch_size(fetched), time.perf_counter() - start, sized)
+        return fetched
+        
+    def imap_parse_fetch_item(self, fetch_item):
+        '''
+            convert fetch item from FetchParser.fetch or parse_fetch_response into email dictionary
+            BODY[] will parsed as full message
+            BODY[HEADER] will parsed as header only
+        '''
+
+        email_msg = None
+        if fetch_item.get('BODY[]') is not None:
+            email_msg = literal_to_message(fetch_item.get('BODY[]'))
+        elif fetch_item.get('BODY[HEADER]') is not None:
+            email_msg = HeaderParser().parsestr(decode_literal(fetch_item.get('BODY[HEADER]')))
+
+        size = fetch_item.get('RFC822.SIZE')
+
+        return {'ID':fetch_item.get('UID'),
+            'Flags':fetch_item.get('FLAGS'),
+            'Size':int(size) if size is not None else None,
+            'Email':email_msg,
+            'Fetch':fetch_item}
+
+    def imap_store_command(self, message_id, command, flag_list):
+        '''
+            store imap flags
+            command should be 'FLAGS', '+FLAGS', '-FLAGS', optionaly with suffix of ."SILENT".
+            flag_list must be valid flag '\\Deleted', '\\Seen' etc
+        '''
+        
+        status, msg = self.imap_get().uid('STORE', message_id, command, flag_list)
+        
+        if status.lower() == 'ok':
+            fetched = parse_fetch_response(msg)
+            self.__imap_flag_cache.update_from_fetch(self.imap_get_namespace(), fetched)
+        
+        return {'status':status, 'msg':msg}
+        
+    def imap_store_flags(self, email_ids, command, flag_list, silent=True, unchangedsince=None, batch_size=1000, deadline=None):
+        '''
+            store imap flags for many email at once
+            email_ids = ['30411', '30412', '30413']
+            command should be 'FLAGS', '+FLAGS', '-FLAGS'
+            flag_list = ['\\Seen'] or '(\\Seen)'
+            silent = True will use .SILENT suffix, server will not return the new flags
+            unchangedsince = modseq, only store if flags not changed since modseq (need CONDSTORE capability)
+            batch_size = maximum email_id in one STORE command
+            deadline = seconds or Deadline object
+                when exceeded status is 'TIMEOUT' and continuation is sequence set of email_id not stored,
+                store is safe to repeat, call again with email_ids = uid_list(continuation)
+            
+            email_ids compressed into sequence set, ex: 1:100,105
+            return
+            {
+                'status':'OK',
+                'msg':['30411', '30412'] (stored email_id),
+                'modified':['30413'] (rejected by unchangedsince),
+                'continuation':None
+            }
+        '''
+        
+        imap = self.imap_get()
+        namespace = self.imap_get_namespace()
+        
+        if isinstance(flag_list, str):
+            flag_list = flag_list.strip('()').split()
+        
+        store_command = command.upper().replace('.SILENT', '')
+        if silent:
+            store_command += '.SILENT'
+        
+        conditional = unchangedsince is not None and 'CONDSTORE' in imap.capabilities
+        if conditional:
+            store_command = '(UNCHANGEDSINCE %s) %s' % (unchangedsince, store_command)
+        
+        email_ids = sorted(set(str(email_id) for email_id in email_ids), key=int)
+        deadline = Deadline.get(deadline)
+        stored = []
+        modified = []
+        status = 'OK'
+        
+        for index, batch in enumerate(chunk_list(email_ids, batch_size)):
+            try:
+                status, tagged = self.__imap_run_deadline(deadline, imap_command, imap, 'UID', 'STORE', uid_set(batch),
+                    store_command, '(' + ' '.join(flag_list) + ')')
+                    
+            except DeadlineExceeded:
+                # flags of batch in progress is unknown now
+                self.__imap_flag_cache.remove(namespace, batch + modified)
+                return {'status':'TIMEOUT', 'msg':stored, 'modified':modified,
+                    'continuation':uid_set(email_ids[index * batch_size:])}
+                    
+            # take untagged FETCH out of imap object even if failed, so next command don't read it
+            fetched = [fetch_item for fetch_item in parse_fetch_response(imap.response('FETCH')[1]) if fetch_item.get('UID')]
+            if status.lower() != 'ok':
+                return {'status':status, 'msg':stored, 'modified':modified, 'continuation':None}
+            
+            
+            # email rejected because modified since unchangedsince is listed in MODIFIED response code
+            # stored email without flag change may have no FETCH response
+            if conditional:
+                rejected = set(parse_modified(tagged))
+                modified.extend(email_id for email_id in batch if email_id in rejected)
+                batch = [email_id for email_id in batch if email_id not in rejected]
+            
+            self.__imap_flag_cache.update(namespace, batch, command, flag_list)
+            self.__imap_flag_cache.update_from_fetch(namespace, fetched)
+            stored.extend(batch)
+        
+        # flags of modified email is unknown now
+        self.__imap_flag_cache.remove(namespace, modified)
+        
+        return {'status':status, 'msg':stored, 'modified':modified, 'continuation':None}
+        
+    def imap_bulk_store(self, operations, silent=True, unchangedsince=None):
+        '''
+            store imap flags grouped by operation
+            operations = [
+                ('30411', '+FLAGS', ['\\Seen']),
+                ('30412', '+FLAGS', ['\\Seen']),
+                ('30413', '-FLAGS', ['\\Flagged'])
+            ]
+            
+            email_id with same command and flags sent in one STORE command
+            return list of imap_store_flags result for each group
+        '''
+        
+        groups = {}
+        for email_id, command, flag_list in operations:
+            if isinstance(flag_list, str):
+                flag_list = flag_list.strip('()').split()
+            
+            groups.setdefault((command.upper(), tuple(sorted(flag_list))), []).append(email_id)
+        
+        return [self.imap_store_flags(email_ids, command, list(flag_list), silent, unchangedsince)
+            for (command, flag_list), email_ids in groups.items()]
+        
+    def imap_fetch_flags(self, email_ids, batch_size=1000, deadline=None):
+        '''
+            refresh flag cache from server
+            email_ids = ['30411', '30412'] or '1:*' for all email in mailbox
+            deadline = seconds or Deadline object
+                when exceeded status is 'TIMEOUT' and continuation is sequence set of email_ids not refreshed,
+                call again with email_ids = continuation
+            
+            return {'status':'OK', 'msg':{cached flags}, 'continuation':None}
+        '''
+        
+        if isinstance(email_ids, str):
+            batches = [email_ids]
+        else:
+            email_ids = sorted(set(str(email_id) for email_id in email_ids), key=int)
+            batches = [uid_set(batch) for batch in chunk_list(email_ids, batch_size)]
+        
+        deadline = Deadline.get(deadline)
+        continuation = None
+        status = 'OK'
+        for index, batch in enumerate(batches):
+            try:
+                status, msg = self.__imap_run_deadline(deadline, self.imap_get().uid, 'FETCH', batch, '(UID FLAGS)')
+                
+            except DeadlineExceeded:
+                status = 'TIMEOUT'
+                continuation = batch if isinstance(email_ids, str) else uid_set(email_ids[index * batch_size:])
+                break
+                
+            if status.lower() != 'ok':
+                break
+            
+            self.__imap_flag_cache.update_from_fetch(self.imap_get_namespace(), parse_fetch_response(msg))
+        
+        return {'status':status, 'msg':self.__imap_flag_cache.get(self.imap_get_namespace()), 'continuation':continuation}
+        
+    def imap_get_cached_flags(self, email_id=None):
+        '''
+            get cached flags of email_id in selected mailbox
+            if email_id not set will return all cached flags as dictionary
+        '''
+        
+        return self.__imap_flag_cache.get(self.imap_get_namespace(), email_id)
+        
+    def imap_search_cached_flags(self, flag, present=True):
+        '''
+            search email_id in selected mailbox using flag cache
+            without server round trip
+            ex: imap_search_cached_flags('\\Seen', False) will return unread email_id
+        '''
+        
+        return self.__imap_flag_cache.search(self.imap_get_namespace(), flag, present)
+    
+    def imap_expunge(self):
+        '''
+            commit all change command to email
+            should call this after change email flag
+        '''
+        
+        status, msg = self.imap_get().expunge()
+        
+        if status.lower() == 'ok':
+            namespace = self.imap_get_namespace()
+            self.__imap_flag_cache.remove(namespace, self.__imap_flag_cache.search(namespace, '\\Deleted'))
+        
+        return {'status':status, 'msg':msg}
+        
+    def imap_uid_expunge(self, email_ids, batch_size=1000):
+        '''
+            expunge only email_ids with \\Deleted flag (need UIDPLUS capability)
+            unlike imap_expunge, email flagged as \\Deleted by other client is not expunged
+            return status NO if server not support UIDPLUS
+        '''
+        
+        imap = self.imap_get()
+        if 'UIDPLUS' not in imap.capabilities:
+            return {'status':'NO', 'msg':[b'UIDPLUS not supported']}
+        
+        namespace = self.imap_get_namespace()
+        status, msg = 'OK', [None]
+        
+        for batch in chunk_list(sorted(set(str(email_id) for email_id in email_ids), key=int), batch_size):
+            status, msg = imap.uid('EXPUNGE', uid_set(batch))
+            if status.lower() != 'ok':
+                break
+            
+            self.__imap_flag_cache.remove(namespace, batch)
+        
+        return {'status':status, 'msg':msg}
+        
+    def imap_copy(self, email_ids, mailbox, batch_size=1000):
+        '''
+            copy email_ids from selected mailbox to other mailbox using UID COPY
+            if server support UIDPLUS, cached email copied to destination mailbox cache
+            so copied email will not downloaded again
+            
+            return
+            {
+                'status':'OK',
+                'msg':{'30411':'4001', '30412':'4002'} (source email_id to destination email_id)
+            }
+        '''
+        
+        return self.__imap_transfer('COPY', email_ids, mailbox, batch_size)
+        
+    def imap_move(self, email_ids, mailbox, batch_size=1000):
         '''
-            logout from specific imap object
+            move email_ids from selected mailbox to other mailbox
+            use UID MOVE (RFC 6851) if server support MOVE
+            else fallback to UID COPY + UID STORE \\Deleted + UID EXPUNGE (UIDPLUS)
+            without UIDPLUS moved email only flagged \\Deleted, call imap_expunge to remove it
+            
+            cached email moved to destination mailbox cache
+            on fallback cached email is copied, source cache only removed after expunge succeed
             return
-            EntityFlag.SUCCESS_USER_LOGOUT|EntityFlag.SUCCESS_USER_LOGOUT
+            {
+                'status':'OK',
+                'msg':{'30411':'4001', '30412':'4002'} (source email_id to destination email_id)
+            }
         '''
         
-        try:
-            host = self.imap_get_active().get('host')
-            username = self.imap_get_active().get('username')
-            self.imap_get_user(host, username)['is_login'] = False
-            self.imap_get().close()
-            self.imap_get().logout()
-            self.imap_get().shutdown()
-            return EntityFlag.SUCCESS_USER_LOGOUT
-        except Exception:
-            return EntityFlag.ERROR_USER_LOGOUT
+        if 'MOVE' in self.imap_get().capabilities:
+            return self.__imap_transfer('MOVE', email_ids, mailbox, batch_size)
         
+        copied = self.__imap_transfer('COPY', email_ids, mailbox, batch_size)
+        if copied.get('status').lower() != 'ok':
+            return copied
         
-    def imap_get_list(self):
-        '''
-            return list of mailbox list
-            directory default to top level
-            pattern default match to any
-        '''
+        email_ids = [str(email_id) for email_id in email_ids]
+        stored = self.imap_store_flags(email_ids, '+FLAGS', ['\\Deleted'], batch_size=batch_size)
+        if stored.get('status').lower() != 'ok':
+            return {'status':stored.get('status'), 'msg':copied.get('msg')}
         
-        status, msg = self.imap_get().list()
+        if 'UIDPLUS' in self.imap_get().capabilities:
+            expunged = self.imap_uid_expunge(email_ids, batch_size)
+            if expunged.get('status').lower() == 'ok':
+                self.__imap_remove_cache(email_ids)
+                
+            return {'status':expunged.get('status'), 'msg':copied.get('msg')}
         
-        try:
-            msg = [mailbox.decode('UTF-8') for mailbox in msg]
-        except Exception as e:
-            print(e)
+        return copied
         
-        return {'status':status, 'msg':msg}
-            
-    def imap_mailbox_select(self, mailbox='INBOX', readonly=False):
+    def __imap_transfer(self, command, email_ids, mailbox, batch_size):
         '''
-            select mailbox from imap object
-            default is INBOX
+            run UID COPY or UID MOVE in batch
+            then update local cache using COPYUID response code
         '''
+        
+        imap = self.imap_get()
+        mailbox = unquote_mailbox(mailbox)
+        uid_map = {}
+        status = 'OK'
+        
+        for batch in chunk_list(sorted(set(str(email_id) for email_id in email_ids), key=int), batch_size):
+            # COPYUID of COPY is in tagged OK response
+            # COPYUID of MOVE is sent as untagged OK before EXPUNGE response
+            status, tagged = imap_command(imap, 'UID', command, uid_set(batch), quote_mailbox(mailbox))
+            untagged = imap.response('COPYUID')[1]
+            
+            if status.lower() != 'ok':
+                break
+            
+            batch_map = parse_copyuid(tagged)[1]
+            for response in untagged:
+                if response:
+                    batch_map.update(parse_copyuid(response, code=False)[1])
             
-        status, msg = self.imap_get().select(mailbox, readonly)
+            self.imap_transfer_cache(batch_map, mailbox, move=(command == 'MOVE'))
+            uid_map.update(batch_map)
+            
+            if command == 'MOVE':
+                # moved email without COPYUID can't be mapped to destination, only source cache removed
+                unmapped = [email_id for email_id in batch if email_id not in batch_map]
+                if unmapped:
+                    self.__imap_remove_cache(unmapped)
         
-        return {'status':status, 'msg':msg}
-    
-    def imap_get_search(self, *criterion):
+        return {'status':status, 'msg':uid_map}
+        
+    def __imap_remove_cache(self, email_ids):
         '''
-            do search in imap
-            get email from imap object
-            *criterion is for search criterion ex: 'FROM', '"LDJ"' or '(FROM "LDJ")'
+            remove cached email and index entry of expunged email_ids in selected mailbox
         '''
         
-        status, msg = self.imap_get().uid('search', None, *criterion)
+        mailbox = self.imap_get_active().get('mailbox')
+        self.__imap_flag_cache.remove(self.imap_get_namespace(), email_ids)
+        
+        for email_id in email_ids:
+            shutil.rmtree(self.imap_get_cache_dir() + os.path.sep + email_id, ignore_errors=True)
         
-        email_ids = []
-        if len(msg):
-            msg_ids = msg[0].decode('UTF-8')
-            if msg_ids != '':
-                email_ids = msg_ids.split(' ')
+        self.imap_get_dedupe_index().remove(mailbox, email_ids)
+        self.imap_get_address_index().remove(mailbox, email_ids)
         
-        return {'status':status, 'msg':email_ids}
+        thread_index = self.imap_get_thread_index(mailbox)
+        thread_index.remove(email_ids)
+        thread_index.save()
         
-    def imap_get_fetch(self, email_id, *criterion):
+    def imap_transfer_cache(self, uid_map, mailbox, move=False):
         '''
-            do fetch email information
-            for specific email_id
+            copy or move cached email from selected mailbox to other mailbox cache
+            uid_map = {'30411':'4001'} (source email_id to destination email_id)
+                destination email_id None if unknown, moved email is only removed from source cache
         '''
         
-        status, msg = self.imap_get().uid('fetch', email_id, *criterion)
+        namespace = self.imap_get_namespace()
+        destination = namespace[:2] + (mailbox,)
         
-        return {'status':status, 'msg':msg}
+        for email_id, dest_id in uid_map.items():
+            if dest_id is None:
+                continue
+                
+            flags = self.__imap_flag_cache.get(namespace, email_id)
+            if flags is not None:
+                self.__imap_flag_cache.set(destination, dest_id, flags)
+            
+            self.__imap_relink_cache(self.imap_get_cache_dir() + os.path.sep + email_id, email_id, dest_id, mailbox, move)
+            self.imap_get_dedupe_index().copy(namespace[2], email_id, mailbox, dest_id)
+            self.imap_get_address_index().copy(namespace[2], email_id, mailbox, dest_id)
         
-    def imap_store_command(self, message_id, command, flag_list):
+        if move and uid_map:
+            self.__imap_remove_cache([str(email_id) for email_id in uid_map])
+        
+    def __imap_relink_cache(self, src_dir, email_id, dest_id, mailbox, move=True):
         '''
-            store imap flags
-            command should be 'FLAGS', '+FLAGS', '-FLAGS', optionaly with suffix of ."SILENT".
-            flag_list must be valid flag '\\Deleted', '\\Seen' etc
+            copy or move cached email directory to dest_id of mailbox
+            return True if cached email exist and relinked
         '''
         
-        status, msg = self.imap_get().uid('STORE', message_id, command, flag_list)
+        if not os.path.isdir(src_dir):
+            return False
         
-        return {'status':status, 'msg':msg}
-    
-    def imap_expunge(self):
+        try:
+            if not os.path.isdir(self.imap_get_cache_dir(mailbox)):
+                os.makedirs(self.imap_get_cache_dir(mailbox))
+                
+            dest_dir = self.imap_get_cache_dir(mailbox) + os.path.sep + dest_id
+            if os.path.isdir(dest_dir):
+                shutil.rmtree(dest_dir)
+                
+            if move:
+                shutil.move(src_dir, dest_dir)
+            else:
+                shutil.copytree(src_dir, dest_dir)
+            
+            # serialized email file is named by email_id
+            os.rename(dest_dir + os.path.sep + email_id, dest_dir + os.path.sep + dest_id)
+            
+            email_data = self.imap_unserialize_email_from_file(dest_id, mailbox)
+            if email_data:
+                email_data['ID'] = dest_id
+                self.imap_serialize_email_to_file(email_data, mailbox)
+                
+            return True
+                
+        except Exception as e:
+            print(e)
+            
+        return False
+        
+    def imap_append_message(self, message, mailbox='Drafts', flags=None, date_time=None, chunk_size=STREAM_CHUNK_SIZE):
         '''
-            commit all change command to email
-            should call this after change email flag
+            append message to mailbox, ex: save to Drafts or Sent
+            message = MessageBuilder object or binary file object with CRLF line ending
+            flags = ['\\Seen', '\\Draft']
+            date_time = internal date, see imaplib.Time2Internaldate
+            
+            message literal streamed from file in chunk_size
+            MessageBuilder message generated with generate_file, spooled to disk if big
+            return
+            {
+                'status':'OK',
+                'msg':[b'[APPENDUID 38505 3955] APPEND completed'],
+                'uid':'3955' (only if server support UIDPLUS)
+            }
         '''
         
-        status, msg = self.imap_get().expunge()
+        if isinstance(message, MessageBuilder):
+            with message.generate_file(chunk_size=chunk_size) as message_file:
+                return self.imap_append_message(message_file, mailbox, flags, date_time, chunk_size)
         
-        return {'status':status, 'msg':msg}
+        imap = self.imap_get()
+        
+        message.seek(0, os.SEEK_END)
+        size = message.tell()
+        message.seek(0)
+        
+        command = 'APPEND ' + quote_mailbox(unquote_mailbox(mailbox))
+        if flags:
+            command += ' (' + ' '.join(flags) + ')'
+        if date_time:
+            command += ' ' + imaplib.Time2Internaldate(date_time)
+        
+        # imaplib append need whole message as bytes
+        # so write command and literal directly to imap socket
+        tag = 'PXA%d' % next(self.__imap_tag)
+        
+        non_sync = 'LITERAL+' in imap.capabilities
+        imap.send(('%s %s {%d%s}\r\n' % (tag, command, size, '+' if non_sync else '')).encode('UTF-8'))
+        
+        if not non_sync:
+            # untagged response before continuation (ex: EXISTS) is kept for imaplib
+            line = imap.readline()
+            while line.startswith(b'* '):
+                append_untagged(imap, line.rstrip(b'\r\n'))
+                line = imap.readline()
+            
+            if not line.startswith(b'+'):
+                return {'status':line.split(b' ')[1].decode('ASCII') if b' ' in line else 'BAD', 'msg':[line.strip()], 'uid':None}
+        
+        for chunk in read_chunks(message, chunk_size):
+            imap.send(chunk)
+        imap.send(b'\r\n')
+        
+        line = imap.readline()
+        while not line.startswith(tag.encode('ASCII') + b' '):
+            if not line:
+                raise imaplib.IMAP4.abort('connection closed while APPEND')
+            if line.startswith(b'* '):
+                append_untagged(imap, line.rstrip(b'\r\n'))
+            line = imap.readline()
+        
+        status, _, msg = line.strip()[len(tag) + 1:].partition(b' ')
+        uid = None
+        match = re.search(rb'\[APPENDUID \d+ (\d+)\]', msg)
+        if match:
+            uid = match.group(1).decode('ASCII')
+        
+        return {'status':status.decode('ASCII'), 'msg':[msg], 'uid':uid}
         
     def imap_get_fetch_header(self, email_id):
         '''
@@ -320,15 +2417,49 @@ class PxEmail(object):
         if email_cache:
             return {'status':'OK', 'msg':email_cache}
         
-        email_info = self.imap_get_fetch(email_id, '(BODY[HEADER])')
-        if email_info.get('status').lower() != 'ok':
+        fetch_item = self.__imap_fetch_item(email_id, 'BODY[HEADER]', 'RFC822.SIZE')
+        if fetch_item is None:
             return None
         
-        header = email_info.get('msg')[0][1].decode('UTF-8') #get header string then decode
+        header = decode_literal(fetch_item.get('BODY[HEADER]')) #get header string then decode
         parser = HeaderParser()
         
         # serialize
         parsed_header = parser.parsestr(header)
+        email_data = self.imap_build_header(email_id, parsed_header, fetch_item.get('RFC822.SIZE'))
+        self.imap_serialize_email_to_file(email_data)
+        self.imap_get_dedupe_index().add(self.imap_get_active().get('mailbox'), email_id, email_data.get('MessageID'), email_data.get('Size'))
+            
+        return {'status':'OK', 'msg':parsed_header}
+        
+    def __imap_fetch_item(self, email_id, item, extra=None):
+        '''
+            fetch one literal item of email_id, ex: 'BODY[HEADER]'
+            extra = other fetch item, ex: 'RFC822.SIZE'
+            return fetch item with memoryview of the literal or None if failed
+        '''
+        
+        items = '(UID ' + item + (' ' + extra if extra else '') + ')'
+        
+        try:
+            for fetch_item in get_parser(self.imap_get()).fetch([email_id], items):
+                if fetch_item.get('UID') == str(email_id) and fetch_item.get(item) is not None:
+                    return fetch_item
+                    
+        except imaplib.IMAP4.abort:
+            raise
+            
+        except imaplib.IMAP4.error as e:
+            print(e)
+            
+        return None
+        
+    def imap_build_header(self, email_id, parsed_header, size=None):
+        '''
+            convert parsed header into serializable email dictionary
+            size = RFC822.SIZE of email
+        '''
+        
         serialized_eml = {}
         serialized_eml['ID'] = email_id
         serialized_eml['From'] = parsed_header.get('From')
@@ -337,9 +2468,12 @@ class PxEmail(object):
         serialized_eml['BCC'] = parsed_header.get('BCC')
         serialized_eml['Subject'] = parsed_header.get('Subject')
         serialized_eml['Date'] = parsed_header.get('Date')
-        self.imap_serialize_email_to_file(serialized_eml)
-            
-        return {'status':'OK', 'msg':parsed_header}
+        serialized_eml['MessageID'] = parsed_header.get('Message-ID')
+        serialized_eml['InReplyTo'] = parsed_header.get('In-Reply-To')
+        serialized_eml['References'] = parsed_header.get('References')
+        serialized_eml['Size'] = int(size) if size is not None else None
+        
+        return serialized_eml
         
     def imap_get_fetch_content(self, email_id, download_attachment=False):
         '''
@@ -366,7 +2500,15 @@ class PxEmail(object):
         if email_cache and email_cache.get('msg') and email_cache.get('msg').get('Message'):
             return email_cache
         
+        # same email already cached in other mailbox
+        linked = self.__imap_link_duplicate(email_id)
+        if linked:
+            return {'status':'OK', 'msg':linked}
+        
         email_cache = email_cache.get('msg')
+        if not isinstance(email_cache, dict):
+            # header just fetched is parsed message, use the cached dictionary instead
+            email_cache = self.imap_unserialize_email_from_file(email_id) or self.imap_build_header(email_id, email_cache)
         
         #email_content = {'content':[], 'attachment':[], 'inline_attachment':[]}
         email_cache['Message'] = []
@@ -374,14 +2516,15 @@ class PxEmail(object):
         email_cache['InlineAttachment'] = []
         email_cache['ID'] = email_id
         
-        body = self.imap_get_fetch(email_id, '(BODY[])')
-        status = body.get('status')
-        data = body.get('msg')[0][1]
-        email_msg = email.message_from_bytes(data)
-        
-        if status.lower() != 'ok':
+        fetch_item = self.__imap_fetch_item(email_id, 'BODY[]')
+        if fetch_item is None:
             return None
         
+        status = 'OK'
+        data = fetch_item.get('BODY[]')
+        email_msg = literal_to_message(data)
+        email_cache['BodyHash'] = hashlib.sha256(data).hexdigest()
+        
         # check if download_attachment is set
         for part in email_msg.walk():
             if part.get('Content-Disposition') and download_attachment:
@@ -422,6 +2565,8 @@ class PxEmail(object):
         
         #return {'status':status, 'msg':email_content}
         self.imap_serialize_email_to_file(email_cache)
+        self.imap_get_dedupe_index().add(self.imap_get_active().get('mailbox'), email_id,
+            email_msg.get('Message-ID'), len(data), email_cache.get('BodyHash'))
         return {'status':status, 'msg':email_cache}
     
     def imap_set_directory(self, directory):
@@ -432,46 +2577,84 @@ class PxEmail(object):
         
         self.__imap_local_dir = directory
     
-    def imap_init_serialize_dir(self, email_id):
+    def imap_get_cache_dir(self, mailbox=None):
+        '''
+            get local cache directory of active user and mailbox
+            email_id is only unique in one mailbox, so each mailbox has own directory
+            mailbox default is selected mailbox
+        '''
+        
+        if mailbox is None:
+            mailbox = self.imap_get_active().get('mailbox')
+        
+        return self.__imap_cache_dir(self.imap_get_active().get('username'), mailbox)
+        
+    def __imap_cache_dir(self, username, mailbox):
+        '''
+            get local cache directory of username and mailbox
+        '''
+        
+        dir_path = self.__imap_local_dir + os.path.sep + username
+        if mailbox:
+            dir_path += os.path.sep + quote(mailbox, safe='')
+            
+        return dir_path
+    
+    def imap_init_serialize_dir(self, email_id, mailbox=None):
         '''
             check if local directory for serialize already exists
             if not create it
         '''
         
-        dir_path = self.__imap_local_dir + os.path.sep + self.__active_imap_user.get('username') + os.path.sep + email_id
+        dir_path = self.imap_get_cache_dir(mailbox) + os.path.sep + email_id
         if not os.path.isdir(dir_path):
             os.makedirs(dir_path)
             
         return dir_path
     
-    def imap_unserialize_email_from_file(self, email_id):
+    def imap_set_cache_codec(self, codec=None, allow_pickle=False):
         '''
-            unserialize json from email cache to variable
+            set codec of cached email file
+            codec = codec name ('binary', 'pickle') or CacheCodec object, default is binary codec
+            allow_pickle = read legacy pickle cache, only for trusted cache directory
+                if False legacy cache is fetched again and saved with codec
+                use emailcodec.migrate_cache to convert existing cache directory,
+                with legacy_mailbox it also move cache saved before per mailbox cache directory
         '''
         
-        dir_path = self.imap_init_serialize_dir(email_id)
-        file = dir_path + os.path.sep + email_id
+        self.__imap_cache_codec = codec if isinstance(codec, CacheCodec) else get_codec(codec)
+        self.__imap_cache_allow_pickle = allow_pickle
+        
+    def imap_get_cache_codec(self):
+        '''
+            get codec of cached email file
+        '''
         
-        content = None
+        return self.__imap_cache_codec
         
-        '''if os.path.exists(file):
-            f = open(file, 'r')
-            content = f.readline()
-            f.close()
-            
-            if content:
-                content = json.loads(content)
-        ''' 
+    def imap_unserialize_email_from_file(self, email_id, mailbox=None):
+        '''
+            unserialize email cache to variable
+            return None if not cached or can't be decoded
+        '''
+        
+        dir_path = self.imap_init_serialize_dir(email_id, mailbox)
+        file = dir_path + os.path.sep + email_id
         
         try:
-            return Unpickler(open(file, 'rb')).load()
+            with open(file, 'rb') as f:
+                return decode_cache(f.read(), self.__imap_cache_codec, self.__imap_cache_allow_pickle)
+            
+        except (FileNotFoundError, CodecError):
+            # not cached or legacy cache, fetch again
+            pass
             
         except Exception as e:
             print(e)
                
-        return content
+        return None
         
-    def imap_serialize_email_to_file(self, email_data):
+    def imap_serialize_email_to_file(self, email_data, mailbox=None):
         '''
             email_data = {
                 'Subject':'',
@@ -484,9 +2667,16 @@ class PxEmail(object):
         '''
         
         try:
-            dir_path = self.imap_init_serialize_dir(email_data.get('ID'))
+            dir_path = self.imap_init_serialize_dir(email_data.get('ID'), mailbox)
             file = dir_path + os.path.sep + email_data.get('ID')
-            Pickler(open(file, 'wb'), protocol=pickle.HIGHEST_PROTOCOL).dump(email_data)
+            data = self.__imap_cache_codec.encode(email_data)
+            
+            # write then replace, so reader never get partial file
+            temp_file = '%s.%d.tmp' % (file, threading.get_ident())
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+                
+            os.replace(temp_file, file)
             
         except Exception as e:
             print(e)
@@ -496,13 +2686,13 @@ class PxEmail(object):
             check email data is alrady exists or not
         '''
         
-        return os.path.exists(self.__imap_local_dir + os.path.sep + self.__active_imap_user.get('username') + os.path.sep + email_id)
+        return os.path.exists(self.imap_get_cache_dir() + os.path.sep + email_id)
         
     ####################################
     ####### SMTP FUNCTIONALITY #########
     ####################################
     def smtp_add(self, host, username, password, port=smtplib.SMTP_PORT, local_hostname=None, source_address=None,
-        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, context=None, force=False):
+        connection_type=EntityFlag.CONNECTION_PLAIN, keyfile=None, certfile=None, context=None, force=False, timeout=None):
         '''
             add smtp user to __smtp_user
             host = 'ex@mail.com'
@@ -517,13 +2707,14 @@ class PxEmail(object):
                 If omitted (or if host or port are '' and/or 0 respectively) the OS default behavior will be used.    
             force = False (default is false, to not override existing user), if exist will return false
                     True will force existing user with new configuration
+            timeout = socket timeout in seconds of connect and each blocking operation, None use socket default timeout
                     
             connection_type = EntityFlag.CONNECTION_PLAIN (if connection using ssl, may need keyfile, certfile, ssl_context parameter)
                 value should be one of connection_type=EntityFlag.CONNECTION_PLAIN|connection_type=EntityFlag.CONNECTION_SSL|connection_type=EntityFlag.CONNECTION_LMTP
         '''
         
         return self.__smtp_entity.add(host, username, password, port, local_hostname, source_address,
-            connection_type, keyfile, certfile, context, force)
+            connection_type, keyfile, certfile, context, force, timeout)
     
     def smtp_serialize(self, filename):
         '''
@@ -539,11 +2730,12 @@ class PxEmail(object):
                 smtp_entity_item = copy.copy(smtp_entity.get(entity))
                 smtp_entity_dump[entity] = {}
                 for smtp_user in smtp_entity_item:
-                    smtp_entity_dump[entity][smtp_user] = smtp_entity_item.get(smtp_user)
+                    smtp_entity_dump[entity][smtp_user] = dict(smtp_entity_item.get(smtp_user))
                     smtp_entity_dump.get(entity).get(smtp_user)['smtp'] = None
             
             # serialize smtp user         
-            Pickler(open(filename + '.smtp.entity', 'wb'), protocol=pickle.HIGHEST_PROTOCOL).dump(smtp_entity_dump)
+            with open(filename + '.smtp.entity', 'wb') as f:
+                Pickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(smtp_entity_dump)
         except Exception as e:
             print(e)
             
@@ -554,7 +2746,8 @@ class PxEmail(object):
         '''
         
         try:
-            return {'entity':Unpickler(open(filename + '.smtp.entity', 'rb')).load()}
+            with open(filename + '.smtp.entity', 'rb') as f:
+                return {'entity':Unpickler(f).load()}
         except Exception as e:
             print(e)
             
@@ -580,6 +2773,24 @@ class PxEmail(object):
         username = self.smtp_get_active().get('username')
         return self.__smtp_entity.get_smtp(host, username)
         
+    def smtp_is_connected(self, noop=True):
+        '''
+            check if conneected to server or not
+            noop = False only check the socket without server round trip
+        '''
+        
+        smtp = self.smtp_get()
+        if smtp is None or not is_socket_open(smtp.sock):
+            return False
+            
+        if not noop:
+            return True
+            
+        try:
+            return smtp.noop()[0] == 250
+        except Exception:
+            return False
+            
     def smtp_set_active(self, host, username):
         '''
             set current active user
@@ -642,14 +2853,367 @@ class PxEmail(object):
         except Exception:
             return EntityFlag.ERROR_USER_LOGOUT
             
-    def smtp_send_message(self, message):
+    def smtp_send_message(self, message, deadline=None):
         '''
             send message with option
             message = implementation of MessageBuilder object
             else is optional message which is like send_message method from smptlib
+            deadline = seconds or Deadline object, raise DeadlineExceeded when exceeded
+                connection is closed by smtplib, smtp_login again before next message
+        '''
+        
+        smtp = self.smtp_get()
+        self.__smtp_run_deadline(Deadline.get(deadline), smtp, smtp.send_message, message.generate(),
+            None, None, message.get_mail_options(), message.get_rcpt_options())
+        
+    def __smtp_run_deadline(self, deadline, smtp, operation, *args):
+        '''
+            run operation with socket timeout limited by remaining time of deadline
+            raise DeadlineExceeded
+        '''
+        
+        if deadline is None or smtp.sock is None:
+            return operation(*args)
+        
+        try:
+            with deadline.apply(smtp.sock):
+                return operation(*args)
+                
+        except DeadlineExceeded as e:
+            if e.__cause__ is not None:
+                host = self.smtp_get_active().get('host')
+                username = self.smtp_get_active().get('username')
+                self.smtp_get_user(host, username)['is_login'] = False
+                smtp.close()
+                
+            raise
+        
+    def smtp_get_pool(self, max_size=None, max_age=300, max_messages=100, check_interval=30):
+        '''
+            get connection pool of current active smtp user
+            pool is created on first call with max_size or 4 connection, see SMTPPool for parameter
+            max_size will grow existing pool if bigger than current max size
+        '''
+        
+        host = self.smtp_get_active().get('host')
+        username = self.smtp_get_active().get('username')
+        return self.__smtp_get_pool(host, username, max_size, max_age, max_messages, check_interval)
+        
+    def __smtp_get_pool(self, host, username, max_size=None, max_age=300, max_messages=100, check_interval=30):
+        '''
+            get connection pool of smtp user
+        '''
+        
+        with self.__smtp_lock:
+            pool = self.__smtp_pool.get((host, username))
+            if not pool:
+                pool = SMTPPool(self.__smtp_entity, host, username, max_size or 4, max_age, max_messages, check_interval)
+                self.__smtp_pool[(host, username)] = pool
+            elif max_size and pool.get_max_size() < max_size:
+                pool.set_max_size(max_size)
+                
+        return pool
+        
+    def smtp_send_message_pooled(self, message, stream=False, retry=1, chunk_size=STREAM_CHUNK_SIZE):
+        '''
+            send message using connection from smtp_get_pool
+            safe to call from many thread, each send use own pooled connection
+            message = implementation of MessageBuilder object
+            stream = True will send using generate_stream like smtp_send_message_stream
+            retry = number of retry with new connection if server disconnected
+                only before message data is sent, after that server may already accept the message
+                and sending again can deliver duplicate
+            
+            return refused recipient like smtplib sendmail
+        '''
+        
+        pool = self.smtp_get_pool()
+        from_addr, to_addrs = message.get_envelope()
+        data = None if stream else self.__smtp_generate_bytes(message)
+        
+        for attempt in range(retry + 1):
+            progress = {}
+            try:
+                with pool.connection() as smtp:
+                    if stream:
+                        chunks = join_chunks(message.generate_stream(chunk_size), chunk_size)
+                    else:
+                        chunks = iter([data])
+                        
+                    return self.__smtp_send_chunks(smtp, from_addr, to_addrs, chunks,
+                        message.get_mail_options(), message.get_rcpt_options(), progress=progress)
+                        
+            except (smtplib.SMTPServerDisconnected, OSError):
+                if attempt >= retry or progress.get('data'):
+                    raise
+                    
+    def __smtp_generate_bytes(self, message):
+        '''
+            generate message as bytes with CRLF line ending, BCC removed like smtplib send_message
+        '''
+        
+        generated = message.generate()
+        del generated['Bcc']
+        del generated['Resent-Bcc']
+        
+        policy = generated.policy.clone(linesep='\r\n')
+        if 'SMTPUTF8' in [option.upper() for option in message.get_mail_options()]:
+            policy = policy.clone(utf8=True)
+            
+        with io.BytesIO() as f:
+            BytesGenerator(f, policy=policy).flatten(generated, linesep='\r\n')
+            data = f.getvalue()
+            
+        # DATA end with CRLF.CRLF
+        return data if data.endswith(b'\r\n') else data + b'\r\n'
+        
+    def smtp_get_spool(self, directory=None, rate=1.0, max_attempts=8, base_delay=60, max_delay=3600, workers=2, start=True):
+        '''
+            get persistent outbound queue
+            spool is created on first call, see EmailSpool for parameter
+            directory default is pxemail_spool in current directory
+            start = True will start background worker
+            
+            message queued before process restart is sent when spool created again with same directory
+        '''
+        
+        with self.__smtp_lock:
+            if not self.__smtp_spool:
+                if directory is None:
+                    directory = os.getcwd() + os.path.sep + 'pxemail_spool'
+                    
+                self.__smtp_spool = EmailSpool(directory, self.__smtp_send_spooled, rate, max_attempts,
+                    base_delay, max_delay, workers)
+                    
+            if start:
+                self.__smtp_spool.start()
+                
+        return self.__smtp_spool
+        
+    def smtp_enqueue_message(self, message, chunk_size=STREAM_CHUNK_SIZE):
+        '''
+            save message to outbound queue and return immediately
+            message sent later by spool worker using active smtp user
+            message = implementation of MessageBuilder object
+            
+            message is generated into spool directory by spool worker, not by caller
+            so message and its attachment file should not be changed after enqueue
+            return id of spooled message, see EmailSpool.get(id) for status
+        '''
+        
+        spool = self.__smtp_spool or self.smtp_get_spool()
+        from_addr, to_addrs = message.get_envelope()
+        
+        def prepare(message_file):
+            with open(message_file, 'wb') as f:
+                for chunk in join_chunks(message.generate_stream(chunk_size), chunk_size):
+                    f.write(chunk)
+        
+        return spool.enqueue(self.smtp_get_active().get('host'), self.smtp_get_active().get('username'),
+            spool.create_message_file(), from_addr, to_addrs, message.get_mail_options(), message.get_rcpt_options(),
+            prepare=prepare)
+            
+    def __smtp_send_spooled(self, entry, message_file):
+        '''
+            send spooled message using pooled connection of spooled smtp user
+        '''
+        
+        pool = self.__smtp_get_pool(entry.get('host'), entry.get('username'))
+        with pool.connection() as smtp:
+            return self.__smtp_send_chunks(smtp, entry.get('from_addr'), entry.get('to_addrs'),
+                read_chunks(message_file, STREAM_CHUNK_SIZE), entry.get('mail_options'), entry.get('rcpt_options'))
+        
+    def smtp_set_rcpt_limit(self, rcpt_limit):
+        '''
+            set maximum recipient in one smtp transaction for active smtp user
+            used by smtp_send_message_batch, default is 100 (RFC 5321 minimum)
+        '''
+        
+        host = self.smtp_get_active().get('host')
+        username = self.smtp_get_active().get('username')
+        self.smtp_get_user(host, username)['rcpt_limit'] = rcpt_limit
+        
+    def smtp_send_message_batch(self, message, recipients, rcpt_limit=None, chunk_size=STREAM_CHUNK_SIZE, deadline=None):
+        '''
+            send same message to many recipient
+            message = implementation of MessageBuilder object, ex: To is list address or undisclosed recipients
+            recipients = ['john@gmail.com', 'doe@gmail.com', ...], only used as envelope recipient
+            rcpt_limit = maximum RCPT TO in one transaction, default from smtp_set_rcpt_limit
+            
+            message generated once and body transmitted once for each batch of recipient
+            recipient rejected with 452 (too many recipients) is sent in next transaction
+            with smaller rcpt_limit, halved when every recipient of transaction is rejected with 452
+            deadline = seconds or Deadline object, when exceeded no new transaction is started
+                recipient not sent yet has reply (None, b'deadline exceeded'),
+                send the rest by calling again with these recipients
+            recipient not sent because server disconnected has reply (None, b'server disconnected: ...')
+            
+            return reply of every recipient
+            {
+                'john@gmail.com':(250, b'OK'),
+                'doe@gmail.com':(550, b'User unknown')
+            }
+        '''
+        
+        smtp = self.smtp_get()
+        if rcpt_limit is None:
+            host = self.smtp_get_active().get('host')
+            username = self.smtp_get_active().get('username')
+            rcpt_limit = self.smtp_get_user(host, username).get('rcpt_limit') or 100
+        
+        from_addr = message.get_envelope()[0]
+        deadline = Deadline.get(deadline)
+        pending = list(recipients)
+        results = {}
+        
+        with message.generate_file(chunk_size=chunk_size) as message_file:
+            while pending:
+                batch = pending[:rcpt_limit]
+                pending = pending[rcpt_limit:]
+                message_file.seek(0)
+                
+                try:
+                    self.__smtp_run_deadline(deadline, smtp, self.__smtp_send_chunks, smtp, from_addr, batch,
+                        read_chunks(message_file, chunk_size), message.get_mail_options(), message.get_rcpt_options(), results)
+                        
+                except DeadlineExceeded:
+                    # transaction not completed, nobody in this batch get the message
+                    for to_addr in batch + pending:
+                        results[to_addr] = (None, b'deadline exceeded')
+                    break
+                    
+                except smtplib.SMTPRecipientsRefused:
+                    # every recipient rejected with 452, server limit is lower than half of batch
+                    if len(batch) > 1 and all(results.get(to_addr)[0] == 452 for to_addr in batch):
+                        rcpt_limit = len(batch) // 2
+                        pending = batch + pending
+                    continue
+                    
+                except smtplib.SMTPResponseException as e:
+                    # sender refused or data rejected, no recipient of this batch get the message
+                    for to_addr in batch:
+                        if results.get(to_addr, (250,))[0] in (250, 251):
+                            results[to_addr] = (e.smtp_code, e.smtp_error)
+                    continue
+                    
+                except (smtplib.SMTPServerDisconnected, OSError) as e:
+                    # transaction not completed, connection closed, send the rest after connecting again
+                    host = self.smtp_get_active().get('host')
+                    username = self.smtp_get_active().get('username')
+                    self.smtp_get_user(host, username)['is_login'] = False
+                    smtp.close()
+                    
+                    for to_addr in batch + pending:
+                        results[to_addr] = (None, ('server disconnected: %s' % e).encode('UTF-8'))
+                    break
+                
+                # server limit is lower than rcpt_limit
+                too_many = [to_addr for to_addr in batch if results.get(to_addr)[0] == 452]
+                if too_many and len(too_many) < len(batch):
+                    rcpt_limit = len(batch) - len(too_many)
+                    pending = too_many + pending
+                
+        return results
+        
+    def smtp_send_message_stream(self, message, chunk_size=STREAM_CHUNK_SIZE):
+        '''
+            send message without building whole message in memory
+            message = implementation of MessageBuilder object
+            chunk_size = maximum bytes read and sent at once
+            
+            message generated with MessageBuilder.generate_stream and written directly to smtp socket
+            use BDAT (CHUNKING, RFC 3030) if server support it, else use DATA with dot stuffing
+            not for LMTP connection, LMTP reply DATA per recipient
+            
+            return refused recipient like smtplib sendmail
+            {'john@gmail.com':(550, 'User unknown')}
+        '''
+        
+        from_addr, to_addrs = message.get_envelope()
+        chunks = join_chunks(message.generate_stream(chunk_size), chunk_size)
+        
+        return self.__smtp_send_chunks(self.smtp_get(), from_addr, to_addrs, chunks,
+            message.get_mail_options(), message.get_rcpt_options())
+        
+    def smtp_send_message_file(self, message_file, from_addr, to_addrs, mail_options=[], rcpt_options=[], chunk_size=STREAM_CHUNK_SIZE):
+        '''
+            send message from file object without loading it into memory
+            message_file = binary file object with CRLF line ending, ex: from MessageBuilder.generate_file()
+            from_addr = 'amru.rosyada@gmail.com'
+            to_addrs = ['john@gmail.com', 'doe@gmail.com']
+            
+            return refused recipient like smtp_send_message_stream
+        '''
+        
+        return self.__smtp_send_chunks(self.smtp_get(), from_addr, to_addrs, read_chunks(message_file, chunk_size),
+            mail_options, rcpt_options)
+        
+    def __smtp_send_chunks(self, smtp, from_addr, to_addrs, chunks, mail_options, rcpt_options, rcpt_results=None, progress=None):
         '''
+            run smtp transaction and send message chunks
+            chunk should not split CRLF, see dot_stuff
+            use BDAT if server support CHUNKING, else DATA with dot stuffing
+            rcpt_results = dictionary filled with RCPT TO reply of every recipient
+            progress = dictionary, 'data' set to True when message data start to be sent
+        '''
+        
+        smtp.ehlo_or_helo_if_needed()
+        
+        code, resp = smtp.mail(from_addr, mail_options)
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        
+        refused = {}
+        for to_addr in to_addrs:
+            code, resp = smtp.rcpt(to_addr, rcpt_options)
+            if rcpt_results is not None:
+                rcpt_results[to_addr] = (code, resp)
+                
+            if code not in (250, 251):
+                refused[to_addr] = (code, resp)
+                
+        if len(refused) == len(to_addrs):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
         
-        self.smtp_get().send_message(message.generate(), from_addr=None, to_addrs=None, mail_options=message.get_mail_options(), rcpt_options=message.get_rcpt_options())
+        if progress is not None:
+            progress['data'] = True
+            
+        if smtp.has_extn('chunking'):
+            # each BDAT need to know if it is the last chunk
+            # transaction always end with LAST, BDAT 0 LAST if there is no chunk
+            chunk = next(chunks, b'')
+            while chunk is not None:
+                next_chunk = next(chunks, None)
+                smtp.send(('BDAT %d%s\r\n' % (len(chunk), ' LAST' if next_chunk is None else '')).encode('ASCII'))
+                if chunk:
+                    smtp.send(chunk)
+                
+                code, resp = smtp.getreply()
+                if code != 250:
+                    smtp.rset()
+                    raise smtplib.SMTPDataError(code, resp)
+                    
+                chunk = next_chunk
+            
+            return refused
+        
+        code, resp = smtp.docmd('DATA')
+        if code != 354:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        
+        for chunk in dot_stuff(chunks):
+            smtp.send(chunk)
+            
+        smtp.send(b'.\r\n')
+        code, resp = smtp.getreply()
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, resp)
+            
+        return refused
         
 if __name__ == '__main__':
     pyemail = PxEmail()
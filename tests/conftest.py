@@ -0,0 +1,11 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import os
+import sys
+
+# module is in repository root, not installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,316 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import re
+import socketserver
+import threading
+
+def parse_uids(uid_set, uids):
+    '''
+        parse uid set of command, ex: 1:3,5 or 4:*
+        return existing uid in the set
+    '''
+
+    result = []
+    max_uid = max(uids) if uids else 0
+    for item in uid_set.split(','):
+        start, _, end = item.partition(':')
+        start = max_uid if start == '*' else int(start)
+        end = start if not end else max_uid if end == '*' else int(end)
+        result += [uid for uid in sorted(uids) if min(start, end) <= uid <= max(start, end) and uid not in result]
+
+    return result
+
+class FakeServer(socketserver.ThreadingTCPServer):
+    '''
+        local server running in background thread
+        handler_class = request handler of the protocol
+    '''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, handler_class):
+        super().__init__(('127.0.0.1', 0), handler_class)
+        # command received by server, ex: ['LOGIN user pass', 'SELECT INBOX']
+        self.commands = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    def get_port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    '''
+        minimal imap server for test, one request per line
+    '''
+
+    def write(self, data):
+        self.wfile.write(data if isinstance(data, bytes) else data.encode('UTF-8'))
+
+    def handle(self):
+        server = self.server
+        self.mailbox = None
+        self.write('* OK [CAPABILITY %s] ready\r\n' % server.capabilities)
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            tag, command = line.decode('UTF-8').rstrip('\r\n').split(' ', 1)
+            with server.lock:
+                server.commands.append(command)
+
+            name = command.split(' ', 1)[0].upper()
+            if name == 'UID':
+                name = 'UID ' + command.split(' ', 2)[1].upper()
+
+            handler = getattr(self, 'do_' + name.replace(' ', '_'), None)
+            if handler is None:
+                self.write('%s BAD unknown command\r\n' % tag)
+                continue
+
+            if handler(tag, command) is False:
+                return
+
+    def do_CAPABILITY(self, tag, command):
+        self.write('* CAPABILITY %s\r\n%s OK done\r\n' % (self.server.capabilities, tag))
+
+    def do_LOGIN(self, tag, command):
+        self.write('%s OK [CAPABILITY %s] logged in\r\n' % (tag, self.server.capabilities))
+
+    def do_LOGOUT(self, tag, command):
+        self.write('* BYE logout\r\n%s OK done\r\n' % tag)
+        return False
+
+    def do_NOOP(self, tag, command):
+        self.write('%s OK noop\r\n' % tag)
+
+    def do_LIST(self, tag, command):
+        for mailbox in self.server.mailboxes:
+            self.write('* LIST () "/" "%s"\r\n' % mailbox)
+
+        self.write('%s OK done\r\n' % tag)
+
+    def do_SELECT(self, tag, command):
+        mailbox = command.split(' ', 1)[1].strip('"')
+        messages = self.server.mailboxes.get(mailbox)
+        if messages is None:
+            self.mailbox = None
+            self.write('%s NO no such mailbox\r\n' % tag)
+            return
+
+        self.mailbox = mailbox
+        self.write('* %d EXISTS\r\n* OK [UIDVALIDITY %d] valid\r\n* OK [UIDNEXT %d] next\r\n%s OK [READ-WRITE] selected\r\n' % (
+            len(messages), self.server.uidvalidity, max(messages, default=0) + 1, tag))
+
+    do_EXAMINE = do_SELECT
+
+    def do_UNSELECT(self, tag, command):
+        self.mailbox = None
+        self.write('%s OK unselected\r\n' % tag)
+
+    do_CLOSE = do_UNSELECT
+
+    def do_STATUS(self, tag, command):
+        mailbox = re.match(r'STATUS ("[^"]*"|\S+) ', command, re.I).group(1)
+        messages = self.server.mailboxes.get(mailbox.strip('"'), {})
+        self.write('* STATUS %s (MESSAGES %d UIDNEXT %d UIDVALIDITY %d)\r\n%s OK done\r\n' % (
+            mailbox, len(messages), max(messages, default=0) + 1, self.server.uidvalidity, tag))
+
+    def do_UID_SEARCH(self, tag, command):
+        if self.mailbox is None:
+            self.write('%s BAD no mailbox selected\r\n' % tag)
+            return
+
+        messages = self.server.mailboxes.get(self.mailbox)
+        uids = sorted(messages)
+        if 'UNSEEN' in command.upper():
+            uids = [uid for uid in uids if '\\Seen' not in messages.get(uid).get('flags')]
+
+        self.write('* SEARCH %s\r\n%s OK search\r\n' % (' '.join(str(uid) for uid in uids), tag))
+
+    def do_UID_FETCH(self, tag, command):
+        if self.mailbox is None:
+            self.write('%s BAD no mailbox selected\r\n' % tag)
+            return
+
+        _, _, uid_set, items = command.split(' ', 3)
+        items = items.upper()
+        messages = self.server.mailboxes.get(self.mailbox)
+        response = []
+        for number, uid in enumerate(parse_uids(uid_set, messages), 1):
+            message = messages.get(uid)
+            item = b'UID %d FLAGS (%s)' % (uid, ' '.join(message.get('flags')).encode('ASCII'))
+            if 'RFC822.SIZE' in items:
+                item += b' RFC822.SIZE %d' % len(message.get('body'))
+
+            if 'BODY.PEEK[HEADER]' in items or 'BODY[HEADER]' in items:
+                header = message.get('body').split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+                item += b' BODY[HEADER] {%d}\r\n' % len(header) + header
+
+            elif 'BODY.PEEK[]' in items or 'BODY[]' in items:
+                item += b' BODY[] {%d}\r\n' % len(message.get('body')) + message.get('body')
+
+            response.append(b'* %d FETCH (' % number + item + b')\r\n')
+
+        self.write(b''.join(response) + b'%s OK fetch\r\n' % tag.encode('ASCII'))
+
+    def do_UID_COPY(self, tag, command):
+        _, name, uid_set, mailbox = command.split(' ', 3)
+        source = self.server.mailboxes.get(self.mailbox)
+        destination = self.server.mailboxes.setdefault(mailbox.strip('"'), {})
+        uids = parse_uids(uid_set, source)
+        dest_uids = []
+        for uid in uids:
+            dest_uids.append(max(destination, default=0) + 1)
+            destination[dest_uids[-1]] = dict(source.get(uid), flags=list(source.get(uid).get('flags')))
+
+        copyuid = '[COPYUID %d %s %s] ' % (self.server.uidvalidity, ','.join(str(uid) for uid in uids),
+            ','.join(str(uid) for uid in dest_uids)) if self.server.copyuid and uids else ''
+
+        if name.upper() == 'COPY':
+            self.write('%s OK %scopy completed\r\n' % (tag, copyuid))
+            return
+
+        # COPYUID of MOVE is sent as untagged OK before EXPUNGE
+        if copyuid:
+            self.write('* OK %smoved\r\n' % copyuid)
+
+        for uid in uids:
+            self.write('* %d EXPUNGE\r\n' % (sorted(source).index(uid) + 1))
+            del source[uid]
+
+        self.write('%s OK move completed\r\n' % tag)
+
+    do_UID_MOVE = do_UID_COPY
+
+class FakeIMAPServer(FakeServer):
+    '''
+        fake imap server
+        mailboxes = {'INBOX':{1:{'body':b'...', 'flags':['\\Seen']}}}
+    '''
+
+    def __init__(self, mailboxes=None, capabilities='IMAP4rev1 UIDPLUS UNSELECT MOVE'):
+        self.mailboxes = mailboxes if mailboxes is not None else {'INBOX':{}}
+        self.capabilities = capabilities
+        self.uidvalidity = 1
+        # False to answer COPY and MOVE without COPYUID response code
+        self.copyuid = True
+        super().__init__(FakeIMAPHandler)
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    '''
+        minimal smtp server for test
+    '''
+
+    def write(self, line):
+        self.wfile.write(line.encode('UTF-8') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        self.write('220 fake smtp ready')
+        recipients = []
+        data = b''
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.decode('UTF-8').rstrip('\r\n')
+            with server.lock:
+                server.commands.append(command)
+
+            name = command.split(' ', 1)[0].upper()
+            if server.drop.get(name):
+                # connection dropped without reply
+                server.drop[name] -= 1
+                return
+
+            if name in ('EHLO', 'HELO'):
+                extensions = ['fake', 'AUTH PLAIN', '8BITMIME'] + (['CHUNKING'] if server.chunking else [])
+                for extension in extensions[:-1]:
+                    self.write('250-' + extension)
+
+                self.write('250 ' + extensions[-1])
+
+            elif name == 'AUTH':
+                self.write('235 authenticated')
+
+            elif name == 'MAIL':
+                recipients = []
+                data = b''
+                self.write('250 ok')
+
+            elif name == 'RCPT':
+                address = command.split('<', 1)[1].split('>', 1)[0]
+                if address in server.reject:
+                    self.write('550 no such user')
+                elif address in server.temporary:
+                    self.write('450 try again later')
+                else:
+                    recipients.append(address)
+                    self.write('250 ok')
+
+            elif name == 'DATA':
+                self.write('354 go ahead')
+                while True:
+                    line = self.rfile.readline()
+                    if line == b'.\r\n':
+                        break
+
+                    data += line[1:] if line.startswith(b'.') else line
+
+                server.messages.append((recipients, data))
+                self.write('250 queued')
+
+            elif name == 'BDAT':
+                arguments = command.split()
+                data += self.rfile.read(int(arguments[1]))
+                if len(arguments) > 2 and arguments[2].upper() == 'LAST':
+                    server.messages.append((recipients, data))
+
+                self.write('250 ok')
+
+            elif name in ('RSET', 'NOOP'):
+                self.write('250 ok')
+
+            elif name == 'QUIT':
+                self.write('221 bye')
+                return
+
+            else:
+                self.write('500 unknown command')
+
+class FakeSMTPServer(FakeServer):
+    '''
+        fake smtp server
+        messages = received message [(recipients, data)]
+        reject = address refused with 550, temporary = address refused with 450
+        drop = number of time connection dropped when command received, ex: {'MAIL':1}
+    '''
+
+    def __init__(self, chunking=True, reject=(), temporary=()):
+        self.chunking = chunking
+        self.reject = reject
+        self.temporary = temporary
+        self.drop = {}
+        self.messages = []
+        super().__init__(FakeSMTPHandler)
+
+def make_message(number, body=b'hello\r\n'):
+    '''
+        create raw email for fake server
+    '''
+
+    return (b'From: sender%d@mail.com\r\nTo: me@mail.com\r\nSubject: hello %d\r\nMessage-ID: <%d@mail.com>\r\n\r\n' % (
+        number, number, number)) + body
@@ -0,0 +1,77 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import unittest
+
+from emailbatch import FetchBatcher, is_body_fetch, get_fetch_size
+
+class FetchBatcherTest(unittest.TestCase):
+
+    def test_split_by_count(self):
+        batcher = FetchBatcher(4)
+
+        self.assertEqual(list(batcher.batches(list(range(10)))), [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_pack_by_size(self):
+        batcher = FetchBatcher(10, min_bytes=1, max_bytes=100)
+        sizes = [40, 40, 40, 500, 10, 10]
+
+        # email bigger than limit is still fetched alone
+        self.assertEqual(list(batcher.batches(list(range(6)), sizes)), [[0, 1], [2], [3], [4, 5]])
+
+    def test_lazy_sizes(self):
+        batcher = FetchBatcher(3, max_count=4)
+        chunks = []
+
+        def fetch_sizes(chunk):
+            chunks.append(list(chunk))
+            return [10] * len(chunk)
+
+        batches = batcher.batches(list(range(10)), fetch_sizes)
+        self.assertEqual(next(batches), [0, 1, 2])
+        self.assertEqual(chunks, [[0, 1, 2, 3]])
+
+        self.assertEqual(list(batches), [[3, 4, 5], [6, 7, 8], [9]])
+        self.assertEqual(chunks, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_grow_and_shrink(self):
+        batcher = FetchBatcher(100, max_count=1000, target_time=1.0)
+
+        batcher.record(100, 100000, 0.25)
+        self.assertEqual(batcher.get_stats().get('count'), 200)
+
+        batcher.record(200, 200000, 4.0)
+        self.assertEqual(batcher.get_stats().get('count'), 100)
+
+        batcher.failure()
+        self.assertEqual(batcher.get_stats().get('count'), 50)
+
+    def test_small_batch_not_grow(self):
+        batcher = FetchBatcher(100)
+        batcher.record(5, 5000, 0.01)
+
+        self.assertEqual(batcher.get_stats().get('count'), 100)
+
+    def test_limit_bound(self):
+        batcher = FetchBatcher(100, min_count=10, max_count=150)
+        for i in range(5):
+            batcher.record(batcher.get_limit()[0], 1000, 0.01)
+        self.assertEqual(batcher.get_limit()[0], 150)
+
+        for i in range(10):
+            batcher.record(batcher.get_limit()[0], 1000, 100)
+        self.assertEqual(batcher.get_limit()[0], 10)
+
+    def test_body_fetch(self):
+        self.assertTrue(is_body_fetch('(UID BODY.PEEK[])'))
+        self.assertTrue(is_body_fetch('(UID RFC822)'))
+        self.assertFalse(is_body_fetch('(UID RFC822.SIZE BODY.PEEK[HEADER])'))
+
+    def test_fetch_size(self):
+        self.assertEqual(get_fetch_size([{'UID':'1', 'BODY[]':memoryview(b'abc')}, {'BODY[]':b'de'}]), 5)
+
+if __name__ == '__main__':
+    unittest.main()
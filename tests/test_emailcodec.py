@@ -0,0 +1,123 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from email.header import Header
+
+from emailcodec import BinaryCodec, PickleCodec, CacheCodec, CodecError, decode_cache, migrate_cache
+
+class BinaryCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = BinaryCodec()
+        self.email = {'ID':'30411',
+            'From':'Jhon Doe <jhon@mail.com>',
+            'CC':None,
+            'Size':1234,
+            'Score':0.5,
+            'Seen':True,
+            'Deleted':False,
+            'Subject':'héllo \U0001f600 wörld',
+            'Message':'line\r\n' * 100,
+            'Attachment':[{'name':'report.pdf', 'mime':'application/pdf'}],
+            'InlineAttachment':[]}
+
+    def test_round_trip(self):
+        data = self.codec.encode(self.email)
+
+        self.assertTrue(data.startswith(BinaryCodec.MAGIC))
+        self.assertEqual(self.codec.decode(data), self.email)
+        self.assertEqual(self.codec.decode(memoryview(data)), self.email)
+
+    def test_header_value(self):
+        email_data = {'Subject':Header('héllo', 'UTF-8'), 'To':[Header('jhon@mail.com')]}
+
+        self.assertEqual(self.codec.decode(self.codec.encode(email_data)), {'Subject':'héllo', 'To':['jhon@mail.com']})
+
+    def test_unsupported_value(self):
+        with self.assertRaises(CodecError):
+            self.codec.encode({'ID':object()})
+
+        with self.assertRaises(CodecError):
+            self.codec.encode(['not', 'dictionary'])
+
+    def test_corrupted(self):
+        data = self.codec.encode(self.email)
+
+        with self.assertRaises(CodecError):
+            self.codec.decode(data[:-10])
+
+        with self.assertRaises(CodecError):
+            self.codec.decode(b'XXXX' + data[4:])
+
+    def test_peek(self):
+        data = self.codec.encode(self.email)
+
+        self.assertEqual(self.codec.peek(data, ('Message', 'Size', 'Missing')),
+            {'Message':self.email.get('Message'), 'Size':1234})
+
+    def test_decode_cache(self):
+        pickled = PickleCodec().encode(self.email)
+
+        self.assertEqual(decode_cache(self.codec.encode(self.email)), self.email)
+        self.assertEqual(decode_cache(pickled, allow_pickle=True), self.email)
+
+        # pickle is never loaded unless allowed
+        with self.assertRaises(CodecError):
+            decode_cache(pickled)
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            CacheCodec()
+
+class MigrateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, path, value):
+        filename = os.path.join(self.directory, *path.split('/'))
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(PickleCodec().encode(value))
+
+        return filename
+
+    def read(self, path):
+        with open(os.path.join(self.directory, *path.split('/')), 'rb') as f:
+            return BinaryCodec().decode(f.read())
+
+    def test_current_layout(self):
+        self.write('jhon/INBOX/10/10', {'ID':'10'})
+
+        self.assertEqual(migrate_cache(self.directory), {'migrated':1, 'skipped':0, 'legacy':0, 'failed':{}})
+        self.assertEqual(self.read('jhon/INBOX/10/10'), {'ID':'10'})
+        self.assertEqual(migrate_cache(self.directory).get('skipped'), 1)
+
+    def test_legacy_layout(self):
+        legacy = self.write('jhon/10/10', {'ID':'10'})
+        self.write('jhon/11/11', {'ID':'11'})
+        self.write('jhon/%5BGmail%5D%2FSent/11/11', {'ID':'11', 'Subject':'new'})
+
+        # mailbox of legacy cache is unknown, left as it is
+        self.assertEqual(migrate_cache(self.directory).get('legacy'), 2)
+        self.assertTrue(os.path.isfile(legacy))
+
+        result = migrate_cache(self.directory, legacy_mailbox='[Gmail]/Sent')
+        self.assertEqual((result.get('migrated'), result.get('skipped'), result.get('legacy')), (1, 2, 0))
+        self.assertEqual(self.read('jhon/%5BGmail%5D%2FSent/10/10'), {'ID':'10'})
+        self.assertEqual(self.read('jhon/%5BGmail%5D%2FSent/11/11'), {'ID':'11', 'Subject':'new'})
+        self.assertFalse(os.path.exists(os.path.dirname(legacy)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import socket
+import threading
+import time
+import unittest
+
+from emaildeadline import Deadline, DeadlineExceeded
+
+class DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_never_expire(self):
+        deadline = Deadline()
+
+        self.assertIsNone(deadline.remaining())
+        self.assertFalse(deadline.is_expired())
+        deadline.check()
+
+    def test_get(self):
+        deadline = Deadline(5)
+
+        self.assertIs(Deadline.get(deadline), deadline)
+        self.assertIsNone(Deadline.get(None))
+        self.assertLessEqual(Deadline.get(2).remaining(), 2)
+
+    def test_check(self):
+        with self.assertRaises(DeadlineExceeded) as context:
+            Deadline(0).check('5:10')
+
+        self.assertEqual(context.exception.continuation, '5:10')
+
+        # handler of dropped connection must not catch it
+        self.assertNotIsInstance(context.exception, OSError)
+
+    def test_apply_restore_timeout(self):
+        self.client.settimeout(30)
+        with Deadline(5).apply(self.client):
+            self.assertLessEqual(self.client.gettimeout(), 5)
+
+        self.assertEqual(self.client.gettimeout(), 30)
+
+    def test_apply_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExceeded) as context:
+            with Deadline(0.2).apply(self.client):
+                self.client.recv(10)
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertIsNotNone(context.exception.__cause__)
+
+    def test_apply_slow_response(self):
+        # each read complete before socket timeout, but the whole response is slower than deadline
+        def send_slowly():
+            for i in range(10):
+                try:
+                    self.server.send(b'* %d EXISTS\r\n' % i)
+                except OSError:
+                    return
+
+                time.sleep(0.1)
+
+        sender = threading.Thread(target=send_slowly)
+        sender.start()
+
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            with Deadline(0.35).apply(self.client):
+                while self.client.recv(100):
+                    pass
+
+        self.assertLess(time.monotonic() - start, 0.8)
+        sender.join()
+
+    def test_one_timer(self):
+        deadline = Deadline(5)
+        with deadline.apply(self.client):
+            threads = threading.active_count()
+
+        for i in range(10):
+            with deadline.apply(self.client):
+                self.server.send(b'x')
+                self.client.recv(1)
+
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_apply_expired(self):
+        with self.assertRaises(DeadlineExceeded) as context:
+            with Deadline(0).apply(self.client):
+                self.fail('operation run after deadline')
+
+        # nothing sent, connection can be used again
+        self.assertIsNone(context.exception.__cause__)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from emailindex import AddressIndex
+
+class AddressIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = AddressIndex(self.directory + os.path.sep + 'address.db')
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def get_count(self):
+        return dict((contact.get('address'), contact.get('count')) for contact in self.index.get_top(100))
+
+    def get_row_count(self):
+        # count of address row, contact count must always match it
+        counts = {}
+        for mailbox in ('INBOX', 'Archive'):
+            for contact in self.index.get_top(100, mailbox=mailbox):
+                counts[contact.get('address')] = counts.get(contact.get('address'), 0) + contact.get('count')
+
+        return counts
+
+    def test_add(self):
+        self.index.add_many('INBOX', [
+            ('1', {'from':'Jhon <jhon@mail.com>', 'to':'jane@mail.com, team@mail.com'}, 1.0),
+            ('2', {'from':'jhon@mail.com', 'cc':'jane@mail.com'}, 2.0)])
+
+        self.assertEqual(self.get_count(), {'jhon@mail.com':2, 'jane@mail.com':2, 'team@mail.com':1})
+        self.assertEqual(self.get_count(), self.get_row_count())
+        self.assertEqual(self.index.search('jhon@mail.com'), {'INBOX':['1', '2']})
+
+    def test_repeated_address(self):
+        # same address twice in one field and same uid twice in one call is one row
+        self.index.add_many('INBOX', [
+            ('1', {'to':'jane@mail.com, Jane <jane@mail.com>'}, 1.0),
+            ('1', {'to':'jane@mail.com'}, 1.0)])
+
+        self.assertEqual(self.get_count(), {'jane@mail.com':1})
+        self.assertEqual(self.get_count(), self.get_row_count())
+
+    def test_add_again(self):
+        self.index.add('INBOX', '1', {'from':'jhon@mail.com'})
+        self.index.add('INBOX', '1', {'from':'jhon@mail.com'})
+
+        self.assertEqual(self.get_count(), {'jhon@mail.com':1})
+
+    def test_copy(self):
+        self.index.add('INBOX', '1', {'from':'jhon@mail.com', 'to':'jane@mail.com'})
+        self.index.copy('INBOX', '1', 'Archive', '10')
+        self.index.copy('INBOX', '1', 'Archive', '10')
+
+        self.assertEqual(self.get_count(), {'jhon@mail.com':2, 'jane@mail.com':2})
+        self.assertEqual(self.get_count(), self.get_row_count())
+
+    def test_remove(self):
+        self.index.add_many('INBOX', [('1', {'from':'jhon@mail.com'}, 1.0), ('2', {'from':'jhon@mail.com'}, 2.0)])
+        self.index.copy('INBOX', '1', 'Archive', '10')
+
+        self.index.remove('INBOX', ['1'])
+        self.assertEqual(self.get_count(), {'jhon@mail.com':2})
+
+        self.index.remove('INBOX')
+        self.index.remove('Archive')
+        self.assertEqual(self.get_count(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import smtplib
+import threading
+import unittest
+
+from emailentity import IMAPEntity, SMTPEntity
+from emailpool import IMAPPool, SMTPPool, is_socket_open
+from fakeserver import FakeIMAPServer, FakeSMTPServer
+
+HOST = '127.0.0.1'
+USERNAME = 'jhondoe@mail.com'
+
+class IMAPPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeIMAPServer({'INBOX':{}})
+        imap_entity = IMAPEntity()
+        imap_entity.add(HOST, USERNAME, 'secret', self.server.get_port(), timeout=5)
+        self.pool = IMAPPool(imap_entity, HOST, USERNAME, max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_reuse(self):
+        imap = self.pool.acquire()
+        self.assertEqual(imap.state, 'AUTH')
+        self.pool.release(imap)
+
+        self.assertIs(self.pool.acquire(), imap)
+        self.assertEqual(self.pool.get_state().get('size'), 1)
+
+    def test_full(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+
+        self.assertIsNot(first, second)
+        self.assertIsNone(self.pool.acquire(timeout=0))
+        self.assertFalse(self.pool.is_wanted())
+
+        # waiting thread get released connection
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(self.pool.acquire(timeout=5)))
+        thread.start()
+        self.pool.release(first)
+        thread.join()
+
+        self.assertIs(acquired[0], first)
+        self.pool.release(first)
+        self.pool.release(second)
+
+    def test_discard(self):
+        imap = self.pool.acquire()
+        self.pool.release(imap, discard=True)
+
+        self.assertEqual(self.pool.get_state().get('size'), 0)
+        self.assertFalse(is_socket_open(imap.sock))
+
+    def test_dead_connection_replaced(self):
+        imap = self.pool.acquire()
+        self.pool.release(imap)
+        imap.shutdown()
+
+        replaced = self.pool.acquire()
+        self.assertIsNot(replaced, imap)
+        self.assertEqual(self.pool.get_state().get('size'), 1)
+        self.pool.release(replaced)
+
+    def test_release_unselect(self):
+        imap = self.pool.acquire()
+        imap.select('INBOX')
+        self.pool.release(imap)
+
+        self.assertEqual(self.server.commands[-1], 'UNSELECT')
+        self.assertEqual(self.pool.acquire().state, 'AUTH')
+
+    def test_connection_discard_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.pool.connection() as imap:
+                raise ValueError('failed')
+
+        self.assertEqual(self.pool.get_state().get('size'), 0)
+
+    def test_keepalive(self):
+        self.pool.release(self.pool.acquire())
+
+        self.assertEqual(self.pool.keepalive(idle_time=0), {'checked':1, 'closed':0})
+        self.assertEqual(self.server.commands[-1], 'NOOP')
+
+class SMTPPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer()
+        self.smtp_entity = SMTPEntity()
+        self.smtp_entity.add(HOST, USERNAME, 'secret', self.server.get_port(), timeout=5)
+        self.pool = SMTPPool(self.smtp_entity, HOST, USERNAME, max_size=2, max_messages=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.smtp_entity.get_smtp(HOST, USERNAME).close()
+        self.server.stop()
+
+    def test_reuse(self):
+        smtp = self.pool.acquire()
+        self.pool.release(smtp)
+
+        self.assertIs(self.pool.acquire(), smtp)
+        self.assertEqual(self.pool.get_state().get('size'), 1)
+
+    def test_max_messages(self):
+        smtp = self.pool.acquire()
+        self.pool.release(smtp, messages=2)
+
+        # recycled after max_messages
+        self.assertEqual(self.pool.get_state().get('size'), 0)
+        self.assertIsNot(self.pool.acquire(), smtp)
+
+    def test_release_twice(self):
+        smtp = self.pool.acquire()
+        self.pool.release(smtp)
+        self.pool.release(smtp)
+        self.pool.release(object())
+
+        state = self.pool.get_state()
+        self.assertEqual((state.get('size'), state.get('idle'), state.get('in_use')), (1, 1, 0))
+
+    def test_response_error_reset(self):
+        with self.assertRaises(smtplib.SMTPResponseException):
+            with self.pool.connection() as smtp:
+                raise smtplib.SMTPResponseException(550, b'rejected')
+
+        # connection kept after successful RSET
+        self.assertEqual(self.server.commands[-1].upper(), 'RSET')
+        self.assertEqual(self.pool.get_state().get('idle'), 1)
+
+    def test_error_discard(self):
+        with self.assertRaises(OSError):
+            with self.pool.connection() as smtp:
+                raise OSError('connection reset')
+
+        self.assertEqual(self.pool.get_state().get('size'), 0)
+        self.assertFalse(is_socket_open(smtp.sock))
+
+    def test_full(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+
+        self.assertIsNone(self.pool.acquire(timeout=0))
+        self.pool.release(first)
+        self.pool.release(second)
+
+if __name__ == '__main__':
+    unittest.main()
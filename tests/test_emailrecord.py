@@ -0,0 +1,56 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import io
+import unittest
+
+from emailrecord import MessageRecord, NOT_DECODED, FIELD_INDEX, parse_header_fields, read_records, write_records
+
+HEADER = (b'From: =?UTF-8?B?SsO2aG4=?= <jhon@mail.com>\r\n'
+    b'To: jane@mail.com,\r\n team@mail.com\r\n'
+    b'Subject: hello\r\n'
+    b'Message-ID: <1@mail.com>\r\n\r\n')
+
+class MessageRecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.record = MessageRecord.from_header('30411', HEADER, 120, ['\\Seen', 'Work'])
+
+    def test_parse_header_fields(self):
+        fields = parse_header_fields(HEADER)
+
+        self.assertEqual(fields[FIELD_INDEX['To']], b'jane@mail.com, team@mail.com')
+        self.assertIsNone(fields[FIELD_INDEX['CC']])
+
+    def test_get(self):
+        self.assertEqual(self.record.get('ID'), '30411')
+        self.assertEqual(self.record['Size'], 120)
+        self.assertEqual(self.record.get('Flags'), ['\\Seen', 'Work'])
+        self.assertEqual(self.record.get('From'), 'Jöhn <jhon@mail.com>')
+        self.assertEqual(self.record.get('CC', ''), '')
+        self.assertRaises(KeyError, lambda: self.record['Unknown'])
+
+    def test_decode_on_field_access(self):
+        self.assertEqual(self.record.get('Subject'), 'hello')
+
+        decoded = [name for name, index in FIELD_INDEX.items() if self.record._decoded[index] is not NOT_DECODED]
+        self.assertEqual(decoded, ['Subject'])
+
+        self.assertIsNone(self.record.get('CC'))
+        self.assertIsNone(self.record._decoded[FIELD_INDEX['CC']])
+
+    def test_records_file(self):
+        fp = io.BytesIO()
+        write_records([self.record, MessageRecord(7, (None,) * len(FIELD_INDEX))], fp)
+        fp.seek(0)
+
+        records = read_records(fp)
+        self.assertEqual(records[0].to_dict(), self.record.to_dict())
+        self.assertEqual(records[1].get('ID'), '7')
+        self.assertIsNone(records[1].get('Size'))
+
+if __name__ == '__main__':
+    unittest.main()
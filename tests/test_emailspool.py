@@ -0,0 +1,173 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import os
+import shutil
+import smtplib
+import tempfile
+import time
+import unittest
+
+from emailspool import EmailSpool, SpoolFlag
+
+class EmailSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # reply of each send, exception is raised, default nobody refused
+        self.replies = []
+        self.sent = []
+        self.spool = self.create_spool()
+
+    def tearDown(self):
+        self.spool.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def create_spool(self, **options):
+        return EmailSpool(self.directory, self.send, **dict({'rate':0, 'max_attempts':3, 'base_delay':60}, **options))
+
+    def send(self, entry, message_file):
+        self.sent.append((entry.get('host'), entry.get('to_addrs'), message_file.read()))
+        reply = self.replies.pop(0) if self.replies else {}
+        if isinstance(reply, Exception):
+            raise reply
+
+        return reply
+
+    def enqueue(self, host='smtp.mail.com', to_addrs=('john@mail.com',), data=b'hello\r\n'):
+        message_file = self.spool.create_message_file()
+        with open(message_file, 'wb') as f:
+            f.write(data)
+
+        return self.spool.enqueue(host, 'jhondoe@mail.com', message_file, 'jhondoe@mail.com', to_addrs)
+
+    def test_sent(self):
+        spool_id = self.enqueue()
+
+        self.assertEqual(self.spool.run_pending(), 1)
+        self.assertEqual(self.sent, [('smtp.mail.com', ['john@mail.com'], b'hello\r\n')])
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.SENT)
+        self.assertFalse(os.path.exists(self.spool.get(spool_id).get('message_file')))
+
+    def test_temporary_failure_retried(self):
+        self.replies = [smtplib.SMTPServerDisconnected('dropped')]
+        spool_id = self.enqueue()
+        self.spool.run_pending()
+
+        entry = self.spool.get(spool_id)
+        self.assertEqual(entry.get('status'), SpoolFlag.QUEUED)
+        self.assertEqual(entry.get('attempts'), 1)
+        self.assertGreaterEqual(entry.get('next_attempt'), time.time() + 59)
+        # not due yet
+        self.assertEqual(self.spool.run_pending(), 0)
+
+    def test_max_attempts(self):
+        self.replies = [smtplib.SMTPResponseException(421, b'busy')] * 3
+        self.spool = self.create_spool(base_delay=0)
+        spool_id = self.enqueue()
+
+        for i in range(3):
+            self.spool.run_pending()
+
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.FAILED)
+        self.assertEqual(len(self.sent), 3)
+
+    def test_permanent_failure(self):
+        self.replies = [smtplib.SMTPResponseException(554, b'rejected')]
+        spool_id = self.enqueue()
+        self.spool.run_pending()
+
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.FAILED)
+
+    def test_refused_recipient_retried(self):
+        self.replies = [{'later@mail.com':(450, b'try later'), 'nobody@mail.com':(550, b'no such user')}]
+        spool_id = self.enqueue(to_addrs=['john@mail.com', 'later@mail.com', 'nobody@mail.com'])
+        self.spool.run_pending()
+
+        entry = self.spool.get(spool_id)
+        self.assertEqual(entry.get('status'), SpoolFlag.QUEUED)
+        self.assertEqual(entry.get('to_addrs'), ['later@mail.com'])
+
+    def test_all_recipients_refused_temporary(self):
+        self.replies = [smtplib.SMTPRecipientsRefused({'john@mail.com':(452, b'mailbox full')})]
+        spool_id = self.enqueue()
+        self.spool.run_pending()
+
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.QUEUED)
+
+    def test_rate_limit(self):
+        self.spool = self.create_spool(rate=1)
+        first = self.enqueue()
+        second = self.enqueue()
+        other = self.enqueue('smtp.other.com')
+
+        # second message wait for host rate, but doesn't block message of other host
+        self.assertEqual(self.spool.run_pending(), 2)
+        self.assertEqual(self.spool.get(first).get('status'), SpoolFlag.SENT)
+        self.assertEqual(self.spool.get(second).get('status'), SpoolFlag.QUEUED)
+        self.assertEqual(self.spool.get(other).get('status'), SpoolFlag.SENT)
+
+    def test_prepare(self):
+        def prepare(message_file):
+            with open(message_file, 'wb') as f:
+                f.write(b'prepared\r\n')
+
+        spool_id = self.spool.enqueue('smtp.mail.com', 'jhondoe@mail.com', self.spool.create_message_file(),
+            'jhondoe@mail.com', ['john@mail.com'], prepare=prepare)
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.PREPARING)
+
+        self.spool.run_pending()
+        self.assertEqual(self.sent, [('smtp.mail.com', ['john@mail.com'], b'prepared\r\n')])
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.SENT)
+
+    def test_prepare_failed(self):
+        def prepare(message_file):
+            with open(message_file, 'wb') as f:
+                f.write(b'partial')
+
+            raise OSError('attachment not found')
+
+        message_file = self.spool.create_message_file()
+        spool_id = self.spool.enqueue('smtp.mail.com', 'jhondoe@mail.com', message_file,
+            'jhondoe@mail.com', ['john@mail.com'], prepare=prepare)
+        self.spool.run_pending()
+
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.FAILED)
+        self.assertFalse(os.path.exists(message_file))
+        self.assertEqual(self.sent, [])
+
+    def test_prepare_on_stop(self):
+        def prepare(message_file):
+            with open(message_file, 'wb') as f:
+                f.write(b'prepared\r\n')
+
+        spool_id = self.spool.enqueue('smtp.mail.com', 'jhondoe@mail.com', self.spool.create_message_file(),
+            'jhondoe@mail.com', ['john@mail.com'], prepare=prepare)
+        self.spool.stop()
+
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.QUEUED)
+
+    def test_worker_wake_up(self):
+        self.spool.start()
+        # worker is waiting for message, enqueue must wake it up without waiting for poll interval
+        time.sleep(0.1)
+        spool_id = self.enqueue()
+
+        deadline = time.time() + 2
+        while self.spool.get(spool_id).get('status') != SpoolFlag.SENT and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.SENT)
+
+    def test_restart(self):
+        spool_id = self.enqueue()
+        self.spool = self.create_spool()
+
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.QUEUED)
+        self.assertEqual(self.spool.run_pending(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
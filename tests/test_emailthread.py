@@ -0,0 +1,86 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from emailthread import ThreadIndex, normalize_subject, parse_thread_response
+
+class NormalizeSubjectTest(unittest.TestCase):
+
+    def test_prefix(self):
+        self.assertEqual(normalize_subject('Re: Fwd:  Hello  World'), ('hello world', True))
+        self.assertEqual(normalize_subject('RE[2]: report'), ('report', True))
+        self.assertEqual(normalize_subject('Regarding report'), ('regarding report', False))
+
+class ParseThreadResponseTest(unittest.TestCase):
+
+    def test_nested(self):
+        threads = parse_thread_response([b'(2)(3 6 (4 23)(44 7 96))'])
+
+        self.assertEqual([node.get('uid') for node in threads], ['2', '3'])
+        self.assertEqual(threads[1].get('children')[0].get('uid'), '6')
+        self.assertEqual([node.get('uid') for node in threads[1].get('children')[0].get('children')], ['4', '44'])
+
+class ThreadIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = self.directory + os.path.sep + '.threadindex'
+        self.index = ThreadIndex(self.filename)
+        self.index.add('1', '<a@mail.com>', subject='report', date='Mon, 1 Jan 2024 10:00:00 +0000')
+        self.index.add('2', '<b@mail.com>', '<a@mail.com>', '<a@mail.com>', 'Re: report', 'Mon, 1 Jan 2024 11:00:00 +0000')
+        self.index.add('3', '<c@mail.com>', subject='other', date='Mon, 1 Jan 2024 09:00:00 +0000')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_threads(self):
+        threads = self.index.get_threads()
+
+        self.assertEqual([node.get('uid') for node in threads], ['1', '3'])
+        self.assertEqual([node.get('uid') for node in threads[0].get('children')], ['2'])
+        self.assertEqual(self.index.get_thread_id('2'), '<a@mail.com>')
+
+    def test_reply_by_subject(self):
+        self.index.add('4', '<d@mail.com>', subject='RE: Report', date='Mon, 1 Jan 2024 12:00:00 +0000')
+
+        self.assertEqual(self.index.get_thread_id('4'), '<a@mail.com>')
+
+    def test_reply_before_parent(self):
+        self.index.add('5', '<f@mail.com>', references='<e@mail.com>', subject='Re: new')
+        self.assertEqual(self.index.get_thread_id('5'), '<e@mail.com>')
+
+        self.index.add('6', '<e@mail.com>', subject='new')
+        self.assertEqual(self.index.get_thread_id('5'), '<e@mail.com>')
+        self.assertEqual(self.index.get_thread_id('6'), '<e@mail.com>')
+
+    def test_remove(self):
+        self.index.remove(['1'])
+
+        # parent without email kept while referenced by reply
+        self.assertIsNone(self.index.get_thread_id('1'))
+        self.assertEqual(self.index.get_thread_id('2'), '<a@mail.com>')
+
+        self.index.remove(['2'])
+        self.assertEqual([node.get('uid') for node in self.index.get_threads()], ['3'])
+
+    def test_sorted(self):
+        self.assertEqual(self.index.get_sorted(), ['2', '1', '3'])
+        self.assertEqual(self.index.get_sorted(reverse=False), ['3', '1', '2'])
+
+    def test_save(self):
+        self.index.save()
+
+        self.assertEqual(os.listdir(self.directory), ['.threadindex'])
+        loaded = ThreadIndex(self.filename)
+        self.assertEqual(loaded.get_threads(), self.index.get_threads())
+        self.assertEqual(loaded.get_thread_id('2'), '<a@mail.com>')
+
+if __name__ == '__main__':
+    unittest.main()
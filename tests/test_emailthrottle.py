@@ -0,0 +1,68 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import imaplib
+import socket
+import unittest
+
+from emailthrottle import Backoff, is_throttled, is_disconnected
+
+class ThrottleTest(unittest.TestCase):
+
+    def test_response_code(self):
+        self.assertTrue(is_throttled(imaplib.IMAP4.error('PXF4 command error: NO [THROTTLED] slow down')))
+        self.assertTrue(is_throttled(b'[UNAVAILABLE] try later'))
+        self.assertTrue(is_throttled([b'[LIMIT] too many commands']))
+        self.assertTrue(is_throttled('[INUSE] mailbox locked'))
+        self.assertTrue(is_throttled(imaplib.IMAP4.abort('[ALERT] Too many simultaneous connections. (Failure)')))
+        self.assertTrue(is_throttled('Server Unavailable. 15'))
+
+    def test_free_text_not_throttled(self):
+        self.assertFalse(is_throttled(imaplib.IMAP4.error('too many arguments')))
+        self.assertFalse(is_throttled('please try again later'))
+        self.assertFalse(is_throttled([b'OK done']))
+
+    def test_other_exception_not_throttled(self):
+        self.assertFalse(is_throttled(ValueError('too many values to unpack')))
+        self.assertFalse(is_throttled(ValueError('[THROTTLED]')))
+        self.assertFalse(is_throttled(OSError('[UNAVAILABLE]')))
+
+    def test_disconnected(self):
+        self.assertTrue(is_disconnected(imaplib.IMAP4.abort('socket error: EOF')))
+        self.assertTrue(is_disconnected(socket.timeout()))
+        self.assertFalse(is_disconnected(imaplib.IMAP4.error('BAD command')))
+
+class BackoffTest(unittest.TestCase):
+
+    def test_exponential(self):
+        backoff = Backoff(base_delay=1, max_delay=5)
+        delays = [backoff.failure() for i in range(5)]
+
+        for delay, expected in zip(delays, [1, 2, 4, 5, 5]):
+            self.assertGreaterEqual(delay, expected)
+            self.assertLessEqual(delay, expected * 1.1)
+
+        self.assertEqual(backoff.get_state().get('failures'), 5)
+
+    def test_success_reset(self):
+        backoff = Backoff(base_delay=0.01, max_delay=1)
+        backoff.failure()
+        backoff.failure()
+        backoff.success()
+
+        self.assertEqual(backoff.get_state().get('failures'), 0)
+        self.assertLessEqual(backoff.failure(), 0.011)
+
+    def test_get_delay_stateless(self):
+        backoff = Backoff(base_delay=60, max_delay=3600)
+
+        self.assertGreaterEqual(backoff.get_delay(3), 240)
+        self.assertLessEqual(backoff.get_delay(3), 264)
+        self.assertGreaterEqual(backoff.get_delay(10), 3600)
+        self.assertEqual(backoff.get_state().get('failures'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import unittest
+
+from emailutil import uid_set, uid_list, parse_copyuid, parse_modified, dot_stuff
+
+class UIDSetTest(unittest.TestCase):
+
+    def test_compress(self):
+        self.assertEqual(uid_set(['1', '2', '3', '7', '9', '10']), '1:3,7,9:10')
+
+    def test_unsorted_and_duplicate(self):
+        self.assertEqual(uid_set([10, '9', 3, 1, 2, 3]), '1:3,9:10')
+
+    def test_empty(self):
+        self.assertEqual(uid_set([]), '')
+
+    def test_expand(self):
+        self.assertEqual(uid_list('1:3,7'), ['1', '2', '3', '7'])
+        self.assertEqual(uid_list('5:3'), ['3', '4', '5'])
+
+    def test_round_trip(self):
+        uids = [str(uid) for uid in (1, 2, 5, 6, 7, 100, 102)]
+        self.assertEqual(uid_list(uid_set(uids)), uids)
+
+class ParseCopyUIDTest(unittest.TestCase):
+
+    def test_response_code(self):
+        self.assertEqual(parse_copyuid(b'[COPYUID 38505 304,319:320 3956:3958] done'),
+            ('38505', {'304':'3956', '319':'3957', '320':'3958'}))
+
+    def test_value_only(self):
+        self.assertEqual(parse_copyuid('38505 304 3956', code=False), ('38505', {'304':'3956'}))
+
+    def test_code_required(self):
+        # uid in free text is not COPYUID
+        self.assertEqual(parse_copyuid('OK 38505 304 3956 copied'), (None, {}))
+        self.assertEqual(parse_copyuid('[COPYUID 38505] broken'), (None, {}))
+
+    def test_modified(self):
+        self.assertEqual(parse_modified(b'[MODIFIED 7,9:10] Conditional STORE failed'), ['7', '9', '10'])
+        self.assertEqual(parse_modified('OK store completed'), [])
+
+class DotStuffTest(unittest.TestCase):
+
+    def test_line_start(self):
+        chunks = [b'.first\r\nsecond\r\n.third\r\n', b'.fourth\r\n']
+        self.assertEqual(b''.join(dot_stuff(chunks)), b'..first\r\nsecond\r\n..third\r\n..fourth\r\n')
+
+    def test_chunk_in_middle_of_line(self):
+        chunks = [b'hello', b'.world\r\n', b'\r\n.next\r\n']
+        self.assertEqual(b''.join(dot_stuff(chunks)), b'hello.world\r\n\r\n..next\r\n')
+
+    def test_empty_chunk(self):
+        chunks = [b'hello', b'', b'.world\r\n']
+        self.assertEqual(b''.join(dot_stuff(chunks)), b'hello.world\r\n')
+
+if __name__ == '__main__':
+    unittest.main()
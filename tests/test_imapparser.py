@@ -0,0 +1,129 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import imaplib
+import io
+import unittest
+
+from imapparser import FetchParser, append_untagged, decode_literal
+
+class FakeSocket(io.RawIOBase):
+    '''
+        response bytes waiting to be read by parser
+    '''
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.data))
+        buffer[:size] = self.data[:size]
+        del self.data[:size]
+        return size
+
+class FakeIMAP(object):
+    '''
+        imap object with canned response
+        respond = function(tag, command) return response bytes of the command
+    '''
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.sock = FakeSocket()
+        self.file = io.BufferedReader(self.sock, 16)
+        self.sent = []
+        self.untagged_responses = {}
+
+    def send(self, data):
+        tag, command = data.decode('UTF-8').rstrip('\r\n').split(' ', 1)
+        self.sent.append(command)
+        self.sock.data += self.respond(tag.encode('ASCII'), command)
+
+    def _append_untagged(self, typ, dat):
+        self.untagged_responses.setdefault(typ, []).append(dat)
+
+class FetchParserTest(unittest.TestCase):
+
+    def test_fetch_literal(self):
+        header = b'Subject: hello\r\nFrom: a@mail.com\r\n\r\n'
+
+        def respond(tag, command):
+            return (b'* 1 FETCH (UID 10 FLAGS (\\Seen) RFC822.SIZE 120 BODY[HEADER] {%d}\r\n' % len(header) + header + b')\r\n'
+                b'* 2 FETCH (UID 11 FLAGS () RFC822.SIZE 80 BODY[HEADER] {0}\r\n)\r\n' + tag + b' OK done\r\n')
+
+        imap = FakeIMAP(respond)
+        records = list(FetchParser(imap).fetch(['10', '11'], '(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER])'))
+
+        self.assertEqual(imap.sent, ['UID FETCH 10:11 (UID FLAGS RFC822.SIZE BODY.PEEK[HEADER])'])
+        self.assertEqual([record.get('UID') for record in records], ['10', '11'])
+        self.assertEqual(records[0].get('FLAGS'), ['\\Seen'])
+        self.assertEqual(records[0].get('RFC822.SIZE'), '120')
+        self.assertIsInstance(records[0].get('BODY[HEADER]'), memoryview)
+        self.assertEqual(decode_literal(records[0].get('BODY[HEADER]')), header.decode('ASCII'))
+        self.assertEqual(bytes(records[1].get('BODY[HEADER]')), b'')
+
+    def test_unsolicited_response_kept(self):
+        def respond(tag, command):
+            return (b'* 5 EXISTS\r\n* 3 FETCH (FLAGS (\\Deleted))\r\n* 1 FETCH (UID 10 FLAGS ())\r\n'
+                b'* 2 EXPUNGE\r\n' + tag + b' OK done\r\n')
+
+        imap = FakeIMAP(respond)
+        records = list(FetchParser(imap).fetch('10', '(UID FLAGS)'))
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(imap.untagged_responses.get('EXISTS'), [b'5'])
+        self.assertEqual(imap.untagged_responses.get('EXPUNGE'), [b'2'])
+        self.assertEqual(imap.untagged_responses.get('FETCH'), [b'3 (FLAGS (\\Deleted))'])
+
+    def test_failed_command(self):
+        imap = FakeIMAP(lambda tag, command: tag + b' NO [THROTTLED] slow down\r\n')
+        with self.assertRaises(imaplib.IMAP4.error) as context:
+            list(FetchParser(imap).fetch('1', '(FLAGS)'))
+
+        self.assertIn('[THROTTLED]', str(context.exception))
+
+    def test_bye(self):
+        imap = FakeIMAP(lambda tag, command: b'* BYE server shutdown\r\n')
+        with self.assertRaises(imaplib.IMAP4.abort):
+            list(FetchParser(imap).fetch('1', '(FLAGS)'))
+
+    def test_early_close_read_rest(self):
+        def respond(tag, command):
+            if command.startswith('UID SEARCH'):
+                return b'* SEARCH 4 5\r\n' + tag + b' OK done\r\n'
+
+            return b''.join(b'* %d FETCH (UID %d FLAGS ())\r\n' % (i, i) for i in range(1, 4)) + tag + b' OK done\r\n'
+
+        imap = FakeIMAP(respond)
+        parser = FetchParser(imap)
+        records = parser.fetch('1:3', '(UID FLAGS)')
+        next(records)
+        records.close()
+
+        self.assertEqual(parser.search('ALL'), ['4', '5'])
+
+    def test_search_long_line(self):
+        uids = [str(uid) for uid in range(1, 5001)]
+        imap = FakeIMAP(lambda tag, command: b'* SEARCH ' + ' '.join(uids).encode('ASCII') + b' (MODSEQ 917162500)\r\n' + tag + b' OK done\r\n')
+
+        self.assertEqual(FetchParser(imap, buffer_size=64).search('MODSEQ', '1'), uids)
+
+    def test_append_untagged(self):
+        imap = FakeIMAP(None)
+        append_untagged(imap, b'* OK [UIDNEXT 4392] Predicted next UID')
+        append_untagged(imap, b'* 23 EXISTS')
+        append_untagged(imap, b'* VANISHED (EARLIER) 1:3')
+
+        self.assertEqual(imap.untagged_responses.get('OK'), [b'[UIDNEXT 4392] Predicted next UID'])
+        self.assertEqual(imap.untagged_responses.get('UIDNEXT'), [b'4392'])
+        self.assertEqual(imap.untagged_responses.get('EXISTS'), [b'23'])
+        self.assertEqual(imap.untagged_responses.get('VANISHED'), [b'(EARLIER) 1:3'])
+
+if __name__ == '__main__':
+    unittest.main()
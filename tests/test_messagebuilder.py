@@ -0,0 +1,125 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from email.mime.text import MIMEText
+from email.policy import SMTP
+
+from messagebuilder import MessageBuilder, substitute
+
+def normalize(data):
+    '''
+        replace random boundary, so generated message can be compared
+    '''
+
+    return re.sub(rb'={15}\d{19}==', b'BOUNDARY', data)
+
+class GenerateStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file = os.path.join(self.directory, 'report.bin')
+        with open(self.file, 'wb') as f:
+            f.write(bytes(range(256)) * 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def assertSameMessage(self, message, chunk_size=1024):
+        self.assertEqual(normalize(b''.join(message.generate_stream(chunk_size))), normalize(message.generate().as_bytes(policy=SMTP)))
+
+    def test_same_as_generate(self):
+        message = MessageBuilder('jhondoe@mail.com', ['john@mail.com'], 'report')
+        message.attach_text('text without line end')
+        message.attach_text('<p>html</p>\n', 'html')
+        message.attach_application(self.file)
+        message.attach_part(MIMEText('custom part'))
+
+        self.assertSameMessage(message)
+        self.assertSameMessage(message, 57)
+
+    def test_without_attachment(self):
+        self.assertSameMessage(MessageBuilder('jhondoe@mail.com', ['john@mail.com'], 'empty'))
+
+    def test_delimiter(self):
+        message = MessageBuilder('jhondoe@mail.com', ['john@mail.com'], 'report')
+        message.attach_text('first')
+        message.attach_text('second')
+        data = normalize(b''.join(message.generate_stream()))
+
+        self.assertIn(b'\r\n\r\nfirst\r\n--BOUNDARY\r\n', data)
+        self.assertTrue(data.endswith(b'\r\n\r\nsecond\r\n--BOUNDARY--\r\n'))
+
+    def test_bcc_not_included(self):
+        message = MessageBuilder('jhondoe@mail.com', ['john@mail.com'], 'report')
+        message.set_BCC(['secret@mail.com'])
+        message.attach_text('hello')
+
+        self.assertNotIn(b'secret@mail.com', b''.join(message.generate_stream()))
+        self.assertIn('secret@mail.com', message.get_envelope()[1])
+
+class RenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file = os.path.join(self.directory, 'invoice.pdf')
+        with open(self.file, 'wb') as f:
+            f.write(b'first version')
+
+        self.template = MessageBuilder('jhondoe@mail.com', [], 'Invoice for {name}')
+        self.template.set_CC(['finance@mail.com'])
+        self.template.attach_text('Hello {name}, total {total} {unknown}').attach_application(self.file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def get_attachment(self, message):
+        return message.generate().get_payload()[1].get_payload(decode=True)
+
+    def test_substitute(self):
+        self.assertEqual(substitute('{name} owe {total}', {'name':'John', 'total':10}), 'John owe 10')
+        self.assertEqual(substitute('{missing}', {}), '{missing}')
+
+    def test_render(self):
+        message = self.template.render(['john@mail.com'], name='John', total=10)
+        generated = message.generate()
+
+        self.assertTrue(self.template.is_template())
+        self.assertEqual(generated['Subject'], 'Invoice for John')
+        self.assertEqual(generated['To'], 'john@mail.com')
+        self.assertEqual(generated['CC'], 'finance@mail.com')
+        self.assertEqual(generated.get_payload()[0].get_payload(), 'Hello John, total 10 {unknown}')
+        self.assertEqual(self.get_attachment(message), b'first version')
+
+    def test_override_cc(self):
+        message = self.template.render(['john@mail.com'], CC=[], BCC=['audit@mail.com'], name='John')
+
+        self.assertIsNone(message.generate()['CC'])
+        self.assertEqual(message.get_envelope()[1], ['john@mail.com', 'audit@mail.com'])
+
+    def test_cached_attachment(self):
+        self.template.render(['john@mail.com'], name='John')
+        with open(self.file, 'wb') as f:
+            f.write(b'second version')
+
+        # attachment built once for every render until template cache is cleared
+        self.assertEqual(self.get_attachment(self.template.render(['jane@mail.com'], name='Jane')), b'first version')
+
+        self.template.set_template(False)
+        self.assertEqual(self.get_attachment(self.template.render(['jane@mail.com'], name='Jane')), b'second version')
+
+    def test_render_stream(self):
+        message = self.template.render(['john@mail.com'], name='John', total=10)
+
+        self.assertEqual(normalize(b''.join(message.generate_stream())), normalize(message.generate().as_bytes(policy=SMTP)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,321 @@
+'''
+    Author  : Amru Rosyada
+    Email   : amru.rosyada@gmail.com
+    License : GPL3 (http://www.gnu.org/licenses/gpl-3.0.en.html)
+'''
+
+import copy
+import io
+import json
+import os
+import shutil
+import smtplib
+import tempfile
+import unittest
+
+from emailspool import SpoolFlag
+from fakeserver import FakeIMAPServer, FakeSMTPServer, make_message
+from messagebuilder import MessageBuilder
+from pxemail import PxEmail
+
+HOST = '127.0.0.1'
+USERNAME = 'jhondoe@mail.com'
+
+class PxEmailTestCase(unittest.TestCase):
+    '''
+        PxEmail object with imap user on fake imap server
+    '''
+
+    mailboxes = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.imap_server = FakeIMAPServer(copy.deepcopy(self.mailboxes))
+        self.pxemail = PxEmail()
+        self.pxemail.imap_set_directory(self.directory)
+        self.pxemail.imap_add(HOST, USERNAME, 'secret', self.imap_server.get_port(), timeout=5)
+        self.pxemail.imap_set_active(HOST, USERNAME)
+
+    def tearDown(self):
+        self.pxemail.imap_get_pool().close()
+        self.imap_server.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class SMTPTestCase(unittest.TestCase):
+    '''
+        PxEmail object with login smtp user on fake smtp server
+    '''
+
+    chunking = True
+
+    def setUp(self):
+        self.smtp_server = FakeSMTPServer(self.chunking, reject=['nobody@mail.com'])
+        self.pxemail = PxEmail()
+        self.pxemail.smtp_add(HOST, USERNAME, 'secret', self.smtp_server.get_port(), timeout=5)
+        self.pxemail.smtp_set_active(HOST, USERNAME)
+        self.pxemail.smtp_login()
+
+    def tearDown(self):
+        self.pxemail.smtp_logout()
+        self.smtp_server.stop()
+
+    def create_message(self, text):
+        message = MessageBuilder(USERNAME, ['john@mail.com', 'nobody@mail.com'], 'hello')
+        message.attach_text(text)
+        return message
+
+class SessionTest(PxEmailTestCase):
+
+    mailboxes = {'INBOX':{1:{'body':make_message(1), 'flags':[]}}, 'Sent':{}}
+
+    def test_unknown_user(self):
+        self.assertIsNone(self.pxemail.imap_session(HOST, 'nobody@mail.com'))
+
+    def test_own_active_user(self):
+        with self.pxemail.imap_session(HOST, USERNAME, 'Sent') as session:
+            self.assertTrue(session.imap_is_session())
+            self.assertEqual(session.imap_get_active().get('mailbox'), 'Sent')
+            session.imap_set_active('other.mail.com', 'other@mail.com')
+
+        self.assertFalse(self.pxemail.imap_is_session())
+        self.assertEqual(self.pxemail.imap_get_active().get('host'), HOST)
+        self.assertIsNone(self.pxemail.imap_get_active().get('mailbox'))
+
+    def test_share_pool_and_user(self):
+        pool = self.pxemail.imap_get_pool(1)
+        session = self.pxemail.imap_session(HOST, USERNAME, pooled=True)
+        try:
+            self.assertIs(session.imap_get_pool(), pool)
+            self.assertIs(session.imap_get_user(HOST, USERNAME), self.pxemail.imap_get_user(HOST, USERNAME))
+        finally:
+            session.imap_logout()
+
+    def test_pooled_unselect(self):
+        self.pxemail.imap_get_pool(1)
+        session = self.pxemail.imap_session(HOST, USERNAME, 'INBOX', pooled=True)
+        imap = session.imap_get()
+        session.imap_logout()
+        self.assertEqual(self.imap_server.commands[-1], 'UNSELECT')
+
+        # next session without mailbox must not get INBOX selected by previous session
+        session = self.pxemail.imap_session(HOST, USERNAME, pooled=True)
+        try:
+            self.assertIs(session.imap_get(), imap)
+            self.assertEqual(session.imap_get().state, 'AUTH')
+        finally:
+            session.imap_logout()
+
+    def test_pooled_timeout(self):
+        self.pxemail.imap_get_pool(1)
+        session = self.pxemail.imap_session(HOST, USERNAME, pooled=True)
+        try:
+            self.assertIsNone(self.pxemail.imap_session(HOST, USERNAME, pooled=True, timeout=0))
+        finally:
+            session.imap_logout()
+
+class SyncTest(PxEmailTestCase):
+
+    mailboxes = {'INBOX':dict((uid, {'body':make_message(uid), 'flags':['\\Seen'] if uid % 2 else []}) for uid in range(1, 6)),
+        'Sent':{1:{'body':make_message(10), 'flags':['\\Seen']}}}
+
+    def setUp(self):
+        super().setUp()
+        self.pxemail.imap_login()
+
+    def tearDown(self):
+        self.pxemail.imap_logout()
+        super().tearDown()
+
+    def get_fetch_count(self):
+        return len([command for command in self.imap_server.commands if command.upper().startswith('UID FETCH')])
+
+    def test_sync(self):
+        result = self.pxemail.imap_sync(max_workers=2, batch_size=2)
+
+        self.assertEqual(sorted(result.get('msg').get('synced')), ['INBOX', 'Sent'])
+        self.assertEqual(sorted(self.pxemail.imap_get_cached_ids('INBOX'), key=int), ['1', '2', '3', '4', '5'])
+        self.assertEqual(self.pxemail.imap_get_sync_state('INBOX').get('UIDNEXT'), 6)
+
+    def test_unchanged_skipped(self):
+        self.pxemail.imap_sync()
+        fetch_count = self.get_fetch_count()
+
+        result = self.pxemail.imap_sync()
+        self.assertEqual(result.get('msg').get('synced'), [])
+        self.assertEqual(sorted(result.get('msg').get('skipped')), ['INBOX', 'Sent'])
+        self.assertEqual(self.get_fetch_count(), fetch_count)
+
+    def test_changed_synced(self):
+        self.pxemail.imap_sync()
+        self.imap_server.mailboxes.get('INBOX')[6] = {'body':make_message(6), 'flags':[]}
+
+        result = self.pxemail.imap_sync()
+        self.assertEqual(result.get('msg').get('synced'), ['INBOX'])
+        self.assertEqual(result.get('msg').get('skipped'), ['Sent'])
+        self.assertIn('6', self.pxemail.imap_get_cached_ids('INBOX'))
+
+class MoveTest(PxEmailTestCase):
+
+    mailboxes = {'INBOX':{1:{'body':make_message(1), 'flags':['\\Seen']}, 2:{'body':make_message(2), 'flags':[]}}, 'Archive':{}}
+
+    def setUp(self):
+        super().setUp()
+        self.pxemail.imap_login()
+        self.pxemail.imap_mailbox_select('INBOX')
+        self.pxemail.imap_get_fetch_content('1')
+        self.cache_dir = self.pxemail.imap_get_cache_dir() + os.path.sep + '1'
+        self.assertTrue(os.path.isdir(self.cache_dir))
+
+    def tearDown(self):
+        self.pxemail.imap_logout()
+        super().tearDown()
+
+    def test_move_copyuid(self):
+        result = self.pxemail.imap_move(['1'], 'Archive')
+
+        self.assertEqual(result.get('msg'), {'1':'1'})
+        self.assertFalse(os.path.isdir(self.cache_dir))
+        self.assertTrue(os.path.isdir(self.pxemail.imap_get_cache_dir('Archive') + os.path.sep + '1'))
+        self.assertIsNone(self.pxemail.imap_get_dedupe_index().get('INBOX', '1'))
+        self.assertIsNotNone(self.pxemail.imap_get_dedupe_index().get('Archive', '1'))
+
+    def test_move_without_copyuid(self):
+        self.imap_server.copyuid = False
+        self.pxemail.imap_get_thread_index().add('1', '<1@mail.com>')
+        result = self.pxemail.imap_move(['1'], 'Archive')
+
+        self.assertEqual(result.get('status'), 'OK')
+        self.assertEqual(result.get('msg'), {})
+        self.assertFalse(os.path.isdir(self.cache_dir))
+        self.assertIsNone(self.pxemail.imap_get_dedupe_index().get('INBOX', '1'))
+        self.assertIsNone(self.pxemail.imap_get_thread_index().get_thread_id('1'))
+
+class StreamTest(SMTPTestCase):
+
+    def test_bdat(self):
+        message = self.create_message('hello')
+        refused = self.pxemail.smtp_send_message_stream(message)
+
+        self.assertEqual(list(refused), ['nobody@mail.com'])
+        self.assertEqual(self.smtp_server.messages[0][0], ['john@mail.com'])
+        self.assertRegex(self.smtp_server.messages[0][1], rb'\r\n\r\nhello\r\n--={15}\d{19}==--\r\n$')
+        self.assertTrue(self.smtp_server.commands[-1].endswith(' LAST'))
+
+    def test_bdat_empty(self):
+        refused = self.pxemail.smtp_send_message_file(io.BytesIO(b''), USERNAME, ['john@mail.com'])
+
+        self.assertEqual(refused, {})
+        self.assertEqual(self.smtp_server.commands[-1], 'BDAT 0 LAST')
+        self.assertEqual(self.smtp_server.messages, [(['john@mail.com'], b'')])
+
+class DataStreamTest(SMTPTestCase):
+
+    chunking = False
+
+    def test_dot_stuffing(self):
+        text = '.first line\r\nsecond line\r\n.\r\nlast line'
+        self.pxemail.smtp_send_message_stream(self.create_message(text), chunk_size=16)
+
+        self.assertIn('DATA', self.smtp_server.commands)
+        self.assertIn(b'\r\n\r\n' + text.encode('ASCII') + b'\r\n--', self.smtp_server.messages[0][1])
+
+class PooledSendTest(SMTPTestCase):
+
+    def test_send(self):
+        self.pxemail.smtp_send_message_pooled(self.create_message('hello'))
+        self.pxemail.smtp_send_message_pooled(self.create_message('hello'), stream=True)
+
+        self.assertEqual(len(self.smtp_server.messages), 2)
+        self.assertEqual(self.pxemail.smtp_get_pool().get_state().get('size'), 1)
+
+    def test_retry_before_data(self):
+        self.smtp_server.drop['MAIL'] = 1
+        self.pxemail.smtp_send_message_pooled(self.create_message('hello'), retry=1)
+
+        self.assertEqual(len(self.smtp_server.messages), 1)
+
+    def test_no_retry_after_data(self):
+        self.smtp_server.drop['BDAT'] = 1
+
+        with self.assertRaises((smtplib.SMTPServerDisconnected, OSError)):
+            self.pxemail.smtp_send_message_pooled(self.create_message('hello'), retry=1)
+
+        # message may already be accepted, so it is not sent again
+        self.assertEqual([command for command in self.smtp_server.commands if command.startswith('MAIL')][1:], [])
+
+class SpoolTest(SMTPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.spool = self.pxemail.smtp_get_spool(self.directory, rate=0, start=False)
+
+    def tearDown(self):
+        self.spool.stop()
+        super().tearDown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_enqueue(self):
+        message = self.create_message('hello')
+        spool_id = self.pxemail.smtp_enqueue_message(message)
+
+        # message generated by spool worker
+        self.assertEqual(self.spool.get(spool_id).get('status'), SpoolFlag.PREPARING)
+        self.assertEqual(self.spool.run_pending(), 1)
+
+        entry = self.spool.get(spool_id)
+        self.assertEqual(entry.get('status'), SpoolFlag.SENT)
+        self.assertIn('nobody@mail.com', entry.get('last_error'))
+        self.assertEqual(self.smtp_server.messages[0][0], ['john@mail.com'])
+        self.assertRegex(self.smtp_server.messages[0][1], rb'\r\n\r\nhello\r\n--={15}\d{19}==--\r\n$')
+
+class SnapshotTest(PxEmailTestCase):
+
+    mailboxes = {'INBOX':{1:{'body':make_message(1), 'flags':['\\Seen']}}}
+
+    def setUp(self):
+        super().setUp()
+        self.pxemail.imap_login()
+        self.pxemail.imap_mailbox_select('INBOX')
+        self.filename = self.directory + os.path.sep + 'snapshot.json'
+
+    def tearDown(self):
+        self.pxemail.imap_logout()
+        super().tearDown()
+
+    def test_without_password(self):
+        self.assertEqual(self.pxemail.snapshot(self.filename).get('status'), 'OK')
+
+        with open(self.filename, 'r') as f:
+            snapshot = json.load(f)
+
+        self.assertNotIn('password', snapshot.get('imap').get(HOST).get(USERNAME))
+        self.assertEqual(os.stat(self.filename).st_mode & 0o777, 0o600)
+
+    def test_restore(self):
+        self.pxemail.snapshot(self.filename)
+        requested = []
+
+        def get_password(protocol, host, username):
+            requested.append((protocol, host, username))
+            return 'secret'
+
+        restored = PxEmail()
+        result = restored.restore(self.filename, get_password)
+
+        self.assertEqual(result.get('msg').get('imap'), 1)
+        self.assertEqual(requested, [('imap', HOST, USERNAME)])
+        self.assertEqual(restored.imap_get_user(HOST, USERNAME).get('password'), 'secret')
+        self.assertEqual(restored.imap_get_namespace(), (HOST, USERNAME, 'INBOX'))
+        self.assertEqual(restored.imap_get_cache_dir(), self.pxemail.imap_get_cache_dir())
+
+    def test_restore_with_password(self):
+        self.pxemail.snapshot(self.filename, save_password=True)
+
+        restored = PxEmail()
+        restored.restore(self.filename)
+
+        self.assertEqual(restored.imap_get_user(HOST, USERNAME).get('password'), 'secret')
+
+if __name__ == '__main__':
+    unittest.main()